@@ -26,16 +26,23 @@ Author: Devin N. Taylor, UW-Madison
 '''
 import os
 import sys
-from itertools import permutations, combinations
+from itertools import permutations, combinations, izip
 import argparse
 import datetime
 import math
+import time
 import logging
 
 from scale_factors import LeptonScaleFactors, TriggerScaleFactors, ChargeIdSystematics, LeptonEfficiency, LeptonFakeRate
 from pu_weights import PileupWeights
 import leptonId as lepId
+import kinematics as kin
 from ntuples import *
+from columnar import ChunkedTreeReader, ChunkRow
+from branchActivation import RecordingRow, ActivatedRow, loadBranches, saveBranches, activateBranches
+from eventIndex import EventKeyIndex
+from prefetch import FilePrefetcher
+from profiling import Profiler, profileName
 
 sys.argv.append('-b')
 import ROOT as rt
@@ -55,9 +62,13 @@ class CutSequence(object):
     def add(self, fun, label=''):
         self.cut_sequence.append([fun,label])
 
-    def evaluate(self, rtrow):
+    def evaluate(self, rtrow, profiler=None, name='cut'):
         for i,cut in enumerate(self.cut_sequence):
-            if not cut[0](rtrow):
+            if profiler:
+                passed = profiler.call('%s:%s' % (name, cut[1] or i), cut[0], rtrow)
+            else:
+                passed = cut[0](rtrow)
+            if not passed:
                 self.results = i
                 return False
         self.results = i+1
@@ -69,21 +80,29 @@ class CutSequence(object):
 class CutTree(object):
     '''
     Tree for storing passing selection information.
+    A cut can require cuts added before it. In lazy mode it is then only evaluated if they pass (and fails
+    otherwise), by default every cut is evaluated and stored independently of the others.
+    Each cut is evaluated at most once, in the order they were added.
     '''
-    def __init__(self):
+    def __init__(self, lazy=False):
         # create selections
         self.labels = []
         self.selections = {}
+        self.requirements = {}
         self.results = {}
+        self.lazy = lazy
 
-    def add(self, fun, label):
+    def add(self, fun, label, requires=[]):
+        for req in requires:
+            if req not in self.selections: raise ValueError('Cut {0} requires {1}, which must be added first'.format(label,req))
         self.labels += [label]
         self.selections[label] = fun
+        self.requirements[label] = list(requires)
 
     def getLabels(self):
         return self.labels
 
-    def evaluate(self,rtrow,failed=False):
+    def evaluate(self,rtrow,failed=False,profiler=None,name='cutTree'):
         self.results['evt'] = long(rtrow.evt)
         self.results['run'] = int(rtrow.run)
         self.results['lumi'] = int(rtrow.lumi)
@@ -92,15 +111,97 @@ class CutTree(object):
                 self.results[label] = False
             return False
         passAll = True
-        for label in self.selections:
-            cut = self.selections[label]
-            self.results[label] = cut(rtrow)
+        for label in self.labels:
+            if self.lazy and not all([self.results[req] for req in self.requirements[label]]):
+                self.results[label] = False
+            else:
+                cut = self.selections[label]
+                self.results[label] = bool(profiler.call('%s:%s' % (name,label), cut, rtrow) if profiler else cut(rtrow))
             if not self.results[label]: passAll = False
         return passAll
 
     def getResults(self):
         return self.results
 
+    def getMask(self):
+        '''The results packed into a mask, bit i for the i-th cut'''
+        mask = 0
+        for i, label in enumerate(self.labels):
+            if self.results[label]: mask |= 1 << i
+        return mask
+
+allowedMetShifts = ['ees+','ees-','mes+','mes-','tes+','tes-','ues+','ues-','jes+','jes-','jres+','jres-']
+
+shiftNames = {
+    'ees+' : 'eesUp',
+    'ees-' : 'eesDown',
+    'mes+' : 'mesUp',
+    'mes-' : 'mesDown',
+    'tes+' : 'tesUp',
+    'tes-' : 'tesDown',
+    'ues+' : 'uesUp',
+    'ues-' : 'uesDown',
+    'jes+' : 'jesUp',
+    'jes-' : 'jesDown',
+    'jres+': 'jresUp',
+    'jres-': 'jresDown',
+}
+
+def inputFileName(file_name):
+    '''
+    Name to open an input file (files in /store are read over xrootd).
+    '''
+    if file_name.startswith('//store'): file_name = 'root://cmsxrootd.hep.wisc.edu/%s' % file_name
+    if file_name.startswith('/store'): file_name = 'root://cmsxrootd.hep.wisc.edu//%s' % file_name
+    if file_name.startswith('store'): file_name = 'root://cmsxrootd.hep.wisc.edu///%s' % file_name
+    return file_name
+
+def preloadCalibrations():
+    '''
+    Decode the calibration tables used by the analyzers in this process.
+    Called before forking the workers, which then share the decoded tables instead of each decoding them.
+    '''
+    for calibrationClass in [LeptonScaleFactors, TriggerScaleFactors, PileupWeights, ChargeIdSystematics, LeptonEfficiency, LeptonFakeRate]:
+        calibrationClass()
+
+def shiftFileName(out_file, shift):
+    '''
+    Output file for a met shift (i.e. sample.root -> sample_mesUp.root).
+    '''
+    if not shift: return out_file
+    base, ext = os.path.splitext(out_file)
+    return '{0}_{1}{2}'.format(base,shiftNames[shift],ext)
+
+class ShiftState(object):
+    '''
+    The output trees and event bookkeeping of a single met shift.
+    The maps are kept for the current file, only the written events are kept across files.
+    '''
+    def __init__(self, metShift, out_file, **kwargs):
+        self.metShift = metShift
+        self.out_file = out_file
+        self.eventMap = {}
+        self.bestCandMap = {}
+        self.cutTreeMap = {}
+        self.cutTreeEventsToWrite = set()
+        self.cutTreeEventsWritten = EventKeyIndex(**kwargs)
+        self.eventsToWrite = set()
+        self.eventsWritten = EventKeyIndex(**kwargs)
+        self.passedPreselection = set()
+
+    def nextFile(self):
+        '''Clear the bookkeeping of the current file'''
+        self.eventMap.clear()
+        self.bestCandMap = {}
+        self.cutTreeMap = {}
+        self.cutTreeEventsToWrite = set()
+        self.eventsToWrite = set()
+        self.passedPreselection = set()
+
+    def close(self):
+        self.eventsWritten.close()
+        self.cutTreeEventsWritten.close()
+
 def lep_order(a, b):
     '''
     A simple function to guarantee order of leptons in FSA ntuples.
@@ -169,9 +270,44 @@ class AnalyzerBase(object):
         self.period = period
         self.metShift = kwargs.pop('metShift','')
         if self.metShift:
-            if self.metShift not in ['ees+','ees-','mes+','mes-','tes+','tes-','ues+','ues-','jes+','jes-','jres+','jres-']:
+            if self.metShift not in allowedMetShifts:
                 logging.error('{0} is not an allowed met shift'.format(self.metShift))
         if self.isData: self.metShift = '' # force no shift for data
+        self.metShifts = kwargs.pop('metShifts',[]) # additional met shifts evaluated in the same pass, 'all' for every shift
+        if self.metShifts=='all': self.metShifts = [x for x in allowedMetShifts if x!=self.metShift]
+        for shift in self.metShifts:
+            if shift not in allowedMetShifts:
+                logging.error('{0} is not an allowed met shift'.format(shift))
+        self.metShifts = [x for x in self.metShifts if x in allowedMetShifts and x!=self.metShift]
+        if self.isData: self.metShifts = [] # only nominal for data
+        self.chunkSize = kwargs.pop('chunkSize',0) # read fsa ntuples in chunks of this many entries (0 = row by row)
+        self.chunkBranches = {}
+        self.branchMode = kwargs.pop('branchMode','') # 'record' the fsa branches read or 'activate' only the recorded branches
+        if self.branchMode not in ['','record','activate']:
+            logging.error('{0} is not an allowed branch mode'.format(self.branchMode))
+        self.branchFile = kwargs.pop('branchFile','')
+        self.cacheSize = kwargs.pop('cacheSize',30000000)
+        self.recordedBranches = {}
+        self.activeBranches = {}
+        self.indexSpillDir = kwargs.pop('indexSpillDir','') # spill the written event keys to disk
+        self.prefetchDir = kwargs.pop('prefetchDir','') # stage the next input files in this directory
+        self.prefetchFiles = kwargs.pop('prefetchFiles',2)
+        self.prefetchSize = kwargs.pop('prefetchSize',2000)*1000000
+        self.profile = kwargs.pop('profile',False) # time the cuts and stages, written to <output>_profile.json
+        self.profiler = None
+        self.packCutTree = kwargs.pop('packCutTree',False) # store the cut tree results as a single bitmask, evaluating the cuts lazily
+        self.rowBlockSize = kwargs.pop('rowBlockSize',1000) # pending rows are written in blocks of this many rows (the buffer starts with one block)
+        self.outputProfile = kwargs.pop('outputProfile','full') # the groups of optional fields written (see ntuples.outputProfiles)
+        self.outputGroups = getOutputGroups(self.outputProfile)
+        self.writerPreset = kwargs.pop('writerPreset','default') # compression, basket size and auto flush of the output (see ntuples.writerPresets)
+        self.writerSettings = getWriterSettings(self.writerPreset,
+            compression=kwargs.pop('compression',None),
+            compressionLevel=kwargs.pop('compressionLevel',None),
+            basketSize=kwargs.pop('basketSize',None),
+            autoFlush=kwargs.pop('autoFlush',None),
+        )
+        self.sourceNames = {}
+        self.assignmentTables = {}
 
     def __enter__(self):
         self.begin()
@@ -181,6 +317,10 @@ class AnalyzerBase(object):
         self.finish()
 
     def begin(self):
+        if self.profile:
+            self.profiler = Profiler()
+            for stage in ['choose_objects','ID','getScales','store_row','write_row']:
+                setattr(self, stage, self.profiler.timed(stage, getattr(self, stage)))
         self.lepscaler = LeptonScaleFactors()
         self.trigscaler = TriggerScaleFactors()
         self.pu_weights = PileupWeights()
@@ -188,8 +328,6 @@ class AnalyzerBase(object):
         self.lepeff = LeptonEfficiency()
         self.lepfake = LeptonFakeRate()
 
-        self.file = rt.TFile(self.out_file, 'recreate')
-        
         if hasattr(self,'other_states'):
             states = [self.initial_states] + self.other_states
         else:
@@ -197,11 +335,30 @@ class AnalyzerBase(object):
         if not hasattr(self,'alternateIds'): self.alternateIds = []
         if not hasattr(self,'doVBF'): self.doVBF = False
         if not hasattr(self,'doMetUnc'): self.doMetUnc = False
-        self.ntuple, self.branches = buildNtuple(self.object_definitions,states,self.channel,self.final_states,altIds=self.alternateIds,doVBF=self.doVBF,doMetUnc=self.doMetUnc)
-
         if hasattr(self,'cutTreeSelections'):
             self.cutTreeLabels = self.cutTreeSelections().getLabels()
-            self.cutTree, self.eventBranch, self.cutsBranch = buildCutTree(self.cutTreeLabels)
+
+        # one output per met shift, the first is the nominal output
+        self.shiftStates = []
+        for shift in [self.metShift] + self.metShifts:
+            state = ShiftState(shift, shiftFileName(self.out_file,shift) if shift!=self.metShift else self.out_file, spillDir=self.indexSpillDir)
+            state.file = rt.TFile(state.out_file, 'recreate')
+            setFileWriter(state.file,self.writerSettings)
+            state.ntuple, state.branches = buildNtuple(self.object_definitions,states,self.channel,self.final_states,altIds=self.alternateIds,doVBF=self.doVBF,doMetUnc=self.doMetUnc,outputGroups=self.outputGroups,writer=self.writerSettings)
+            if hasattr(self,'cutTreeSelections'):
+                state.cutTree, state.eventBranch, state.cutsBranch = buildCutTree(self.cutTreeLabels,packed=self.packCutTree)
+                setTreeWriter(state.cutTree,self.writerSettings)
+            state.layout = RowLayout(state.ntuple, state.branches)
+            state.eventMap = RowBuffer(state.layout, blockSize=self.rowBlockSize)
+            self.shiftStates += [state]
+        self.useShift(self.shiftStates[0])
+
+        if not self.branchFile: # default next to the output
+            self.branchFile = os.path.join(os.path.dirname(self.out_file),'branches_{0}_{1}TeV.json'.format(self.channel,self.period))
+        if self.branchMode=='activate':
+            self.activeBranches = loadBranches(self.branchFile)
+            if not self.activeBranches:
+                logging.warning('No recorded branches in {0}, reading all branches'.format(self.branchFile))
 
     def analyze(self,**kwargs):
         '''
@@ -210,147 +367,120 @@ class AnalyzerBase(object):
         logger = logging.getLogger(__name__)
 
         logger.info('%s %s Analyzing' %(self.channel, self.sample_name))
-        eventMap = {}
-        bestCandMap = {}
-        cutflowMap = {}
-        cutTreeMap = {}
-        cutTreeEventsToWrite = set()
-        cutTreeEventsWritten = set()
-        eventsToWrite = set()
-        eventsWritten = set()
-        passedPreselection = set()
         numEvts = 0
         absEvts = 0
         totalWritten = 0
+        prefetcher = None
+        if self.prefetchDir:
+            prefetcher = FilePrefetcher([inputFileName(f.strip()) for f in self.file_names], self.prefetchDir, numAhead=self.prefetchFiles, maxSize=self.prefetchSize)
 
         # iterate over files
-        for i, file_name in enumerate(self.file_names):
-            self.file_name = file_name
-            logger.info('%s %s Processing %i/%i files', self.channel, self.sample_name, i+1, len(self.file_names))
-            sys.stdout.flush()
-            if file_name.startswith('//store'): file_name = 'root://cmsxrootd.hep.wisc.edu/%s' % file_name
-            if file_name.startswith('/store'): file_name = 'root://cmsxrootd.hep.wisc.edu//%s' % file_name
-            if file_name.startswith('store'): file_name = 'root://cmsxrootd.hep.wisc.edu///%s' % file_name
-
-            rtFile = rt.TFile.Open(file_name, "READ")
-
-            # iterate over final states
-            for fs in self.final_states:
-                if len(self.file_names)<10: logger.info('%s %s %s' % (self.channel, self.sample_name, fs))
-                tree = rtFile.Get("%s/final/Ntuple" % fs)
-                #if self.period==8:
-                metatree = rtFile.Get("%s/metaInfo" % fs)
-                tempEvts = 0
-                absTempEvts = 0
-                for entry in xrange(metatree.GetEntries()):
-                    metatree.GetEntry(entry)
-                    absTempEvts += metatree.nevents
-                    tempEvts += metatree.nevents if self.isData or self.period==8 else metatree.summedWeights # gen level processed
-
-                self.objects = self.enumerate_objects(fs)
-
-                # initialize event counter
-                numFSEvents = 0
-                totalFSEvents = tree.GetEntries()
-
-                # iterate over each row of an fsa ntuple
-                rtrow = tree
-                numRows = tree.GetEntries('1')
-                for r in range(numRows):
-                    rtrow.GetEntry(r)
-                    if numFSEvents % 10000 == 0:
-                        if len(self.file_names)==1: logger.info('%s %s %s %i/%i entries' % (self.channel, self.sample_name, fs, numFSEvents, totalFSEvents))
-                        sys.stdout.flush()
-                    numFSEvents += 1
-
-                    # cache to prevent excessive reads of fsa ntuple
-                    self.cache = {}
-
-                    # event number for dictionary storing
-                    eventkey = (long(rtrow.evt), int(rtrow.lumi), int(rtrow.run))
-
-                    # if we have a cutTree, do it
+        try:
+            for i, file_name in enumerate(self.file_names):
+                self.file_name = file_name
+                logger.info('%s %s Processing %i/%i files', self.channel, self.sample_name, i+1, len(self.file_names))
+                sys.stdout.flush()
+                fileStart = time.time()
+                fileEvents = 0
+                file_name = prefetcher.get(i) if prefetcher else inputFileName(file_name)
+                if self.profiler and prefetcher: self.profiler.add('prefetch', time.time()-fileStart)
+
+                openStart = time.time()
+                rtFile = rt.TFile.Open(file_name, "READ")
+                if self.profiler: self.profiler.add('open', time.time()-openStart)
+
+                # iterate over final states
+                for fs in self.final_states:
+                    if len(self.file_names)<10: logger.info('%s %s %s' % (self.channel, self.sample_name, fs))
+                    tree = rtFile.Get("%s/final/Ntuple" % fs)
+                    if self.branchMode=='activate':
+                        if fs in self.activeBranches:
+                            activateBranches(tree,self.activeBranches[fs],cacheSize=self.cacheSize)
+                        else:
+                            logger.warning('%s %s No recorded branches for %s, reading all branches' % (self.channel, self.sample_name, fs))
+                    #if self.period==8:
+                    metatree = rtFile.Get("%s/metaInfo" % fs)
+                    tempEvts = 0
+                    absTempEvts = 0
+                    for entry in xrange(metatree.GetEntries()):
+                        metatree.GetEntry(entry)
+                        absTempEvts += metatree.nevents
+                        tempEvts += metatree.nevents if self.isData or self.period==8 else metatree.summedWeights # gen level processed
+
+                    self.objects = self.enumerate_objects(fs)
+
+                    # initialize event counter
+                    numFSEvents = 0
+                    totalFSEvents = tree.GetEntries()
+
+                    # iterate over each row of an fsa ntuple
+                    rows = self.iterate_rows(tree,fs)
+                    if self.profiler: rows = self.profiler.iterate('read', rows)
+                    for rtrow in rows:
+                        if numFSEvents % 10000 == 0:
+                            if len(self.file_names)==1: logger.info('%s %s %s %i/%i entries' % (self.channel, self.sample_name, fs, numFSEvents, totalFSEvents))
+                            sys.stdout.flush()
+                        numFSEvents += 1
+                        fileEvents += 1
+
+                        # event number for dictionary storing
+                        eventkey = (long(rtrow.evt), int(rtrow.lumi), int(rtrow.run))
+
+                        # cache to prevent excessive reads of fsa ntuple, shared by the met shifts
+                        # (shift dependent entries are keyed on the shift, see objectShift)
+                        self.cache = {}
+
+                        # the row is read once and analyzed for each met shift
+                        for state in self.shiftStates:
+                            self.useShift(state)
+
+                            self.analyze_row(rtrow,eventkey,state)
+
+                bytesRead = rtFile.GetBytesRead()
+                rtFile.Close("R")
+                if prefetcher: prefetcher.release(i)
+                numEvts += tempEvts
+                absEvts += absTempEvts
+
+                # end of file, write the ntuples
+                fillStart = time.time()
+                for state in self.shiftStates:
+                    self.useShift(state)
+                    self.file.cd()
+                    for keys, rows, filled in state.eventMap.blocks():
+                        for key, row, f in izip(keys, rows, filled):
+                            if key in state.eventsWritten:
+                                logger.warning('%s %s Attempted to write previously written event' % (self.channel, self.sample_name))
+                            else:
+                                self.write_row(row, filled=f)
+                                self.ntuple.Fill()
+                    state.eventsWritten.update(state.eventsToWrite)
                     if hasattr(self,'cutTree'):
-                        eventCutTree = self.cutTreeSelections()
-
-                    # can we define the object we want?
-                    candidate = self.choose_objects(rtrow)
-                    if not candidate or len(candidate) < 2 or len(candidate[0])<1: # in case no objects satisfy our conditions
-                        # do the cut tree stuff, this fails topology
-                        if hasattr(self,'cutTree'):
-                            if eventkey not in bestCandMap: # it has never passed before, store it
-                                cutTreeMap[eventkey] = self.storeCutTree(rtrow,eventCutTree,failed=True)
-                                cutTreeEventsToWrite.add(eventkey)
-                        continue
-
-
-                    # name candidate
-                    self.objCand = candidate[1]
-
-                    # now see if event is viable
-                    passPreselection = self.pass_preselection(rtrow)
-
-                    # check preselection
-                    if not passPreselection:
-                        if hasattr(self,'cutTree'):
-                            # check combinatorics
-                            if eventkey in bestCandMap:
-                                bestcand = bestCandMap[eventkey]
+                        for key in state.cutTreeEventsToWrite:
+                            if key in state.cutTreeEventsWritten:
+                                logger.warning('%s %s Attempted to write previously written event - cut tree' % (self.channel, self.sample_name))
                             else:
-                                numMin = len(candidate[0])
-                                bestcand = [float('inf')] * numMin
-                            if self.good_to_store(rtrow,candidate[0],bestcand):
-                                #bestCandMap[eventkey] = candidate[0]
-                                if eventkey not in passedPreselection: # dont replace something that could pass preselection
-                                    cutTreeMap[eventkey] = self.storeCutTree(rtrow,eventCutTree,failed=False)
-                                    cutTreeEventsToWrite.add(eventkey)
-                        continue # dont store in event tree, just cut tree
-
-                    passedPreselection.add(eventkey)
-
-                    # check combinatorics
-                    if eventkey in bestCandMap: 
-                        bestcand = bestCandMap[eventkey]
-                    else:
-                        numMin = len(candidate[0])
-                        bestcand = [float('inf')] * numMin
-                    if self.good_to_store(rtrow,candidate[0],bestcand):
-                        bestCandMap[eventkey] = candidate[0]
-                        ntupleRow = self.store_row(rtrow, *self.objCand)
-                        eventMap[eventkey] = ntupleRow
-                        eventsToWrite.add(eventkey)
-                        if hasattr(self,'cutTree'):
-                            cutTreeMap[eventkey] = self.storeCutTree(rtrow,eventCutTree,failed=False)
-                            cutTreeEventsToWrite.add(eventkey)
-
-            rtFile.Close("R")
-            numEvts += tempEvts
-            absEvts += absTempEvts
-
-            # end of file, write the ntuples
-            self.file.cd()
-            for key in eventsToWrite:
-                if key in eventsWritten:
-                    logger.warning('%s %s Attempted to write previously written event' % (self.channel, self.sample_name))
-                else:
-                    self.write_row(eventMap[key])
-                    self.ntuple.Fill()
-            eventsWritten.update(eventsToWrite)
-            eventMap = {}
-            eventsToWrite = set()
-            if hasattr(self,'cutTree'):
-                for key in cutTreeEventsToWrite:
-                    if key in cutTreeEventsWritten:
-                        logger.warning('%s %s Attempted to write previously written event - cut tree' % (self.channel, self.sample_name))
-                    else:
-                        self.writeCutTree(cutTreeMap[key])
-                        self.cutTree.Fill()
-                cutTreeEventsWritten.update(cutTreeEventsToWrite)
-                cutTreeMap = {}
-                cutTreeEventsToWrite = set()
-
-        logger.info('%s %s Filled Tree (%i events)' % (self.channel, self.sample_name, len(eventsWritten)))
-        logger.info('%s %s Filled Cut Tree (%i events)' % (self.channel, self.sample_name, len(cutTreeEventsWritten)))
+                                self.writeCutTree(state.cutTreeMap[key])
+                                self.cutTree.Fill()
+                        state.cutTreeEventsWritten.update(state.cutTreeEventsToWrite)
+                    state.nextFile()
+                if self.profiler:
+                    self.profiler.add('fill', time.time()-fillStart)
+                    self.profiler.addFile(self.file_name.strip(), fileEvents, bytesRead, time.time()-fileStart)
+
+        finally:
+            if prefetcher: prefetcher.close() # removes the staged files, also if the loop fails
+
+        if self.branchMode=='record':
+            for fs, branches in self.chunkBranches.iteritems():
+                self.recordedBranches.setdefault(fs,set()).update(branches)
+            saveBranches(self.branchFile,self.recordedBranches)
+            logger.info('%s %s Recorded branches in %s' % (self.channel, self.sample_name, self.branchFile))
+
+        for state in self.shiftStates:
+            shiftLabel = ' (%s)' % state.metShift if state.metShift else ''
+            logger.info('%s %s Filled Tree (%i events)%s' % (self.channel, self.sample_name, len(state.eventsWritten), shiftLabel))
+            logger.info('%s %s Filled Cut Tree (%i events)%s' % (self.channel, self.sample_name, len(state.cutTreeEventsWritten), shiftLabel))
 
         # now we store the total processed events
         logger.info('%s %s Processed %i events' % (self.channel, self.sample_name, absEvts))
@@ -364,19 +494,125 @@ class AnalyzerBase(object):
         #        else: cutflowVals[i] += 1
         #print "%s %s %s: Cutflow: " % (str(datetime.datetime.now()), self.channel, self.sample_name), cutflowVals
 
-        cutflowHist = rt.TH1F('cutflow','cutflow',len(cutflowVals)+1,0,len(cutflowVals)+1)
-        cutflowHist.SetBinContent(1,numEvts)
-        #for i in range(len(cutflowVals)):
-        #    cutflowHist.SetBinContent(i+2,cutflowVals[i])
-        ## rename cutflow bins if self.cutflow_labels defined
-        #if hasattr(self,'cutflow_labels'):
-        #    pass # TODO
-        cutflowHist.Write()
+        for state in self.shiftStates:
+            state.file.cd()
+            cutflowHist = rt.TH1F('cutflow','cutflow',len(cutflowVals)+1,0,len(cutflowVals)+1)
+            cutflowHist.SetBinContent(1,numEvts)
+            #for i in range(len(cutflowVals)):
+            #    cutflowHist.SetBinContent(i+2,cutflowVals[i])
+            ## rename cutflow bins if self.cutflow_labels defined
+            #if hasattr(self,'cutflow_labels'):
+            #    pass # TODO
+            cutflowHist.Write()
+        self.useShift(self.shiftStates[0])
+
+    def analyze_row(self,rtrow,eventkey,state):
+        '''
+        Select the best candidate of a row for the current met shift and store it in the shift state.
+        '''
+        # already written from a previous file, nothing from this row can be written
+        if eventkey in state.eventsWritten: return
+
+        # if we have a cutTree, do it
+        if hasattr(self,'cutTree'):
+            eventCutTree = self.cutTreeSelections()
+            eventCutTree.lazy = self.packCutTree
+
+        # can we define the object we want?
+        candidate = self.choose_objects(rtrow)
+        if not candidate or len(candidate) < 2 or len(candidate[0])<1: # in case no objects satisfy our conditions
+            # do the cut tree stuff, this fails topology
+            if hasattr(self,'cutTree'):
+                if eventkey not in state.bestCandMap: # it has never passed before, store it
+                    state.cutTreeMap[eventkey] = self.storeCutTree(rtrow,eventCutTree,failed=True)
+                    state.cutTreeEventsToWrite.add(eventkey)
+            return
+
+
+        # name candidate
+        self.objCand = candidate[1]
+
+        # now see if event is viable
+        passPreselection = self.pass_preselection(rtrow)
+
+        # check preselection
+        if not passPreselection:
+            if hasattr(self,'cutTree'):
+                # check combinatorics
+                if eventkey in state.bestCandMap:
+                    bestcand = state.bestCandMap[eventkey]
+                else:
+                    numMin = len(candidate[0])
+                    bestcand = [float('inf')] * numMin
+                if self.good_to_store(rtrow,candidate[0],bestcand):
+                    #bestCandMap[eventkey] = candidate[0]
+                    if eventkey not in state.passedPreselection: # dont replace something that could pass preselection
+                        state.cutTreeMap[eventkey] = self.storeCutTree(rtrow,eventCutTree,failed=False)
+                        state.cutTreeEventsToWrite.add(eventkey)
+            return # dont store in event tree, just cut tree
+
+        state.passedPreselection.add(eventkey)
+
+        # check combinatorics
+        if eventkey in state.bestCandMap: 
+            bestcand = state.bestCandMap[eventkey]
+        else:
+            numMin = len(candidate[0])
+            bestcand = [float('inf')] * numMin
+        if self.good_to_store(rtrow,candidate[0],bestcand):
+            state.bestCandMap[eventkey] = candidate[0]
+            ntupleRow = self.store_row(rtrow, *self.objCand)
+            state.eventMap.store(eventkey, ntupleRow)
+            state.eventsToWrite.add(eventkey)
+            if hasattr(self,'cutTree'):
+                state.cutTreeMap[eventkey] = self.storeCutTree(rtrow,eventCutTree,failed=False)
+                state.cutTreeEventsToWrite.add(eventkey)
+
+    def useShift(self,state):
+        '''
+        Point the analyzer at the output and met shift of a shift state.
+        '''
+        self.metShift = state.metShift
+        self.file = state.file
+        self.ntuple = state.ntuple
+        self.branches = state.branches
+        self.layout = state.layout
+        if hasattr(state,'cutTree'):
+            self.cutTree = state.cutTree
+            self.eventBranch = state.eventBranch
+            self.cutsBranch = state.cutsBranch
+
+    def iterate_rows(self,tree,fs):
+        '''
+        Iterate over the rows of an fsa ntuple.
+        In chunked mode the rows are served from numpy arrays, otherwise the tree itself is returned.
+        '''
+        if self.chunkSize:
+            branches = self.chunkBranches.setdefault(fs,list(self.activeBranches.get(fs,[])))
+            for row in ChunkedTreeReader(tree,self.chunkSize,branches=branches):
+                yield row
+        else:
+            row = tree
+            if self.branchMode=='record':
+                row = RecordingRow(tree,self.recordedBranches.setdefault(fs,set()))
+            elif self.branchMode=='activate' and fs in self.activeBranches:
+                row = ActivatedRow(tree,set(self.activeBranches[fs]))
+            numRows = tree.GetEntries()
+            for r in xrange(numRows):
+                tree.GetEntry(r)
+                yield row
 
     def finish(self):
         self.lepscaler.close()
-        self.file.Write()
-        self.file.Close()
+        for state in self.shiftStates:
+            state.file.Write()
+            state.file.Close()
+            state.close()
+        if self.profiler:
+            self.profiler.write(profileName(self.out_file))
+            for line in self.profiler.summary():
+                logging.info('%s %s %s' % (self.channel, self.sample_name, line))
+            logging.info('%s %s Wrote profile to %s' % (self.channel, self.sample_name, profileName(self.out_file)))
 
     @staticmethod
     def enumerate_objects(final_state):
@@ -396,6 +632,23 @@ class AnalyzerBase(object):
         '''
         return []
 
+    def assignments(self, ordering=[], sameFlavor=[], pairs=[]):
+        '''
+        Permutations of the final state objects where the pairs in ordering are in lep_order and the pairs
+        in sameFlavor have the same flavor. Each assignment is returned with the FSA names of the pairs
+        in pairs (i.e. e1_m1 for ordered objects e1, m1) to build the pair branches (i.e. e1_m1_SS).
+        The table is built once per final state.
+        '''
+        key = (tuple(self.objects), tuple(ordering), tuple(sameFlavor), tuple(pairs))
+        if key not in self.assignmentTables:
+            table = []
+            for l in permutations(self.objects):
+                if [1 for i,j in ordering if lep_order(l[i],l[j])]: continue
+                if [1 for i,j in sameFlavor if l[i][0]!=l[j][0]]: continue
+                table += [(l, ['%s_%s' % tuple(ordered(l[i],l[j])) for i,j in pairs])]
+            self.assignmentTables[key] = table
+        return self.assignmentTables[key]
+
     #@staticmethod
     def good_to_store(self, rtrow, cand1, cand2):
         '''
@@ -407,9 +660,14 @@ class AnalyzerBase(object):
         return False
 
     def storeCutTree(self,rtrow,eventCutTree,failed=False):
-        passAll = eventCutTree.evaluate(rtrow,failed=failed)
+        passAll = eventCutTree.evaluate(rtrow,failed=failed,profiler=self.profiler)
         results = eventCutTree.getResults()
         ntupleRow = {}
+        if self.packCutTree:
+            for key in ['evt','run','lumi']:
+                ntupleRow['event.{0}'.format(key)] = results[key]
+            ntupleRow['selections.mask'] = eventCutTree.getMask()
+            return ntupleRow
         for key in results:
             if key in ['evt','run','lumi']: # store in event branch
                 ntupleRow['event.{0}'.format(key)] = results[key]
@@ -430,253 +688,208 @@ class AnalyzerBase(object):
 
     def store_row(self,rtrow,*objects):
         '''
-        Function to return a dictionary of event values to be written to the ntuple.
+        Function to return a row of event values to be written to the ntuple.
+        The row is a list of values in the slots of the compiled ntuple layout.
         '''
-        ntupleRow = {}
-
-        ntupleRow["select.passTight"] = int(self.pass_selection(rtrow))
-        ntupleRow["select.passLoose"] = int(self.pass_preselection(rtrow))
-        ntupleRow["select.passDoubleMuon"] = int(rtrow.doubleMuPass if self.period==13 else rtrow.doubleMuPass or rtrow.doubleMuTrkPass)
-        ntupleRow["select.passDoubleEG"] = int(rtrow.doubleEPass if self.period==13 else rtrow.doubleETightPass)
-        ntupleRow["select.passMuonEG"] = int(rtrow.singleMuSingleEPass if self.period==13 else rtrow.mu17ele8isoPass)
-        ntupleRow["select.passEGMuon"] = int(rtrow.singleESingleMuPass if self.period==13 else rtrow.mu8ele17isoPass)
-        ntupleRow["select.passSingleMuon"] = int(rtrow.singleIsoMu20Pass or rtrow.singleIsoTkMu20Pass or rtrow.singleIsoMu27Pass) if self.period==13 else -1
-        ntupleRow["select.passSingleEG"] = int(rtrow.singleE23WPLoosePass) if self.period==13 else -1
-        numObjs = len(self.final_states[0])
-        finalStateObjects ='emtjgn'
-        allowedObjects = ''
-        for fsObj in finalStateObjects:
-            for fs in self.final_states:
-                if fsObj in fs:
-                    allowedObjects += fsObj
-                    break
-        numObjTypes = len(allowedObjects)
+        layout = self.layout
+        ntupleRow = layout.newRow()
+
+        select = layout.branch('select')
+        ntupleRow[select["passTight"]] = int(self.pass_selection(rtrow))
+        ntupleRow[select["passLoose"]] = int(self.pass_preselection(rtrow))
+        ntupleRow[select["passDoubleMuon"]] = int(rtrow.doubleMuPass if self.period==13 else rtrow.doubleMuPass or rtrow.doubleMuTrkPass)
+        ntupleRow[select["passDoubleEG"]] = int(rtrow.doubleEPass if self.period==13 else rtrow.doubleETightPass)
+        ntupleRow[select["passMuonEG"]] = int(rtrow.singleMuSingleEPass if self.period==13 else rtrow.mu17ele8isoPass)
+        ntupleRow[select["passEGMuon"]] = int(rtrow.singleESingleMuPass if self.period==13 else rtrow.mu8ele17isoPass)
+        ntupleRow[select["passSingleMuon"]] = int(rtrow.singleIsoMu20Pass or rtrow.singleIsoTkMu20Pass or rtrow.singleIsoMu27Pass) if self.period==13 else -1
+        ntupleRow[select["passSingleEG"]] = int(rtrow.singleE23WPLoosePass) if self.period==13 else -1
         for altId in self.alternateIds:
-            ntupleRow["select.pass_%s"%altId] = int(self.ID(rtrow,*objects,**self.alternateIdMap[altId]))
+            ntupleRow[select["pass_%s"%altId]] = int(self.ID(rtrow,*objects,**self.alternateIdMap[altId]))
 
         scales = self.getScales(rtrow,objects)
         
-        ntupleRow["event.evt"] = long(rtrow.evt)
-        ntupleRow["event.lumi"] = int(rtrow.lumi)
-        ntupleRow["event.run"] = int(rtrow.run)
-        ntupleRow["event.nvtx"] = int(rtrow.nvtx)
-        ntupleRow["event.GenNUP"] = -1 if self.isData else int(rtrow.NUP)
-        ntupleRow["event.trig_prescale"] = float(scales['trigger_prescale'])
-        ntupleRow["event.lep_scale"] = float(scales['lep'])
-        ntupleRow["event.lep_scale_e"] = float(scales['lepe'])
-        ntupleRow["event.lep_scale_m"] = float(scales['lepm'])
-        ntupleRow["event.lep_scale_up"] = float(scales['lepup'])
-        ntupleRow["event.lep_scale_e_up"] = float(scales['lepeup'])
-        ntupleRow["event.lep_scale_m_up"] = float(scales['lepmup'])
-        ntupleRow["event.lep_scale_down"] = float(scales['lepdown'])
-        ntupleRow["event.lep_scale_e_down"] = float(scales['lepedown'])
-        ntupleRow["event.lep_scale_m_down"] = float(scales['lepmdown'])
-        ntupleRow["event.trig_scale"] = float(scales['trig'])
-        ntupleRow["event.trig_scale_up"] = float(scales['trigup'])
-        ntupleRow["event.trig_scale_down"] = float(scales['trigdown'])
-        ntupleRow["event.pu_weight"] = float(scales['puweight'])
-        ntupleRow["event.pu_weight_up"] = float(scales['puweightup'])
-        ntupleRow["event.pu_weight_down"] = float(scales['puweightdown'])
-        ntupleRow["event.fakerate"] = float(scales['lepfake'])
-        ntupleRow["event.fakerate_up"] = float(scales['lepfakeup'])
-        ntupleRow["event.fakerate_down"] = float(scales['lepfakedown'])
-        ntupleRow["event.gen_weight"] = float(scales['genweight'])
-        ntupleRow["event.charge_uncertainty"] = float(scales['chargeid'])
+        event = layout.branch('event')
+        ntupleRow[event["evt"]] = long(rtrow.evt)
+        ntupleRow[event["lumi"]] = int(rtrow.lumi)
+        ntupleRow[event["run"]] = int(rtrow.run)
+        ntupleRow[event["nvtx"]] = int(rtrow.nvtx)
+        ntupleRow[event["GenNUP"]] = -1 if self.isData else int(rtrow.NUP)
+        ntupleRow[event["trig_prescale"]] = float(scales['trigger_prescale'])
+        ntupleRow[event["lep_scale"]] = float(scales['lep'])
+        ntupleRow[event["lep_scale_e"]] = float(scales['lepe'])
+        ntupleRow[event["lep_scale_m"]] = float(scales['lepm'])
+        ntupleRow[event["lep_scale_up"]] = float(scales['lepup'])
+        ntupleRow[event["lep_scale_e_up"]] = float(scales['lepeup'])
+        ntupleRow[event["lep_scale_m_up"]] = float(scales['lepmup'])
+        ntupleRow[event["lep_scale_down"]] = float(scales['lepdown'])
+        ntupleRow[event["lep_scale_e_down"]] = float(scales['lepedown'])
+        ntupleRow[event["lep_scale_m_down"]] = float(scales['lepmdown'])
+        ntupleRow[event["trig_scale"]] = float(scales['trig'])
+        ntupleRow[event["trig_scale_up"]] = float(scales['trigup'])
+        ntupleRow[event["trig_scale_down"]] = float(scales['trigdown'])
+        ntupleRow[event["pu_weight"]] = float(scales['puweight'])
+        ntupleRow[event["pu_weight_up"]] = float(scales['puweightup'])
+        ntupleRow[event["pu_weight_down"]] = float(scales['puweightdown'])
+        ntupleRow[event["fakerate"]] = float(scales['lepfake'])
+        ntupleRow[event["fakerate_up"]] = float(scales['lepfakeup'])
+        ntupleRow[event["fakerate_down"]] = float(scales['lepfakedown'])
+        ntupleRow[event["gen_weight"]] = float(scales['genweight'])
+        ntupleRow[event["charge_uncertainty"]] = float(scales['chargeid'])
 
 
         channelString = ''
         for x in objects: channelString += x[0]
-        ntupleRow["channel.channel"] = channelString
-        ntupleRow["genChannel.channel"] = self.getGenChannel(rtrow)
-        ntupleRow["fakeChannel.channel"] = self.getFakeChannel(rtrow)
-        if self.channel=='WZ': ntupleRow["fakeChannel_tightW.channel"] = self.getFakeChannel(rtrow,tightW=True)
-        if self.channel=='WZ': ntupleRow["fakeChannel_allMedium.channel"] = self.getFakeChannel(rtrow,allMedium=True)
-
-        ntupleRow["finalstate.mass"] = self.getObject(rtrow,'mass',*objects)
-        ntupleRow["finalstate.eta"] = self.getObject(rtrow,'eta',*objects)
-        ntupleRow["finalstate.phi"] = self.getObject(rtrow,'phi',*objects)
+        ntupleRow[layout.branch('channel')["channel"]] = channelString
+        ntupleRow[layout.branch('genChannel')["channel"]] = self.getGenChannel(rtrow)
+        ntupleRow[layout.branch('fakeChannel')["channel"]] = self.getFakeChannel(rtrow)
+        if self.channel=='WZ': ntupleRow[layout.branch('fakeChannel_tightW')["channel"]] = self.getFakeChannel(rtrow,tightW=True)
+        if self.channel=='WZ': ntupleRow[layout.branch('fakeChannel_allMedium')["channel"]] = self.getFakeChannel(rtrow,allMedium=True)
+
+        finalstate = layout.branch('finalstate')
+        ntupleRow[finalstate["mass"]] = self.getObject(rtrow,'mass',*objects)
+        ntupleRow[finalstate["eta"]] = self.getObject(rtrow,'eta',*objects)
+        ntupleRow[finalstate["phi"]] = self.getObject(rtrow,'phi',*objects)
         objMet = []
         for i in objects:
             objMet += [i]
         objMet += ['met']
-        ntupleRow["finalstate.mT"] = self.getObject(rtrow,'mt',*objMet)
-        ntupleRow["finalstate.sT"] = self.getObject(rtrow,'st',*objects)
-        ntupleRow["finalstate.hT"] = float(rtrow.Ht) if hasattr(rtrow,'Ht') else float(-1)
-        ntupleRow["finalstate.met"] = self.getObject(rtrow, 'pt', 'met')
-        ntupleRow["finalstate.metPhi"] = self.getObject(rtrow, 'phi', 'met')
-        ntupleRow["finalstate.leadJetPt"] = float(rtrow.jet1Pt) if self.period==13 else float(-1)
-        ntupleRow["finalstate.leadJetEta"] = float(rtrow.jet1Eta) if self.period==13 else float(-10)
-        ntupleRow["finalstate.leadJetPhi"] = float(rtrow.jet1Phi) if self.period==13 else float(-10)
-        ntupleRow["finalstate.leadJetPUMVA"] = float(rtrow.jet1PUMVA) if self.period==13 else float(-1)
-        ntupleRow["finalstate.jetVeto20"] = int(rtrow.jetVeto20)
-        ntupleRow["finalstate.jetVeto30"] = int(rtrow.jetVeto30)
-        ntupleRow["finalstate.jetVeto40"] = int(rtrow.jetVeto40)
-        ntupleRow["finalstate.bjetVeto20Loose"] = int(rtrow.bjetCISVVeto20Loose) if self.period==13 else -1
-        ntupleRow["finalstate.bjetVeto30Loose"] = int(rtrow.bjetCISVVeto30Loose) if self.period==13 else -1
-        ntupleRow["finalstate.bjetVeto20Medium"] = int(rtrow.bjetCISVVeto20Medium) if self.period==13 else int(rtrow.bjetCSVVeto)
-        ntupleRow["finalstate.bjetVeto30Medium"] = int(rtrow.bjetCISVVeto30Medium) if self.period==13 else int(rtrow.bjetCSVVeto30)
-        ntupleRow["finalstate.bjetVeto20Tight"] = int(rtrow.bjetCISVVeto20Tight) if self.period==13 else -1
-        ntupleRow["finalstate.bjetVeto30Tight"] = int(rtrow.bjetCISVVeto30Tight) if self.period==13 else -1
-
-        ntupleRow["finalstate.muonVetoTight"] = self.getObjectVetos(rtrow,'m','Tight') if self.period==13 else int(rtrow.muonVetoWZTight)
-        ntupleRow["finalstate.elecVetoTight"] = self.getObjectVetos(rtrow,'e','Tight') if self.period==13 else int(rtrow.elecVetoWZTight)
-        ntupleRow["finalstate.muonVetoLoose"] = self.getObjectVetos(rtrow,'m','Loose') if self.period==13 else int(rtrow.muVetoPt5IsoIdVtx)
-        ntupleRow["finalstate.elecVetoLoose"] = self.getObjectVetos(rtrow,'e','Loose') if self.period==13 else int(rtrow.eVetoMVAIsoVtx)
+        ntupleRow[finalstate["mT"]] = self.getObject(rtrow,'mt',*objMet)
+        ntupleRow[finalstate["sT"]] = self.getObject(rtrow,'st',*objects)
+        ntupleRow[finalstate["hT"]] = float(rtrow.Ht) if hasattr(rtrow,'Ht') else float(-1)
+        ntupleRow[finalstate["met"]] = self.getObject(rtrow, 'pt', 'met')
+        ntupleRow[finalstate["metPhi"]] = self.getObject(rtrow, 'phi', 'met')
+        ntupleRow[finalstate["leadJetPt"]] = float(rtrow.jet1Pt) if self.period==13 else float(-1)
+        ntupleRow[finalstate["leadJetEta"]] = float(rtrow.jet1Eta) if self.period==13 else float(-10)
+        ntupleRow[finalstate["leadJetPhi"]] = float(rtrow.jet1Phi) if self.period==13 else float(-10)
+        ntupleRow[finalstate["leadJetPUMVA"]] = float(rtrow.jet1PUMVA) if self.period==13 else float(-1)
+        ntupleRow[finalstate["jetVeto20"]] = int(rtrow.jetVeto20)
+        ntupleRow[finalstate["jetVeto30"]] = int(rtrow.jetVeto30)
+        ntupleRow[finalstate["jetVeto40"]] = int(rtrow.jetVeto40)
+        ntupleRow[finalstate["bjetVeto20Loose"]] = int(rtrow.bjetCISVVeto20Loose) if self.period==13 else -1
+        ntupleRow[finalstate["bjetVeto30Loose"]] = int(rtrow.bjetCISVVeto30Loose) if self.period==13 else -1
+        ntupleRow[finalstate["bjetVeto20Medium"]] = int(rtrow.bjetCISVVeto20Medium) if self.period==13 else int(rtrow.bjetCSVVeto)
+        ntupleRow[finalstate["bjetVeto30Medium"]] = int(rtrow.bjetCISVVeto30Medium) if self.period==13 else int(rtrow.bjetCSVVeto30)
+        ntupleRow[finalstate["bjetVeto20Tight"]] = int(rtrow.bjetCISVVeto20Tight) if self.period==13 else -1
+        ntupleRow[finalstate["bjetVeto30Tight"]] = int(rtrow.bjetCISVVeto30Tight) if self.period==13 else -1
+
+        ntupleRow[finalstate["muonVetoTight"]] = self.getObjectVetos(rtrow,'m','Tight') if self.period==13 else int(rtrow.muonVetoWZTight)
+        ntupleRow[finalstate["elecVetoTight"]] = self.getObjectVetos(rtrow,'e','Tight') if self.period==13 else int(rtrow.elecVetoWZTight)
+        ntupleRow[finalstate["muonVetoLoose"]] = self.getObjectVetos(rtrow,'m','Loose') if self.period==13 else int(rtrow.muVetoPt5IsoIdVtx)
+        ntupleRow[finalstate["elecVetoLoose"]] = self.getObjectVetos(rtrow,'e','Loose') if self.period==13 else int(rtrow.eVetoMVAIsoVtx)
         if self.doVBF:
-            ntupleRow["finalstate.vbfMass"] = float(rtrow.vbfMass)
-            ntupleRow["finalstate.vbfPt"] = float(rtrow.vbfdijetpt)
-            ntupleRow["finalstate.vbfPt1"] = float(rtrow.vbfj1pt)
-            ntupleRow["finalstate.vbfPt2"] = float(rtrow.vbfj2pt)
-            ntupleRow["finalstate.vbfEta1"] = float(rtrow.vbfj1eta)
-            ntupleRow["finalstate.vbfEta2"] = float(rtrow.vbfj2eta)
-            ntupleRow["finalstate.centralJetVeto20"] = float(rtrow.vbfJetVeto20)
-            ntupleRow["finalstate.centralJetVeto30"] = float(rtrow.vbfJetVeto30)
+            ntupleRow[finalstate["vbfMass"]] = float(rtrow.vbfMass)
+            ntupleRow[finalstate["vbfPt"]] = float(rtrow.vbfdijetpt)
+            ntupleRow[finalstate["vbfPt1"]] = float(rtrow.vbfj1pt)
+            ntupleRow[finalstate["vbfPt2"]] = float(rtrow.vbfj2pt)
+            ntupleRow[finalstate["vbfEta1"]] = float(rtrow.vbfj1eta)
+            ntupleRow[finalstate["vbfEta2"]] = float(rtrow.vbfj2eta)
+            ntupleRow[finalstate["centralJetVeto20"]] = float(rtrow.vbfJetVeto20)
+            ntupleRow[finalstate["centralJetVeto30"]] = float(rtrow.vbfJetVeto30)
 
         def store_state(rtrow,ntupleRow,state,theObjects,period):
             objStart = 0
             for i in state:
                 numObjects = len([ x for x in self.object_definitions[i] if x != 'n']) if theObjects else 0
                 finalObjects = theObjects[objStart:objStart+numObjects]
-                orderedFinalObjects = sorted(finalObjects, key = lambda x: getattr(rtrow,"%sPt" % x), reverse=True)
+                orderedFinalObjects = sorted(finalObjects, key = lambda x: getattr(rtrow,self.getSourceNames(x)["Pt"]), reverse=True)
+                stateSlots = layout.branch(i)
+                flvSlots = layout.branch('%sFlv' % i)
                 if len(self.object_definitions[i]) == 1:
-                    ntupleRow["%s.mass" %i] = float(-999)
-                    ntupleRow["%s.Pt" %i] = float(-9)
-                    ntupleRow["%s.Eta" %i] = float(-9)
-                    ntupleRow["%s.Phi" %i] = float(-9)
-                    ntupleRow["%s.sT" %i] = self.getObject(rtrow, "pt", finalObjects[0]) if theObjects else float(-9)
-                    ntupleRow["%s.dPhi" %i] = float(-9)
-                    ntupleRow["%s.dR" %i] = float(-9)
-                    ntupleRow["%sFlv.Flv" %i] = finalObjects[0][0] if theObjects else 'a'
+                    ntupleRow[stateSlots["mass"]] = float(-999)
+                    ntupleRow[stateSlots["Pt"]] = float(-9)
+                    ntupleRow[stateSlots["Eta"]] = float(-9)
+                    ntupleRow[stateSlots["Phi"]] = float(-9)
+                    ntupleRow[stateSlots["sT"]] = self.getObject(rtrow, "pt", finalObjects[0]) if theObjects else float(-9)
+                    ntupleRow[stateSlots["dPhi"]] = float(-9)
+                    ntupleRow[stateSlots["dR"]] = float(-9)
+                    ntupleRow[flvSlots["Flv"]] = finalObjects[0][0] if theObjects else 'a'
                 elif 'n' == self.object_definitions[i][1]:
-                    ntupleRow["%s.mass" %i] = self.getObject(rtrow, "mt", finalObjects[0], 'met') if theObjects else float(-999)
-                    ntupleRow["%s.Pt" %i] = self.getObject(rtrow, "pt", finalObjects[0], 'met') if theObjects else float(-9)
-                    ntupleRow["%s.sT" %i] = self.getObject(rtrow, "st", finalObjects[0], 'met') if theObjects else float(-9)
-                    ntupleRow["%s.dPhi" %i] = self.getObject(rtrow, "dphi", finalObjects[0], 'met') if theObjects else float(-9)
-                    ntupleRow["%sFlv.Flv" %i] = finalObjects[0][0] if theObjects else 'a'
+                    ntupleRow[stateSlots["mass"]] = self.getObject(rtrow, "mt", finalObjects[0], 'met') if theObjects else float(-999)
+                    ntupleRow[stateSlots["Pt"]] = self.getObject(rtrow, "pt", finalObjects[0], 'met') if theObjects else float(-9)
+                    ntupleRow[stateSlots["sT"]] = self.getObject(rtrow, "st", finalObjects[0], 'met') if theObjects else float(-9)
+                    ntupleRow[stateSlots["dPhi"]] = self.getObject(rtrow, "dphi", finalObjects[0], 'met') if theObjects else float(-9)
+                    ntupleRow[flvSlots["Flv"]] = finalObjects[0][0] if theObjects else 'a'
                 else:
                     finalObjOrdered = ordered(finalObjects[0], finalObjects[1]) if theObjects else []
-                    ntupleRow["%s.mass" %i] = self.getObject(rtrow, "mass", finalObjOrdered[0], finalObjOrdered[1]) if theObjects else float(-999)
-                    ntupleRow["%s.Pt" %i] = self.getObject(rtrow, "pt", finalObjOrdered[0], finalObjOrdered[1]) if theObjects else float(-9)
-                    ntupleRow["%s.sT" %i] = self.getObject(rtrow, "st", finalObjOrdered[0], finalObjOrdered[1]) if theObjects else float(-9)
-                    ntupleRow["%s.dPhi" %i] = self.getObject(rtrow, "dphi", finalObjOrdered[0], finalObjOrdered[1]) if theObjects else float(-9)
-                    ntupleRow["%s.dR" %i] = self.getObject(rtrow, "dr", finalObjOrdered[0], finalObjOrdered[1]) if theObjects else float(-9)
-                    ntupleRow["%sFlv.Flv" %i] = finalObjects[0][0] + finalObjects[1][0] if theObjects else 'aa'
+                    ntupleRow[stateSlots["mass"]] = self.getObject(rtrow, "mass", finalObjOrdered[0], finalObjOrdered[1]) if theObjects else float(-999)
+                    ntupleRow[stateSlots["Pt"]] = self.getObject(rtrow, "pt", finalObjOrdered[0], finalObjOrdered[1]) if theObjects else float(-9)
+                    ntupleRow[stateSlots["sT"]] = self.getObject(rtrow, "st", finalObjOrdered[0], finalObjOrdered[1]) if theObjects else float(-9)
+                    ntupleRow[stateSlots["dPhi"]] = self.getObject(rtrow, "dphi", finalObjOrdered[0], finalObjOrdered[1]) if theObjects else float(-9)
+                    ntupleRow[stateSlots["dR"]] = self.getObject(rtrow, "dr", finalObjOrdered[0], finalObjOrdered[1]) if theObjects else float(-9)
+                    ntupleRow[flvSlots["Flv"]] = finalObjects[0][0] + finalObjects[1][0] if theObjects else 'aa'
                 objCount = 0
                 for obj in self.object_definitions[i]:
                     if obj=='n':
-                        ntupleRow["%s.met" %i] = self.getObject(rtrow,'pt','met') if theObjects else float(-9)
-                        ntupleRow["%s.metPhi" %i] = self.getObject(rtrow, 'phi', 'met') if theObjects else float(-9)
+                        ntupleRow[stateSlots["met"]] = self.getObject(rtrow,'pt','met') if theObjects else float(-9)
+                        ntupleRow[stateSlots["metPhi"]] = self.getObject(rtrow, 'phi', 'met') if theObjects else float(-9)
 
                     else:
                         objCount += 1
+                        slots = layout.branch(i,objCount)
                         l = orderedFinalObjects[objCount-1] if theObjects else 'a'
-                        ntupleRow["%s.Pt%i" % (i,objCount)] = self.getObject(rtrow, "pt", l) if theObjects else float(-9)
-                        ntupleRow["%s.Eta%i" % (i,objCount)] = self.getObject(rtrow, "eta", l) if theObjects else float(-9)
-                        ntupleRow["%s.Phi%i" % (i,objCount)] = self.getObject(rtrow, "phi", l) if theObjects else float(-9)
+                        src = self.getSourceNames(l)
+                        ntupleRow[slots["Pt"]] = self.getObject(rtrow, "pt", l) if theObjects else float(-9)
+                        ntupleRow[slots["Eta"]] = self.getObject(rtrow, "eta", l) if theObjects else float(-9)
+                        ntupleRow[slots["Phi"]] = self.getObject(rtrow, "phi", l) if theObjects else float(-9)
                         # TODO recalculate iso with shift
                         if theObjects:
                             if l[0]=='e': isoVar = 'RelPFIsoRho'
                             if l[0]=='m': isoVar = 'RelPFIsoDBDefault'
-                            isoVal = float(getattr(rtrow, "%s%s" % (l, isoVar))) if l[0] in 'em' and theObjects else float(-9.)
+                            isoVal = float(getattr(rtrow, src[isoVar])) if l[0] in 'em' and theObjects else float(-9.)
                         else:
                             isoVal = float(-9)
-                        ntupleRow["%s.Iso%i" % (i,objCount)] = isoVal
-                        ntupleRow["%s.Dxy%i" % (i,objCount)] = float(getattr(rtrow, "%sPVDXY" % l)) if theObjects else float(-9)
-                        ntupleRow["%s.Dz%i" % (i,objCount)] = float(getattr(rtrow, "%sPVDZ" % l)) if theObjects else float(-9)
-                        ntupleRow["%s.SigmaIEtaIEta%i" % (i,objCount)] = float(getattr(rtrow, "%sSigmaIEtaIEta" % (l))) if l[0] in 'e' else float(-1.)
-                        ntupleRow["%s.DEtaIn%i" % (i,objCount)] = float(getattr(rtrow, "%sdeltaEtaSuperClusterTrackAtVtx" % (l))) if l[0] in 'e' else float(-9.)
-                        ntupleRow["%s.DPhiIn%i" % (i,objCount)] = float(getattr(rtrow, "%sdeltaPhiSuperClusterTrackAtVtx" % (l))) if l[0] in 'e' else float(-9.)
-                        ntupleRow["%s.HOverE%i" % (i,objCount)] = float(getattr(rtrow, "%sHadronicOverEM" % (l))) if l[0] in 'e' else float(-1.)
-                        ntupleRow["%s.OoEmOoP%i" % (i,objCount)] = float(abs((1.-getattr(rtrow, "%seSuperClusterOverP" % (l)))*1./getattr(rtrow, "%secalEnergy" % (l)))) if l[0] in 'e' else float(-1.)
-                        ntupleRow["%s.TriggeringMVA%i" % (i,objCount)] = float(-9. if self.period==13 else getattr(rtrow, "%sMVATrig" % (l))) if l[0] in 'e' else float(-9.)
-                        ntupleRow["%s.NonTriggeringMVA%i" % (i,objCount)] = float(getattr(rtrow, "%sMVANonTrigID" % (l)) if period==13 else getattr(rtrow, "%sMVANonTrig" % (l))) if l[0] in 'e' else float(-9.)
-                        ntupleRow["%s.NormalizedChi2%i" % (i,objCount)] = float(getattr(rtrow, "%sNormTrkChi2" % (l))) if l[0] in 'm' else float(-1.)
-                        ntupleRow["%s.JetPt%i" % (i,objCount)] = float(getattr(rtrow, "%sJetPt" % l)) if (theObjects and l[0] in 'emt') else float(-9.)
-                        ntupleRow["%s.JetBTag%i" % (i,objCount)] = float(-9.)
+                        ntupleRow[slots["Iso"]] = isoVal
+                        ntupleRow[slots["Dxy"]] = float(getattr(rtrow, src["PVDXY"])) if theObjects else float(-9)
+                        ntupleRow[slots["Dz"]] = float(getattr(rtrow, src["PVDZ"])) if theObjects else float(-9)
+                        ntupleRow[slots["SigmaIEtaIEta"]] = float(getattr(rtrow, src["SigmaIEtaIEta"])) if l[0] in 'e' else float(-1.)
+                        ntupleRow[slots["DEtaIn"]] = float(getattr(rtrow, src["deltaEtaSuperClusterTrackAtVtx"])) if l[0] in 'e' else float(-9.)
+                        ntupleRow[slots["DPhiIn"]] = float(getattr(rtrow, src["deltaPhiSuperClusterTrackAtVtx"])) if l[0] in 'e' else float(-9.)
+                        ntupleRow[slots["HOverE"]] = float(getattr(rtrow, src["HadronicOverEM"])) if l[0] in 'e' else float(-1.)
+                        ntupleRow[slots["OoEmOoP"]] = float(abs((1.-getattr(rtrow, src["eSuperClusterOverP"]))*1./getattr(rtrow, src["ecalEnergy"]))) if l[0] in 'e' else float(-1.)
+                        ntupleRow[slots["TriggeringMVA"]] = float(-9. if self.period==13 else getattr(rtrow, src["MVATrig"])) if l[0] in 'e' else float(-9.)
+                        ntupleRow[slots["NonTriggeringMVA"]] = float(getattr(rtrow, src["MVANonTrigID"]) if period==13 else getattr(rtrow, src["MVANonTrig"])) if l[0] in 'e' else float(-9.)
+                        ntupleRow[slots["NormalizedChi2"]] = float(getattr(rtrow, src["NormTrkChi2"])) if l[0] in 'm' else float(-1.)
+                        ntupleRow[slots["JetPt"]] = float(getattr(rtrow, src["JetPt"])) if (theObjects and l[0] in 'emt') else float(-9.)
+                        ntupleRow[slots["JetBTag"]] = float(-9.)
                         if theObjects and l[0] in 'emt':
-                            ntupleRow["%s.JetBTag%i" % (i,objCount)] = float(getattr(rtrow, "%sJetCSVBtag" % l)) if period==8 else float(getattr(rtrow, "%sJetPFCISVBtag" % l))
-                        if theObjects:
-                            looseScales = self.lepscaler.scale_factor(rtrow, l, lepType='Loose', period=period)
-                            mediumScales = self.lepscaler.scale_factor(rtrow, l, lepType='Medium', period=period)
-                            tightScales = self.lepscaler.scale_factor(rtrow, l, lepType='Tight', period=period)
-                            mediumLepeff = self.lepeff.scale_factor(rtrow, l, denom='Loose', numer='Medium', period=period)
-                            tightLepeff = self.lepeff.scale_factor(rtrow, l, denom='Loose', numer='Tight', period=period)
-                            mediumFake = self.lepfake.scale_factor(rtrow, l, denom='Loose', numer='Medium', period=period)
-                            tightFake = self.lepfake.scale_factor(rtrow, l, denom='Loose', numer='Tight', period=period)
-                            mediumFakeMC = self.lepfake.scale_factor(rtrow, l, denom='Loose', numer='Medium', period=period,mc=True)
-                            tightFakeMC = self.lepfake.scale_factor(rtrow, l, denom='Loose', numer='Tight', period=period,mc=True)
-                        else:
-                            looseScales = [-1,-1,-1]
-                            mediumScales = [-1,-1,-1]
-                            tightScales = [-1,-1,-1]
-                            looseLepeff = [-1,-1,-1]
-                            mediumLepeff = [-1,-1,-1]
-                            tightLepeff = [-1,-1,-1]
-                            mediumFake = [-1,-1,-1]
-                            tightFake = [-1,-1,-1]
-                            mediumFakeMC = [-1,-1,-1]
-                            tightFakeMC = [-1,-1,-1]
-                        ntupleRow["%s.LepScaleLoose%i" % (i,objCount)] = float(looseScales[0])
-                        ntupleRow["%s.LepScaleMedium%i" % (i,objCount)] = float(mediumScales[0])
-                        ntupleRow["%s.LepScaleTight%i" % (i,objCount)] = float(tightScales[0])
-                        ntupleRow["%s.LepScaleLoose%i_up" % (i,objCount)] = float(looseScales[1])
-                        ntupleRow["%s.LepScaleMedium%i_up" % (i,objCount)] = float(mediumScales[1])
-                        ntupleRow["%s.LepScaleTight%i_up" % (i,objCount)] = float(tightScales[1])
-                        ntupleRow["%s.LepScaleLoose%i_down" % (i,objCount)] = float(looseScales[2])
-                        ntupleRow["%s.LepScaleMedium%i_down" % (i,objCount)] = float(mediumScales[2])
-                        ntupleRow["%s.LepScaleTight%i_down" % (i,objCount)] = float(tightScales[2])
-                        ntupleRow["%s.LepEffMedium%i" % (i,objCount)] = float(mediumLepeff[0])
-                        ntupleRow["%s.LepEffMedium_up%s" % (i,objCount)] = float(mediumLepeff[1])
-                        ntupleRow["%s.LepEffMedium_down%s" % (i,objCount)] = float(mediumLepeff[2])
-                        ntupleRow["%s.LepEffTight%i" % (i,objCount)] = float(tightLepeff[0])
-                        ntupleRow["%s.LepEffTight_up%s" % (i,objCount)] = float(tightLepeff[1])
-                        ntupleRow["%s.LepEffTight_down%s" % (i,objCount)] = float(tightLepeff[2])
-                        ntupleRow["%s.LepFakeMedium%i" % (i,objCount)] = float(mediumFake[0])
-                        ntupleRow["%s.LepFakeMedium_up%i" % (i,objCount)] = float(mediumFake[1])
-                        ntupleRow["%s.LepFakeMedium_down%i" % (i,objCount)] = float(mediumFake[2])
-                        ntupleRow["%s.LepFakeTight%i" % (i,objCount)] = float(tightFake[0])
-                        ntupleRow["%s.LepFakeTight_up%i" % (i,objCount)] = float(tightFake[1])
-                        ntupleRow["%s.LepFakeTight_down%i" % (i,objCount)] = float(tightFake[2])
-                        ntupleRow["%s.LepFakeMCMedium%i" % (i,objCount)] = float(mediumFakeMC[0])
-                        ntupleRow["%s.LepFakeMCMedium_up%i" % (i,objCount)] = float(mediumFakeMC[1])
-                        ntupleRow["%s.LepFakeMCMedium_down%i" % (i,objCount)] = float(mediumFakeMC[2])
-                        ntupleRow["%s.LepFakeMCTight%i" % (i,objCount)] = float(tightFakeMC[0])
-                        ntupleRow["%s.LepFakeMCTight_up%i" % (i,objCount)] = float(tightFakeMC[1])
-                        ntupleRow["%s.LepFakeMCTight_down%i" % (i,objCount)] = float(tightFakeMC[2])
-                        ntupleRow["%s.Chg%i" % (i,objCount)] = float(getattr(rtrow, "%sCharge" % l)) if theObjects else float(-9)
-                        ntupleRow["%s.PassLoose%i" % (i,objCount)] = float(self.ID(rtrow,l,**self.getIdArgs('Loose'))) if theObjects else float(-9)
-                        ntupleRow["%s.PassMedium%i" % (i,objCount)] = float(self.ID(rtrow,l,**self.getIdArgs('Medium'))) if theObjects else float(-9)
-                        ntupleRow["%s.PassTight%i" % (i,objCount)] = float(self.ID(rtrow,l,**self.getIdArgs('Tight'))) if theObjects else float(-9)
-                        ntupleRow["%s.GenIsPrompt%i" % (i,objCount)] = -2000
-                        ntupleRow["%s.GenPdgId%i" % (i,objCount)] = -2000
-                        ntupleRow["%s.GenPatPdgId%i" % (i,objCount)] = -2000
-                        ntupleRow["%s.MotherGenPdgId%i" % (i,objCount)] = -2000
-                        if not self.isData and theObjects:
-                            ntupleRow["%s.GenIsPrompt%i" % (i,objCount)] = float(getattr(rtrow, "%sGenPrompt" % l))
-                            ntupleRow["%s.GenPdgId%i" % (i,objCount)] = float(getattr(rtrow, "%sGenPdgId" % l))
-                            ntupleRow["%s.GenPatPdgId%i" % (i,objCount)] = float(getattr(rtrow, "%sGenParticle" % l))
-                            ntupleRow["%s.MotherGenPdgId%i" % (i,objCount)] = float(getattr(rtrow, "%sGenMotherPdgId" % l))
-                        ntupleRow["%s.ChargeConsistent%i" % (i,objCount)] = -1
+                            ntupleRow[slots["JetBTag"]] = float(getattr(rtrow, src["JetCSVBtag"])) if period==8 else float(getattr(rtrow, src["JetPFCISVBtag"]))
+                        for var, vals in self.getLeptonScales(rtrow, l if theObjects else '', period).iteritems():
+                            for t, val in zip(['','_up','_down'], vals):
+                                ntupleRow[slots[var+t]] = float(val)
+                        ntupleRow[slots["Chg"]] = float(getattr(rtrow, src["Charge"])) if theObjects else float(-9)
+                        ntupleRow[slots["PassLoose"]] = float(self.ID(rtrow,l,**self.getIdArgs('Loose'))) if theObjects else float(-9)
+                        ntupleRow[slots["PassMedium"]] = float(self.ID(rtrow,l,**self.getIdArgs('Medium'))) if theObjects else float(-9)
+                        ntupleRow[slots["PassTight"]] = float(self.ID(rtrow,l,**self.getIdArgs('Tight'))) if theObjects else float(-9)
+                        ntupleRow[slots["GenIsPrompt"]] = -2000
+                        ntupleRow[slots["GenPdgId"]] = -2000
+                        ntupleRow[slots["GenPatPdgId"]] = -2000
+                        ntupleRow[slots["MotherGenPdgId"]] = -2000
+                        if not self.isData and theObjects and 'gen' in self.outputGroups:
+                            ntupleRow[slots["GenIsPrompt"]] = float(getattr(rtrow, src["GenPrompt"]))
+                            ntupleRow[slots["GenPdgId"]] = float(getattr(rtrow, src["GenPdgId"]))
+                            ntupleRow[slots["GenPatPdgId"]] = float(getattr(rtrow, src["GenParticle"]))
+                            ntupleRow[slots["MotherGenPdgId"]] = float(getattr(rtrow, src["GenMotherPdgId"]))
+                        ntupleRow[slots["ChargeConsistent"]] = -1
                         if theObjects and period==8:
                             if l[0]=='e':
-                                ntupleRow["%s.ChargeConsistent%i" % (i,objCount)] = int(getattr(rtrow,'%sChargeIdTight' %l))
-                        ntupleRow["%s.ExpectedMissingInnerHits%i" % (i,objCount)] = int(getattr(rtrow,'%sMissingHits' %l)) if l[0]=='e' else int(-1)
-                        ntupleRow["%s.PassConversionVeto%i" % (i,objCount)] = int(getattr(rtrow,'%sPassesConversionVeto' %l) if period==13 else not getattr(rtrow, "%sHasConversion" %l)) if l[0]=='e' else int(-1)
-                        ntupleRow["%s.IsGlobalMuon%i" % (i,objCount)] = int(getattr(rtrow,'%sIsGlobal' %l)) if l[0]=='m' else int(-1)
-                        ntupleRow["%s.IsPFMuon%i" % (i,objCount)] = int(getattr(rtrow,'%sIsPFMuon' %l)) if l[0]=='m' and period==13 else int(-1)
-                        ntupleRow["%s.IsTrackerMuon%i" % (i,objCount)] = int(getattr(rtrow,'%sIsTracker' %l)) if l[0]=='m' else int(-1)
-                        ntupleRow["%s.ValidMuonHits%i" % (i,objCount)] = int(getattr(rtrow,'%sMuonHits' %l)) if l[0]=='m' else int(-1)
-                        ntupleRow["%s.MatchedStations%i" % (i,objCount)] = int(getattr(rtrow,'%sMatchedStations' %l)) if l[0]=='m' else int(-1)
-                        ntupleRow["%s.ValidPixelHits%i" % (i,objCount)] = int(getattr(rtrow,'%sPixHits' %l)) if l[0]=='m' else int(-1)
-                        ntupleRow["%s.TrackerLayers%i" % (i,objCount)] = int(getattr(rtrow,'%sTkLayersWithMeasurement' %l)) if l[0]=='m' else int(-1)
+                                ntupleRow[slots["ChargeConsistent"]] = int(getattr(rtrow,src['ChargeIdTight']))
+                        ntupleRow[slots["ExpectedMissingInnerHits"]] = int(getattr(rtrow,src['MissingHits'])) if l[0]=='e' else int(-1)
+                        ntupleRow[slots["PassConversionVeto"]] = int(getattr(rtrow,src['PassesConversionVeto']) if period==13 else not getattr(rtrow, src["HasConversion"])) if l[0]=='e' else int(-1)
+                        ntupleRow[slots["IsGlobalMuon"]] = int(getattr(rtrow,src['IsGlobal'])) if l[0]=='m' else int(-1)
+                        ntupleRow[slots["IsPFMuon"]] = int(getattr(rtrow,src['IsPFMuon'])) if l[0]=='m' and period==13 else int(-1)
+                        ntupleRow[slots["IsTrackerMuon"]] = int(getattr(rtrow,src['IsTracker'])) if l[0]=='m' else int(-1)
+                        ntupleRow[slots["ValidMuonHits"]] = int(getattr(rtrow,src['MuonHits'])) if l[0]=='m' else int(-1)
+                        ntupleRow[slots["MatchedStations"]] = int(getattr(rtrow,src['MatchedStations'])) if l[0]=='m' else int(-1)
+                        ntupleRow[slots["ValidPixelHits"]] = int(getattr(rtrow,src['PixHits'])) if l[0]=='m' else int(-1)
+                        ntupleRow[slots["TrackerLayers"]] = int(getattr(rtrow,src['TkLayersWithMeasurement'])) if l[0]=='m' else int(-1)
                         # manually add w z deltaRs
                         if i=='w1' and len(theObjects)==3:
                             oZ1 = ordered(theObjects[0],theObjects[2]) if theObjects else []
                             oZ2 = ordered(theObjects[1],theObjects[2]) if theObjects else []
-                            ntupleRow["w1.dR1_z1_1"] = self.getObject(rtrow,"dr",oZ1[0],oZ1[1]) if theObjects else float(-9)
-                            ntupleRow["w1.dR1_z1_2"] = self.getObject(rtrow,"dr",oZ2[0],oZ2[1]) if theObjects else float(-9)
-                            ntupleRow["w1.mll_z1_1"] = self.getObject(rtrow,"mass",oZ1[0],oZ1[1]) if theObjects else float(-9)
-                            ntupleRow["w1.mll_z1_2"] = self.getObject(rtrow,"mass",oZ2[0],oZ2[1]) if theObjects else float(-9)
+                            ntupleRow[stateSlots["dR1_z1_1"]] = self.getObject(rtrow,"dr",oZ1[0],oZ1[1]) if theObjects else float(-9)
+                            ntupleRow[stateSlots["dR1_z1_2"]] = self.getObject(rtrow,"dr",oZ2[0],oZ2[1]) if theObjects else float(-9)
+                            ntupleRow[stateSlots["mll_z1_1"]] = self.getObject(rtrow,"mass",oZ1[0],oZ1[1]) if theObjects else float(-9)
+                            ntupleRow[stateSlots["mll_z1_2"]] = self.getObject(rtrow,"mass",oZ2[0],oZ2[1]) if theObjects else float(-9)
                         if i=='w1' and theObjects and self.period==13:
                             lEta = self.getObject(rtrow,'eta',theObjects[-1])
                             lPhi = self.getObject(rtrow,'phi',theObjects[-1])
@@ -684,10 +897,10 @@ class AnalyzerBase(object):
                             jEta = rtrow.jet1Eta
                             jPhi = rtrow.jet1Phi
                             dr = deltaR(lEta,lPhi,jEta,jPhi)
-                            ntupleRow["w1.dR1_leadJet"] = float(dr)
+                            ntupleRow[stateSlots["dR1_leadJet"]] = float(dr)
                         # do alternate IDs
                         for altId in self.alternateIds:
-                            ntupleRow["%s.pass_%s_%i"%(i,altId,objCount)] = int(self.ID(rtrow,l,**self.alternateIdMap[altId]) if theObjects else float(-9))
+                            ntupleRow[stateSlots["pass_%s_%i"%(altId,objCount)]] = int(self.ID(rtrow,l,**self.alternateIdMap[altId]) if theObjects else float(-9))
                 objStart += numObjects
 
 
@@ -704,7 +917,7 @@ class AnalyzerBase(object):
         lepCount = 0
         jetCount = 0
         phoCount = 0
-        orderedAllObjects = sorted(objects, key = lambda x: getattr(rtrow,"%sPt" % x), reverse=True)
+        orderedAllObjects = sorted(objects, key = lambda x: getattr(rtrow,self.getSourceNames(x)["Pt"]), reverse=True)
         for obj in orderedAllObjects:
             if obj[0] in 'emt':
                 charName = 'l'
@@ -718,106 +931,102 @@ class AnalyzerBase(object):
                 charName = 'g'
                 phoCount += 1
                 objCount = phoCount
-            ntupleRow["%s%i.Pt" % (charName,objCount)] = self.getObject(rtrow, "pt", obj)
-            ntupleRow["%s%i.Eta" % (charName,objCount)] = self.getObject(rtrow, "eta", obj)
-            ntupleRow["%s%i.Phi" % (charName,objCount)] = self.getObject(rtrow, "phi", obj)
+            slots = layout.branch('%s%i' % (charName,objCount))
+            src = self.getSourceNames(obj)
+            ntupleRow[slots["Pt"]] = self.getObject(rtrow, "pt", obj)
+            ntupleRow[slots["Eta"]] = self.getObject(rtrow, "eta", obj)
+            ntupleRow[slots["Phi"]] = self.getObject(rtrow, "phi", obj)
             # TODO isolation implementation with shifts
             if obj[0]=='e': isoVar = 'RelPFIsoRho'
             if obj[0]=='m': isoVar = 'RelPFIsoDBDefault'
-            ntupleRow["%s%i.Iso" % (charName,objCount)] = float(getattr(rtrow, "%s%s" % (obj, isoVar))) if obj[0] in 'em' else float(-1.)
-            ntupleRow["%s%i.SigmaIEtaIEta" % (charName,objCount)] = float(getattr(rtrow, "%sSigmaIEtaIEta" % (obj))) if obj[0] in 'e' else float(-1.)
-            ntupleRow["%s%i.DEtaIn" % (charName,objCount)] = float(getattr(rtrow, "%sdeltaEtaSuperClusterTrackAtVtx" % (obj))) if obj[0] in 'e' else float(-9.)
-            ntupleRow["%s%i.DPhiIn" % (charName,objCount)] = float(getattr(rtrow, "%sdeltaPhiSuperClusterTrackAtVtx" % (obj))) if obj[0] in 'e' else float(-9.)
-            ntupleRow["%s%i.HOverE" % (charName,objCount)] = float(getattr(rtrow, "%sHadronicOverEM" % (obj))) if obj[0] in 'e' else float(-1.)
-            ntupleRow["%s%i.OoEmOoP" % (charName,objCount)] = float(abs((1.-getattr(rtrow, "%seSuperClusterOverP" % (obj)))*1./getattr(rtrow, "%secalEnergy" % (obj)))) if obj[0] in 'e' else float(-1.)
-            ntupleRow["%s%i.TriggeringMVA" % (charName,objCount)] = float(-9. if self.period==13 else getattr(rtrow, "%sMVATrig" % (obj))) if obj[0] in 'e' else float(-9.)
-            ntupleRow["%s%i.NonTriggeringMVA" % (charName,objCount)] = float(getattr(rtrow, "%sMVANonTrigID" % (obj)) if self.period==13 else getattr(rtrow, "%sMVANonTrig" % (obj))) if obj[0] in 'e' else float(-9.)
-            ntupleRow["%s%i.NormalizedChi2" % (charName,objCount)] = float(getattr(rtrow, "%sNormTrkChi2" % (obj))) if obj[0] in 'm' else float(-1.)
-            ntupleRow["%s%i.JetPt" % (charName,objCount)] = float(getattr(rtrow, "%sJetPt" % obj)) if obj[0] in 'emt' else float(-1.)
+            ntupleRow[slots["Iso"]] = float(getattr(rtrow, src[isoVar])) if obj[0] in 'em' else float(-1.)
+            ntupleRow[slots["SigmaIEtaIEta"]] = float(getattr(rtrow, src["SigmaIEtaIEta"])) if obj[0] in 'e' else float(-1.)
+            ntupleRow[slots["DEtaIn"]] = float(getattr(rtrow, src["deltaEtaSuperClusterTrackAtVtx"])) if obj[0] in 'e' else float(-9.)
+            ntupleRow[slots["DPhiIn"]] = float(getattr(rtrow, src["deltaPhiSuperClusterTrackAtVtx"])) if obj[0] in 'e' else float(-9.)
+            ntupleRow[slots["HOverE"]] = float(getattr(rtrow, src["HadronicOverEM"])) if obj[0] in 'e' else float(-1.)
+            ntupleRow[slots["OoEmOoP"]] = float(abs((1.-getattr(rtrow, src["eSuperClusterOverP"]))*1./getattr(rtrow, src["ecalEnergy"]))) if obj[0] in 'e' else float(-1.)
+            ntupleRow[slots["TriggeringMVA"]] = float(-9. if self.period==13 else getattr(rtrow, src["MVATrig"])) if obj[0] in 'e' else float(-9.)
+            ntupleRow[slots["NonTriggeringMVA"]] = float(getattr(rtrow, src["MVANonTrigID"]) if self.period==13 else getattr(rtrow, src["MVANonTrig"])) if obj[0] in 'e' else float(-9.)
+            ntupleRow[slots["NormalizedChi2"]] = float(getattr(rtrow, src["NormTrkChi2"])) if obj[0] in 'm' else float(-1.)
+            ntupleRow[slots["JetPt"]] = float(getattr(rtrow, src["JetPt"])) if obj[0] in 'emt' else float(-1.)
             if obj[0] in 'emt':
-                ntupleRow["%s%i.JetBTag" % (charName,objCount)] = float(getattr(rtrow, "%sJetCSVBtag" % obj)) if self.period==8 else float(getattr(rtrow, "%sJetPFCISVBtag" % obj))
-                ntupleRow["%s%i.Dxy" % (charName,objCount)] = float(getattr(rtrow, "%sPVDXY" % obj))
-                ntupleRow["%s%i.Dz" % (charName,objCount)] = float(getattr(rtrow, "%sPVDZ" % obj))
-            looseScales = self.lepscaler.scale_factor(rtrow, obj, lepType='Loose', period=self.period)
-            mediumScales = self.lepscaler.scale_factor(rtrow, obj, lepType='Medium', period=self.period)
-            tightScales = self.lepscaler.scale_factor(rtrow, obj, lepType='Tight', period=self.period)
-            mediumLepeff = self.lepeff.scale_factor(rtrow, obj, denom='Loose', numer='Medium', period=self.period)
-            tightLepeff = self.lepeff.scale_factor(rtrow, obj, denom='Loose', numer='Tight', period=self.period)
-            mediumFake = self.lepfake.scale_factor(rtrow, obj, denom='Loose', numer='Medium', period=self.period)
-            tightFake = self.lepfake.scale_factor(rtrow, obj, denom='Loose', numer='Tight', period=self.period)
-            mediumFakeMC = self.lepfake.scale_factor(rtrow, obj, denom='Loose', numer='Medium', period=self.period, mc=True)
-            tightFakeMC = self.lepfake.scale_factor(rtrow, obj, denom='Loose', numer='Tight', period=self.period, mc=True)
-            ntupleRow["%s%i.LepScaleLoose" % (charName,objCount)] = float(looseScales[0])
-            ntupleRow["%s%i.LepScaleMedium" % (charName,objCount)] = float(mediumScales[0])
-            ntupleRow["%s%i.LepScaleTight" % (charName,objCount)] = float(tightScales[0])
-            ntupleRow["%s%i.LepScaleLoose_up" % (charName,objCount)] = float(looseScales[1])
-            ntupleRow["%s%i.LepScaleMedium_up" % (charName,objCount)] = float(mediumScales[1])
-            ntupleRow["%s%i.LepScaleTight_up" % (charName,objCount)] = float(tightScales[1])
-            ntupleRow["%s%i.LepScaleLoose_down" % (charName,objCount)] = float(looseScales[2])
-            ntupleRow["%s%i.LepScaleMedium_down" % (charName,objCount)] = float(mediumScales[2])
-            ntupleRow["%s%i.LepScaleTight_down" % (charName,objCount)] = float(tightScales[2])
-            ntupleRow["%s%i.LepEffMedium" % (charName,objCount)] = float(mediumLepeff[0])
-            ntupleRow["%s%i.LepEffMedium_up" % (charName,objCount)] = float(mediumLepeff[1])
-            ntupleRow["%s%i.LepEffMedium_down" % (charName,objCount)] = float(mediumLepeff[2])
-            ntupleRow["%s%i.LepEffTight" % (charName,objCount)] = float(tightLepeff[0])
-            ntupleRow["%s%i.LepEffTight_up" % (charName,objCount)] = float(tightLepeff[1])
-            ntupleRow["%s%i.LepEffTight_down" % (charName,objCount)] = float(tightLepeff[2])
-            ntupleRow["%s%i.LepFakeMedium" % (charName,objCount)] = float(mediumFake[0])
-            ntupleRow["%s%i.LepFakeMedium_up" % (charName,objCount)] = float(mediumFake[1])
-            ntupleRow["%s%i.LepFakeMedium_down" % (charName,objCount)] = float(mediumFake[2])
-            ntupleRow["%s%i.LepFakeTight" % (charName,objCount)] = float(tightFake[0])
-            ntupleRow["%s%i.LepFakeTight_up" % (charName,objCount)] = float(tightFake[1])
-            ntupleRow["%s%i.LepFakeTight_down" % (charName,objCount)] = float(tightFake[2])
-            ntupleRow["%s%i.LepFakeMCMedium" % (charName,objCount)] = float(mediumFakeMC[0])
-            ntupleRow["%s%i.LepFakeMCMedium_up" % (charName,objCount)] = float(mediumFakeMC[1])
-            ntupleRow["%s%i.LepFakeMCMedium_down" % (charName,objCount)] = float(mediumFakeMC[2])
-            ntupleRow["%s%i.LepFakeMCTight" % (charName,objCount)] = float(tightFakeMC[0])
-            ntupleRow["%s%i.LepFakeMCTight_up" % (charName,objCount)] = float(tightFakeMC[1])
-            ntupleRow["%s%i.LepFakeMCTight_down" % (charName,objCount)] = float(tightFakeMC[2])
-            ntupleRow["%s%i.Chg" % (charName,objCount)] = float(getattr(rtrow, "%sCharge" % obj))
-            ntupleRow["%s%i.PassLoose" % (charName,objCount)] = float(self.ID(rtrow,obj,**self.getIdArgs('Loose')))
-            ntupleRow["%s%i.PassMedium" % (charName,objCount)] = float(self.ID(rtrow,obj,**self.getIdArgs('Medium')))
-            ntupleRow["%s%i.PassTight" % (charName,objCount)] = float(self.ID(rtrow,obj,**self.getIdArgs('Tight')))
-            ntupleRow["%s%iFlv.Flv" % (charName,objCount)] = obj[0]
-            ntupleRow["%s%i.GenIsPrompt" % (charName,objCount)] = -2000
-            ntupleRow["%s%i.GenPdgId" % (charName,objCount)] = -2000
-            ntupleRow["%s%i.GenPatPdgId" % (charName,objCount)] = -2000
-            ntupleRow["%s%i.MotherGenPdgId" % (charName,objCount)] = -2000
-            if not self.isData and obj[0] in 'emt':
-                ntupleRow["%s%i.GenIsPrompt" % (charName,objCount)] = float(getattr(rtrow, "%sGenPrompt" % obj))
-                ntupleRow["%s%i.GenPdgId" % (charName,objCount)] = float(getattr(rtrow, "%sGenPdgId" % obj))
-                ntupleRow["%s%i.GenPatPdgId" % (charName,objCount)] = float(getattr(rtrow, "%sGenParticle" % obj))
-                ntupleRow["%s%i.MotherGenPdgId" % (charName,objCount)] = float(getattr(rtrow, "%sGenMotherPdgId" % obj))
-            ntupleRow["%s%i.ChargeConsistent" % (charName,objCount)] = int(getattr(rtrow,'%sChargeIdTight' %obj)) if obj[0]=='e' and self.period==8 else int(-1)
-            ntupleRow["%s%i.ExpectedMissingInnerHits" % (charName,objCount)] = int(getattr(rtrow,'%sMissingHits' %obj)) if obj[0]=='e' else int(-1)
-            ntupleRow["%s%i.PassConversionVeto" % (charName,objCount)] = int(getattr(rtrow,'%sPassesConversionVeto' %obj) if self.period==13 else not getattr(rtrow,'%sHasConversion' %obj)) if obj[0]=='e' else int(-1)
-            ntupleRow["%s%i.IsGlobalMuon" % (charName,objCount)] = int(getattr(rtrow,'%sIsGlobal' %obj)) if obj[0]=='m' else int(-1)
-            ntupleRow["%s%i.IsPFMuon" % (charName,objCount)] = int(getattr(rtrow,'%sIsPFMuon' %obj)) if obj[0]=='m'  and self.period==13 else int(-1)
-            ntupleRow["%s%i.IsTrackerMuon" % (charName,objCount)] = int(getattr(rtrow,'%sIsTracker' %obj)) if obj[0]=='m' else int(-1)
-            ntupleRow["%s%i.ValidMuonHits" % (charName,objCount)] = int(getattr(rtrow,'%sMuonHits' %obj)) if obj[0]=='m' else int(-1)
-            ntupleRow["%s%i.MatchedStations" % (charName,objCount)] = int(getattr(rtrow,'%sMatchedStations' %obj)) if obj[0]=='m' else int(-1)
-            ntupleRow["%s%i.ValidPixelHits" % (charName,objCount)] = int(getattr(rtrow,'%sPixHits' %obj)) if obj[0]=='m' else int(-1)
-            ntupleRow["%s%i.TrackerLayers" % (charName,objCount)] = int(getattr(rtrow,'%sTkLayersWithMeasurement' %obj)) if obj[0]=='m' else int(-1)
+                ntupleRow[slots["JetBTag"]] = float(getattr(rtrow, src["JetCSVBtag"])) if self.period==8 else float(getattr(rtrow, src["JetPFCISVBtag"]))
+                ntupleRow[slots["Dxy"]] = float(getattr(rtrow, src["PVDXY"]))
+                ntupleRow[slots["Dz"]] = float(getattr(rtrow, src["PVDZ"]))
+            for var, vals in self.getLeptonScales(rtrow, obj, self.period).iteritems():
+                for t, val in zip(['','_up','_down'], vals):
+                    ntupleRow[slots[var+t]] = float(val)
+            ntupleRow[slots["Chg"]] = float(getattr(rtrow, src["Charge"]))
+            ntupleRow[slots["PassLoose"]] = float(self.ID(rtrow,obj,**self.getIdArgs('Loose')))
+            ntupleRow[slots["PassMedium"]] = float(self.ID(rtrow,obj,**self.getIdArgs('Medium')))
+            ntupleRow[slots["PassTight"]] = float(self.ID(rtrow,obj,**self.getIdArgs('Tight')))
+            ntupleRow[layout.branch('%s%iFlv' % (charName,objCount))["Flv"]] = obj[0]
+            ntupleRow[slots["GenIsPrompt"]] = -2000
+            ntupleRow[slots["GenPdgId"]] = -2000
+            ntupleRow[slots["GenPatPdgId"]] = -2000
+            ntupleRow[slots["MotherGenPdgId"]] = -2000
+            if not self.isData and obj[0] in 'emt' and 'gen' in self.outputGroups:
+                ntupleRow[slots["GenIsPrompt"]] = float(getattr(rtrow, src["GenPrompt"]))
+                ntupleRow[slots["GenPdgId"]] = float(getattr(rtrow, src["GenPdgId"]))
+                ntupleRow[slots["GenPatPdgId"]] = float(getattr(rtrow, src["GenParticle"]))
+                ntupleRow[slots["MotherGenPdgId"]] = float(getattr(rtrow, src["GenMotherPdgId"]))
+            ntupleRow[slots["ChargeConsistent"]] = int(getattr(rtrow,src['ChargeIdTight'])) if obj[0]=='e' and self.period==8 else int(-1)
+            ntupleRow[slots["ExpectedMissingInnerHits"]] = int(getattr(rtrow,src['MissingHits'])) if obj[0]=='e' else int(-1)
+            ntupleRow[slots["PassConversionVeto"]] = int(getattr(rtrow,src['PassesConversionVeto']) if self.period==13 else not getattr(rtrow,src['HasConversion'])) if obj[0]=='e' else int(-1)
+            ntupleRow[slots["IsGlobalMuon"]] = int(getattr(rtrow,src['IsGlobal'])) if obj[0]=='m' else int(-1)
+            ntupleRow[slots["IsPFMuon"]] = int(getattr(rtrow,src['IsPFMuon'])) if obj[0]=='m'  and self.period==13 else int(-1)
+            ntupleRow[slots["IsTrackerMuon"]] = int(getattr(rtrow,src['IsTracker'])) if obj[0]=='m' else int(-1)
+            ntupleRow[slots["ValidMuonHits"]] = int(getattr(rtrow,src['MuonHits'])) if obj[0]=='m' else int(-1)
+            ntupleRow[slots["MatchedStations"]] = int(getattr(rtrow,src['MatchedStations'])) if obj[0]=='m' else int(-1)
+            ntupleRow[slots["ValidPixelHits"]] = int(getattr(rtrow,src['PixHits'])) if obj[0]=='m' else int(-1)
+            ntupleRow[slots["TrackerLayers"]] = int(getattr(rtrow,src['TkLayersWithMeasurement'])) if obj[0]=='m' else int(-1)
 
         return ntupleRow
 
-    def write_row(self, nrow):
+    def getLeptonScales(self, rtrow, l, period):
+        '''
+        The lepton scale factors, efficiencies and fake rates of the output profile, [nominal, up, down] by variable.
+        Only the groups written are computed, without an object (l empty) they are -1.
+        '''
+        groups = self.outputGroups
+        scales = {}
+        if 'lepScale' in groups:
+            for lepType in ['Loose','Medium','Tight']:
+                scales['LepScale%s' % lepType] = self.lepscaler.scale_factor(rtrow, l, lepType=lepType, period=period) if l else [-1,-1,-1]
+        if 'lepEff' in groups:
+            for numer in ['Medium','Tight']:
+                scales['LepEff%s' % numer] = self.lepeff.scale_factor(rtrow, l, denom='Loose', numer=numer, period=period) if l else [-1,-1,-1]
+        if 'lepFake' in groups:
+            for numer in ['Medium','Tight']:
+                scales['LepFake%s' % numer] = self.lepfake.scale_factor(rtrow, l, denom='Loose', numer=numer, period=period) if l else [-1,-1,-1]
+        if 'lepFakeMC' in groups:
+            for numer in ['Medium','Tight']:
+                scales['LepFakeMC%s' % numer] = self.lepfake.scale_factor(rtrow, l, denom='Loose', numer=numer, period=period, mc=True) if l else [-1,-1,-1]
+        return scales
+
+    def getSourceNames(self, obj):
+        '''
+        Get the FSA branch names of an object.
+        '''
+        if obj not in self.sourceNames: self.sourceNames[obj] = SourceNames(obj)
+        return self.sourceNames[obj]
+
+    def write_row(self, nrow, filled=None):
         '''
         Function to write the ntuple row to the tree.
         '''
-        for key,val in nrow.iteritems():
-            branch, var = key.split('.')
-            setattr(self.branches[branch],var,val)
+        self.layout.write(nrow, filled)
 
     def pass_preselection(self, rtrow):
         '''
         Wrapper for preselection defined by user.
         '''
-        if 'preselection' in self.cache: return self.cache['preselection']
+        key = 'preselection' + self.metShift
+        if key in self.cache: return self.cache[key]
         cuts = self.preselection(rtrow)
-        cutResults = cuts.evaluate(rtrow)
-        self.cache['cutflow'] = cuts
-        self.cache['preselection'] = cutResults
+        cutResults = cuts.evaluate(rtrow,profiler=self.profiler,name='preselection')
+        self.cache['cutflow' + self.metShift] = cuts
+        self.cache[key] = cutResults
         return cutResults
 
     def pass_selection(self,rtrow):
@@ -825,10 +1034,11 @@ class AnalyzerBase(object):
         Wrapper for the selection defined by the user (tight selection whereas preselection
         is the loose selection for fake rate method).
         '''
-        if 'selection' in self.cache: return self.cache['selection']
+        key = 'selection' + self.metShift
+        if key in self.cache: return self.cache[key]
         cuts = self.selection(rtrow)
-        cutResults = cuts.evaluate(rtrow)
-        self.cache['selection'] = cutResults
+        cutResults = cuts.evaluate(rtrow,profiler=self.profiler,name='selection')
+        self.cache[key] = cutResults
         return cutResults
 
     def npass(self,rtrow,numObjects,**kwargs):
@@ -870,11 +1080,12 @@ class AnalyzerBase(object):
         for obj in objects:
             if obj[0] not in idDef: continue
             type = idDef[obj[0]]
-            if 'ID_%s_%s' %(type,obj) in self.cache:
-                if not self.cache['ID_%s_%s'%(type,obj)]: return False
+            key = 'ID_%s_%s%s' % (type,obj,self.objectShift(obj))
+            if key in self.cache:
+                if not self.cache[key]: return False
             else:
-                result = lepId.lep_id(rtrow,self.period,obj,idType=idDef[obj[0]],metShift=self.metShift)
-                self.cache['ID_%s_%s'%(type,obj)] = result
+                result = self.evaluateId(rtrow,obj,type)
+                self.cache[key] = result
                 if not result: return False
         # TODO support iso cut with shift
         if isoCut:
@@ -889,8 +1100,22 @@ class AnalyzerBase(object):
                 if getattr(rtrow, '%s%s' %(obj,isotype)) > isoCut[obj[0]]: return False
         return True
 
+    def evaluateId(self,rtrow,obj,idType):
+        '''
+        Evaluate the ID of an object. In chunked mode the ID is evaluated on the arrays of the
+        whole chunk (IdPredicate.evaluate) the first time it is needed, and the row's entry returned.
+        '''
+        predicate = lepId.getIdPredicate(obj,self.period,idType,self.metShift)
+        if not isinstance(rtrow,ChunkRow): return predicate(rtrow)
+        reader = rtrow.getReader()
+        passes = reader.derivedColumn(predicate, lambda: predicate.evaluate(reader.column,len(reader)))
+        return bool(passes[rtrow.getIndex()])
+
     def getScales(self,rtrow,objects,**lepargs):
-        '''Return the scale factors in a dictionary'''
+        '''
+        Return the scale factors in a dictionary. The MC weights are left at 1 for data, the lepton
+        scale factors and fake rates unless their groups are in the output profile.
+        '''
         scales = {
             'lep'             : 1,
             'lepe'            : 1,
@@ -917,12 +1142,21 @@ class AnalyzerBase(object):
         if self.period==8: # TODO: move when we have numbers for 13 tev
             chargeid  = self.chargeid.systematic(rtrow, *objects, period=self.period)
             scales['chargeid'] = chargeid
-        trigeff_data = self.trigscaler.scale_factor(rtrow, *objects, period=self.period, useData=True, metShift=self.metShift)
-        trigeffup_data = self.trigscaler.scale_factor(rtrow, *objects, period=self.period, shiftUp=True, useData=True, metShift=self.metShift)
-        trigeffdown_data = self.trigscaler.scale_factor(rtrow, *objects, period=self.period, shiftDown=True, useData=True, metShift=self.metShift)
-        trigeff_mc = self.trigscaler.scale_factor(rtrow, *objects, period=self.period, useData=False, metShift=self.metShift)
-        trigeffup_mc = self.trigscaler.scale_factor(rtrow, *objects, period=self.period, shiftUp=True, useData=False, metShift=self.metShift)
-        trigeffdown_mc = self.trigscaler.scale_factor(rtrow, *objects, period=self.period, shiftDown=True, useData=False, metShift=self.metShift)
+        groups = self.outputGroups
+        if not self.isData:
+            self.getMCWeights(rtrow,objects,scales,**lepargs)
+        if 'lepFake' in groups:
+            self.getFakeWeights(rtrow,objects,scales,**lepargs)
+        scales['trigger_prescale'] = self.getTriggerPrescale(rtrow)
+        genweight = rtrow.GenWeight if hasattr(rtrow,'GenWeight') else 1.
+        scales['genweight'] = genweight
+        return scales
+
+    def getMCWeights(self,rtrow,objects,scales,**lepargs):
+        '''Fill the trigger, pileup and lepton scale factors (MC only)'''
+        trigeffs_data, trigeffs_mc = self.trigscaler.scale_factors(rtrow, *objects, period=self.period, metShift=self.metShift)
+        trigeff_data, trigeffup_data, trigeffdown_data = trigeffs_data
+        trigeff_mc, trigeffup_mc, trigeffdown_mc = trigeffs_mc
         trigscale = trigeff_data/trigeff_mc if trigeff_mc else 1.
         trigscaleup = trigeffup_data/trigeffup_mc if trigeffup_mc else 1.
         trigscaledown = trigeffdown_data/trigeffdown_mc if trigeffdown_mc else 1.
@@ -933,6 +1167,7 @@ class AnalyzerBase(object):
         scales['puweight'] = puweight[0]
         scales['puweightup'] = puweight[1]
         scales['puweightdown'] = puweight[2]
+        if 'lepScale' not in self.outputGroups: return
         # do different based on category
         lepscales = [1.,1.,1.]
         lepescales = [1.,1.,1.]
@@ -977,6 +1212,10 @@ class AnalyzerBase(object):
         scales['lepdown']  = lepscales[2]
         scales['lepedown'] = lepescales[2]
         scales['lepmdown'] = lepmscales[2]
+
+    def getFakeWeights(self,rtrow,objects,scales,**lepargs):
+        '''Fill the fake rate weight (data fake rates of the leptons failing the tight ID)'''
+        wl = self.objCand[-1]
         passtight = []
         for obj in objects:
             if self.tightW: passtight += [1 if self.ID(rtrow,obj,**self.getIdArgs('Tight' if obj==wl else 'Medium')) else 0]
@@ -994,10 +1233,6 @@ class AnalyzerBase(object):
         scales['lepfake'] = totalfake[0]
         scales['lepfakeup'] = totalfake[1]
         scales['lepfakedown'] = totalfake[2]
-        scales['trigger_prescale'] = self.getTriggerPrescale(rtrow)
-        genweight = rtrow.GenWeight if hasattr(rtrow,'GenWeight') else 1.
-        scales['genweight'] = genweight
-        return scales
 
     def getTriggerPrescale(self,rtrow):
         '''Default trigger prescale'''
@@ -1016,10 +1251,21 @@ class AnalyzerBase(object):
             chan += 'P' if self.ID(rtrow,obj,**self.getIdArgs('Tight')) else 'F'
         return chan
 
+    def objectShift(self,obj):
+        '''
+        The met shift that changes an object ('' if none), to key the cache of the shift dependent
+        values: energy scale shifts only change their own leptons, every shift changes the met.
+        '''
+        if not self.metShift: return ''
+        if obj[0]=='e': return self.metShift if self.metShift in lepId.electronShifts else ''
+        if obj[0]=='m': return self.metShift if self.metShift in lepId.muonShifts else ''
+        if obj[0]=='t' or obj[0]=='j': return ''
+        return self.metShift # met and composite objects
+
     def getObject(self,rtrow,var,*objs,**kwargs):
         '''Get modified object'''
         key = 'getObject' + var
-        for obj in objs: key += obj
+        for obj in objs: key += obj + self.objectShift(obj)
         if key in self.cache: return self.cache[key]
         if len(objs)==1 and objs[0]=='met': # get met with shift
             if var=='eta': return 0.
@@ -1091,6 +1337,7 @@ class AnalyzerBase(object):
             etas = []
             phis = []
             masses = {'e':0.511e-3, 'm':0.1056, 't':1.776, 'j':0}
+            needVec = var in ['pt','mass','m','mt','eta','phi']
             for obj in objs:
                 pt = self.getObject(rtrow,'pt',obj,**kwargs)
                 eta = self.getObject(rtrow,'eta',obj,**kwargs)
@@ -1099,18 +1346,15 @@ class AnalyzerBase(object):
                     mass = masses[obj[0]]
                 else:
                     mass = 0.
-                vec = rt.TLorentzVector()
-                vec.SetPtEtaPhiM(pt,eta,phi,mass)
-                vecs += [vec]
+                if needVec: vecs += [kin.p4(pt,eta,phi,mass)]
                 pts += [pt]
                 etas += [eta]
                 phis += [phi]
-            vec = rt.TLorentzVector()
-            for v in vecs: vec += v
+            if needVec: vec = kin.add(*vecs)
             if var=='pt':
-                val = vec.Pt()
+                val = kin.pt(vec)
             if var=='mass' or var=='m':
-                val = vec.M()
+                val = kin.mass(vec)
             if var=='mt':
                 val = 0.
                 #if val < 20:
@@ -1124,14 +1368,13 @@ class AnalyzerBase(object):
                 if len(objs)>1 and objs[-1]=='met':
                     #val = math.sqrt(2*pts[0]*pts[1]*(1-math.cos(deltaPhi(phis[0],phis[1]))))
                     #val = getattr(rtrow,'{0}MtToPfMet_type1'.format(objs[0]))
-                    candVec = rt.TLorentzVector()
-                    for v in vecs[:-1]: candVec += v
+                    candVec = kin.add(*vecs[:-1])
                     metVec = vecs[-1]
-                    val = math.sqrt(abs((candVec.Et()+metVec.Et())**2 - (vec.Pt())**2))
+                    val = kin.mt(candVec,metVec)
             if var=='eta':
-                val = vec.Eta()
+                val = kin.eta(vec)
             if var=='phi':
-                val = vec.Phi()
+                val = kin.phi(vec)
             if var=='dr' and len(objs)==2:
                 val = deltaR(etas[0],phis[0],etas[1],phis[1])
             if var=='dr' and len(objs)!=2:
@@ -1149,7 +1392,7 @@ class AnalyzerBase(object):
         return val
 
     def getObjectVetos(self,rtrow,flv,vetoType):
-        key = 'getObjectVetos'+flv+vetoType
+        key = 'getObjectVetos'+flv+vetoType+self.objectShift(flv)
         if key in self.cache: return self.cache[key]
         vetoMap = {
             'e' : {
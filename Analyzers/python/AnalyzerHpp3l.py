@@ -56,23 +56,19 @@ class AnalyzerHpp3l(AnalyzerBase):
         '''
         Select candidate objects
         '''
-        cands = []
-        for l in permutations(self.objects):
-            if lep_order(l[0], l[1]):
-                continue
-
-            SS1 = getattr(rtrow, "%s_%s_SS" % (l[0], l[1])) > 0 # select same sign
-            OS = getattr(rtrow, "%sCharge" % l[0]) != getattr(rtrow, "%sCharge" % l[2]) # select opposite sign
-            pts = [getattr(rtrow, "%sPt" %x) for x in l]
+        # the first admissible assignment is the candidate
+        for l, pairNames in self.assignments(ordering=[(0,1)], pairs=[(0,1)]):
+            SS1 = getattr(rtrow, "%s_SS" % pairNames[0]) > 0 # select same sign
+            if not SS1: continue
+            OS = getattr(rtrow, self.getSourceNames(l[0])["Charge"]) != getattr(rtrow, self.getSourceNames(l[2])["Charge"]) # select opposite sign
+            if not OS: continue
+
+            pts = [getattr(rtrow, self.getSourceNames(x)["Pt"]) for x in l]
             sumpt = sum(pts)
+            ordList = [l[1], l[0], l[2]] if pts[0] < pts[1] else l
+            return [[-sumpt],list(ordList)] # minimization is by veto, but pass sumpts for loose id
 
-            if SS1 and OS:
-                ordList = [l[1], l[0], l[2]] if getattr(rtrow,'%sPt' % l[0]) < getattr(rtrow,'%sPt' % l[1]) else l
-                cands.append([[-sumpt],list(ordList)]) # minimization is by veto, but pass sumpts for loose id
-
-        if not len(cands): return 0
-
-        return (cands[0])
+        return 0
 
     # override choose_alternative_objects
     def choose_alternative_objects(self, rtrow, state):
@@ -84,14 +80,11 @@ class AnalyzerHpp3l(AnalyzerBase):
             bestZDiff = float('inf')
             bestLeptons = []
 
-            for l in permutations(self.objects):
-                if lep_order(l[0],l[1]):
-                    continue
-
-                os1 = getattr(rtrow,'%s_%s_SS' % (l[0], l[1])) < 0.5
-                m1 = getattr(rtrow,'%s_%s_Mass' % (l[0], l[1]))
+            for l, pairNames in self.assignments(ordering=[(0,1)], sameFlavor=[(0,1)], pairs=[(0,1)]):
+                os1 = getattr(rtrow,'%s_SS' % pairNames[0]) < 0.5
+                m1 = getattr(rtrow,'%s_Mass' % pairNames[0])
 
-                if l[0][0] == l[1][0] and os1 and abs(m1-ZMASS) < bestZDiff:
+                if os1 and abs(m1-ZMASS) < bestZDiff:
                     bestZDiff = abs(m1-ZMASS)
                     ordList = [l[1], l[0], l[2]] if getattr(rtrow,'%sPt' % l[0]) < getattr(rtrow,'%sPt' % l[1]) else l
                     bestLeptons = ordList
@@ -58,33 +58,35 @@ class AnalyzerHpp4l(AnalyzerBase):
         Select candidate objects
         return them ++-- with ++ and -- ordered in pt
         '''
-        cands = []
-        for l in permutations(self.objects):
-            if lep_order(l[0], l[1]) or lep_order(l[2], l[3]):
-                continue
-
-            SS1 = getattr(rtrow, "%s_%s_SS" % (l[0], l[1])) > 0 # select same sign
-            mass1 = getattr(rtrow, "%s_%s_Mass" % (l[0], l[1])) # select mass
-            SS2 = getattr(rtrow, "%s_%s_SS" % (l[2], l[3])) > 0 # select same sign
-            mass2 = getattr(rtrow, "%s_%s_Mass" % (l[2], l[3])) # select mass
+        best = None
+        for l, pairNames in self.assignments(ordering=[(0,1),(2,3)], pairs=[(0,1),(2,3)]):
             #OS = getattr(rtrow, "%sCharge" % l[0]) != getattr(rtrow, "%sCharge" % l[2]) # select opposite sign
-            C1 = getattr(rtrow, "%sCharge" % l[0]) > 0
-            C2 = getattr(rtrow, "%sCharge" % l[2]) < 0
+            C1 = getattr(rtrow, self.getSourceNames(l[0])["Charge"]) > 0
+            if not C1: continue
+            C2 = getattr(rtrow, self.getSourceNames(l[2])["Charge"]) < 0
+            if not C2: continue
+            SS1 = getattr(rtrow, "%s_SS" % pairNames[0]) > 0 # select same sign
+            if not SS1: continue
+            SS2 = getattr(rtrow, "%s_SS" % pairNames[1]) > 0 # select same sign
+            if not SS2: continue
+
+            mass1 = getattr(rtrow, "%s_Mass" % pairNames[0]) # select mass
+            mass2 = getattr(rtrow, "%s_Mass" % pairNames[1]) # select mass
             massdiff = abs(mass1-mass2)
 
-            #if SS1 and SS2 and OS:
-            if SS1 and SS2 and C1 and C2:
+            # keep the first candidate with the smallest mass difference
+            if best is None or massdiff < best[0]:
                 #order by pt
-                l0 = l[0] if getattr(rtrow,'%sPt' % l[0]) > getattr(rtrow,'%sPt' % l[1]) else l[1]
-                l1 = l[1] if getattr(rtrow,'%sPt' % l[0]) > getattr(rtrow,'%sPt' % l[1]) else l[0]
-                l2 = l[2] if getattr(rtrow,'%sPt' % l[2]) > getattr(rtrow,'%sPt' % l[3]) else l[3]
-                l3 = l[3] if getattr(rtrow,'%sPt' % l[2]) > getattr(rtrow,'%sPt' % l[3]) else l[2]
-                cands.append([massdiff,[l0,l1,l2,l3]]) # minimization is by mass diff
+                pts = [getattr(rtrow, self.getSourceNames(x)["Pt"]) for x in l]
+                l0 = l[0] if pts[0] > pts[1] else l[1]
+                l1 = l[1] if pts[0] > pts[1] else l[0]
+                l2 = l[2] if pts[2] > pts[3] else l[3]
+                l3 = l[3] if pts[2] > pts[3] else l[2]
+                best = [massdiff,[l0,l1,l2,l3]] # minimization is by mass diff
 
-        if not len(cands): return 0
+        if best is None: return 0
 
-        cands.sort(key=lambda x: x[0])
-        massdiff, leps = cands[0]
+        massdiff, leps = best
 
         return ([massdiff], leps)
 
@@ -99,16 +101,13 @@ class AnalyzerHpp4l(AnalyzerBase):
             bestSt = 0
             bestLeptons = []
 
-            for l in permutations(self.objects):
-                if lep_order(l[0],l[1]) or lep_order(l[2],l[3]):
-                    continue
-
-                os1 = getattr(rtrow,'%s_%s_SS' % (l[0], l[1])) < 0.5
-                m1 = getattr(rtrow,'%s_%s_Mass' % (l[0], l[1]))
-                os2 = getattr(rtrow,'%s_%s_SS' % (l[2], l[3])) < 0.5
+            for l, pairNames in self.assignments(ordering=[(0,1),(2,3)], sameFlavor=[(0,1),(2,3)], pairs=[(0,1),(2,3)]):
+                os1 = getattr(rtrow,'%s_SS' % pairNames[0]) < 0.5
+                m1 = getattr(rtrow,'%s_Mass' % pairNames[0])
+                os2 = getattr(rtrow,'%s_SS' % pairNames[1]) < 0.5
                 st2 = getattr(rtrow,'%sPt' %l[2]) + getattr(rtrow,'%sPt' %l[3])
 
-                if l[0][0] == l[1][0] and os1 and l[2][0]==l[3][0] and os2:
+                if os1 and os2:
                     if abs(m1-ZMASS) < bestZDiff:
                         bestZDiff = abs(m1-ZMASS)
                         bestSt = st2
@@ -119,15 +118,12 @@ class AnalyzerHpp4l(AnalyzerBase):
                         bestLeptons = l
 
             if not bestLeptons: # try to find just a Z candidate
-                for l in permutations(self.objects):
-                    if lep_order(l[0],l[1]) or lep_order(l[2],l[3]):
-                        continue
-
-                    os1 = getattr(rtrow,'%s_%s_SS' % (l[0], l[1])) < 0.5
-                    m1 = getattr(rtrow,'%s_%s_Mass' % (l[0], l[1]))
+                for l, pairNames in self.assignments(ordering=[(0,1),(2,3)], sameFlavor=[(0,1)], pairs=[(0,1)]):
+                    os1 = getattr(rtrow,'%s_SS' % pairNames[0]) < 0.5
+                    m1 = getattr(rtrow,'%s_Mass' % pairNames[0])
                     st2 = getattr(rtrow,'%sPt' %l[2]) + getattr(rtrow,'%sPt' %l[3])
 
-                    if l[0][0] == l[1][0] and os1:
+                    if os1:
                         if abs(m1-ZMASS) < bestZDiff:
                             bestZDiff = abs(m1-ZMASS)
                             bestSt = st2
@@ -53,17 +53,14 @@ class AnalyzerWZ(AnalyzerBase):
         We select combinatorics by closest to zmass.
         '''
 
-        cands = []
-        for l in permutations(self.objects):
-            if lep_order(l[0], l[1]):
-                continue
+        # the veto does not depend on the assignment
+        veto = self.veto(rtrow)
+        if not veto: return ([],[])
 
-            OS1 = getattr(rtrow, "%s_%s_SS" % (l[0], l[1])) < 0.5 # select opposite sign
-            mass = self.getObject(rtrow, 'mass', l[0], l[1])
-            massdiff = abs(ZMASS-mass)
-            pt2 = self.getObject(rtrow,'pt', l[2])
-
-            ordList = [l[1], l[0], l[2]] if self.getObject(rtrow,'pt',l[0]) < self.getObject(rtrow,'pt', l[1]) else [l[0], l[1], l[2]]
+        best = None
+        for l, pairNames in self.assignments(ordering=[(0,1)], sameFlavor=[(0,1)], pairs=[(0,1)]):
+            OS1 = getattr(rtrow, "%s_SS" % pairNames[0]) < 0.5 # select opposite sign
+            if not OS1: continue
 
             ## make sure they are all separated (no split tracks)
             #o01 = ordered(l[0],l[1])
@@ -73,18 +70,19 @@ class AnalyzerWZ(AnalyzerBase):
             #dr02 = self.getObject(rtrow,'dr',o02[0],o02[1]) > 0.02
             #dr12 = self.getObject(rtrow,'dr',o12[0],o12[1]) > 0.02
             #dr = dr01 and dr02 and dr12 
-            dr = True
-      
-            veto = self.veto(rtrow)
 
-            if OS1 and l[0][0]==l[1][0] and dr and veto:
-                cands.append((massdiff, -pt2, mass, ordList))
+            mass = self.getObject(rtrow, 'mass', l[0], l[1])
+            massdiff = abs(ZMASS-mass)
+
+            # keep the first candidate closest to the Z mass
+            if best is None or massdiff < best[0]:
+                pt2 = self.getObject(rtrow,'pt', l[2])
+                ordList = [l[1], l[0], l[2]] if self.getObject(rtrow,'pt',l[0]) < self.getObject(rtrow,'pt', l[1]) else [l[0], l[1], l[2]]
+                best = (massdiff, -pt2, mass, ordList)
 
-        if not len(cands): return ([],[])
+        if best is None: return ([],[])
 
-        # Sort by mass difference
-        cands.sort(key=lambda x: x[0])
-        massdiff, negpt2, mass, leps = cands[0]
+        massdiff, negpt2, mass, leps = best
 
         return ([massdiff,negpt2], leps)
 
@@ -179,22 +177,24 @@ class AnalyzerWZ(AnalyzerBase):
     ### Define preselection ###
     ###########################
     def cutTreeSelections(self):
+        # in lazy mode (--packCutTree) the IDs are only evaluated after the trigger and fiducial cuts, the kinematic cuts after the loose ID
+        presel = ['trigger','fiducial']
         cutTree = CutTree()
         cutTree.add(self.returnTrue,'topology')
         cutTree.add(self.trigger,'trigger')
         cutTree.add(self.fiducial,'fiducial')
-        cutTree.add(self.ID_loose,'looseID')
-        cutTree.add(self.ID_medium,'mediumID')
-        cutTree.add(self.ID_tight,'tightID')
-        if self.tightW: cutTree.add(self.ID_tightW,'tightWID')
-        cutTree.add(self.mass3l,'mass3l')
-        cutTree.add(self.zWindow,'zWindow')
-        cutTree.add(self.zLeadPt,'zLeadPt')
-        cutTree.add(self.wPt,'wPt')
-        cutTree.add(self.wMll,'wMll')
-        cutTree.add(self.met,'met')
-        cutTree.add(self.bjetVeto,'bjetVeto')
-        cutTree.add(self.veto,'veto4thLepton')
+        cutTree.add(self.ID_loose,'looseID',requires=presel)
+        cutTree.add(self.ID_medium,'mediumID',requires=presel)
+        cutTree.add(self.ID_tight,'tightID',requires=presel)
+        if self.tightW: cutTree.add(self.ID_tightW,'tightWID',requires=presel)
+        cutTree.add(self.mass3l,'mass3l',requires=presel+['looseID'])
+        cutTree.add(self.zWindow,'zWindow',requires=presel+['looseID'])
+        cutTree.add(self.zLeadPt,'zLeadPt',requires=presel+['looseID'])
+        cutTree.add(self.wPt,'wPt',requires=presel+['looseID'])
+        cutTree.add(self.wMll,'wMll',requires=presel+['looseID'])
+        cutTree.add(self.met,'met',requires=presel+['looseID'])
+        cutTree.add(self.bjetVeto,'bjetVeto',requires=presel+['looseID'])
+        cutTree.add(self.veto,'veto4thLepton',requires=presel+['looseID'])
         return cutTree
 
     def veto(self,rtrow):
@@ -399,15 +399,16 @@ class AnalyzerWZ_ZFakeRate(AnalyzerWZ):
         self.channel = 'FakeRate'
 
     def cutTreeSelections(self):
+        presel = ['trigger','fiducial']
         cutTree = CutTree()
         cutTree.add(self.returnTrue,'topology')
         cutTree.add(self.trigger,'trigger')
         cutTree.add(self.fiducial,'fiducial')
-        cutTree.add(self.ID_tight_Z,'looseProbe')
-        cutTree.add(self.ID_medium,'mediumProbe')
-        cutTree.add(self.ID_tight,'tightProbe')
-        cutTree.add(self.zSelection,'zSelection')
-        cutTree.add(self.veto,'veto4thLepton')
+        cutTree.add(self.ID_tight_Z,'looseProbe',requires=presel)
+        cutTree.add(self.ID_medium,'mediumProbe',requires=presel)
+        cutTree.add(self.ID_tight,'tightProbe',requires=presel)
+        cutTree.add(self.zSelection,'zSelection',requires=presel+['looseProbe'])
+        cutTree.add(self.veto,'veto4thLepton',requires=presel+['looseProbe'])
         return cutTree
 
     def preselection(self,rtrow):
@@ -501,18 +502,19 @@ class AnalyzerWZ_TTFakeRate(AnalyzerWZ):
         self.channel = 'TTFakeRate'
 
     def cutTreeSelections(self):
+        presel = ['trigger','fiducial']
         cutTree = CutTree()
         cutTree.add(self.returnTrue,'topology')
         cutTree.add(self.trigger,'trigger')
         cutTree.add(self.fiducial,'fiducial')
-        cutTree.add(self.ID_tight_TT,'looseProbe')
-        cutTree.add(self.ID_tight,'tightProbe')
-        cutTree.add(self.ID_veryTight,'veryTightProbe')
-        cutTree.add(self.zVeto,'zVeto')
-        cutTree.add(self.jetCut,'jetCut')
-        cutTree.add(self.bjetCut,'bjetCut')
-        cutTree.add(self.metCut,'metCut')
-        cutTree.add(self.veto,'veto4thLepton')
+        cutTree.add(self.ID_tight_TT,'looseProbe',requires=presel)
+        cutTree.add(self.ID_tight,'tightProbe',requires=presel)
+        cutTree.add(self.ID_veryTight,'veryTightProbe',requires=presel)
+        cutTree.add(self.zVeto,'zVeto',requires=presel+['looseProbe'])
+        cutTree.add(self.jetCut,'jetCut',requires=presel+['looseProbe'])
+        cutTree.add(self.bjetCut,'bjetCut',requires=presel+['looseProbe'])
+        cutTree.add(self.metCut,'metCut',requires=presel+['looseProbe'])
+        cutTree.add(self.veto,'veto4thLepton',requires=presel+['looseProbe'])
         return cutTree
 
     def preselection(self,rtrow):
@@ -563,19 +565,14 @@ class AnalyzerWZ_TTFakeRate(AnalyzerWZ):
             if self.metShift in vetoMap:
                 veto = vetoMap[self.metShift]
 
-        cands = []
-        for l in permutations(self.objects):
-            if lep_order(l[0], l[1]):
-                continue
-
-            OS01 = getattr(rtrow, "%s_%s_SS" % (l[0], l[1])) < 0.5 # select opposite sign
-            o02 = ordered(l[0],l[2])
-            OS02 = getattr(rtrow, "%s_%s_SS" % (o02[0], o02[1])) < 0.5 # select opposite sign
-            o12 = ordered(l[1],l[2])
-            OS12 = getattr(rtrow, "%s_%s_SS" % (o12[0], o12[1])) < 0.5 # select opposite sign
-            st = self.getObject(rtrow,'pt', l[0]) + self.getObject(rtrow,'pt', l[1]) + self.getObject(rtrow,'pt', l[2])
+        if not veto: return ([],[])
 
-            ordList = [l[1], l[0], l[2]] if self.getObject(rtrow,'pt',l[0]) < self.getObject(rtrow,'pt', l[1]) else [l[0], l[1], l[2]]
+        best = None
+        for l, pairNames in self.assignments(ordering=[(0,1)], pairs=[(0,1),(0,2),(1,2)]):
+            OS01 = getattr(rtrow, "%s_SS" % pairNames[0]) < 0.5 # select opposite sign
+            if not OS01: continue
+            OS02 = getattr(rtrow, "%s_SS" % pairNames[1]) < 0.5 # select opposite sign
+            OS12 = getattr(rtrow, "%s_SS" % pairNames[2]) < 0.5 # select opposite sign
 
             SF01 = l[0][0] == l[1][0]
             SF02 = l[0][0] == l[2][0]
@@ -585,14 +582,16 @@ class AnalyzerWZ_TTFakeRate(AnalyzerWZ):
             if OS02 and SF02: continue
             if OS12 and SF12: continue
 
-            if OS01 and veto:
-                cands.append((-st, ordList))
+            st = self.getObject(rtrow,'pt', l[0]) + self.getObject(rtrow,'pt', l[1]) + self.getObject(rtrow,'pt', l[2])
+
+            # keep the first candidate with the highest st
+            if best is None or -st < best[0]:
+                ordList = [l[1], l[0], l[2]] if self.getObject(rtrow,'pt',l[0]) < self.getObject(rtrow,'pt', l[1]) else [l[0], l[1], l[2]]
+                best = (-st, ordList)
 
-        if not len(cands): return ([],[])
+        if best is None: return ([],[])
 
-        # Sort by mass difference
-        cands.sort(key=lambda x: x[0])
-        negst, leps = cands[0]
+        negst, leps = best
 
         return ([negst], leps)
 
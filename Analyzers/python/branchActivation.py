@@ -0,0 +1,105 @@
+'''
+Record which FSA branches an analyzer reads and activate only those on later runs.
+
+The FSA ntuples carry thousands of branches, of which an analyzer only reads a
+few hundred. In record mode every branch read through the row is remembered
+(per final state) and written to a json file. In activate mode the recorded
+branches are the only ones enabled (SetBranchStatus) and they are added to a
+sized TTreeCache, so the rest of the tree is never read or decompressed.
+
+Recording must be done with every configuration that reads different branches
+(data and MC, each met shift); the branch file is the union of all recordings,
+merged under a lock so parallel jobs recording into the same file do not drop
+each other's branches. A branch read in activate mode that was not recorded is
+enabled on first access (with a warning) rather than returning a stale value.
+
+Author: Devin N. Taylor, UW-Madison
+'''
+import os
+import json
+import fcntl
+import logging
+
+class RecordingRow(object):
+    '''
+    Wrapper around a row that records the names of the branches read.
+    '''
+    __slots__ = ['_row', '_accessed']
+
+    def __init__(self, row, accessed):
+        self._row = row
+        self._accessed = accessed
+
+    def __getattr__(self, name):
+        val = getattr(self._row, name)
+        self._accessed.add(name)
+        return val
+
+class ActivatedRow(object):
+    '''
+    Wrapper around a tree with only the recorded branches active, enabling the other branches when they are read.
+    '''
+    __slots__ = ['_tree', '_active']
+
+    def __init__(self, tree, active):
+        self._tree = tree
+        self._active = active
+
+    def __getattr__(self, name):
+        if name not in self._active:
+            enableBranch(self._tree, name)
+            self._active.add(name)
+        return getattr(self._tree, name)
+
+def enableBranch(tree, name):
+    '''
+    Enable a branch disabled by activateBranches and read it for the current entry.
+    Returns False if it is not a branch of the tree.
+    '''
+    branch = tree.GetBranch(name)
+    if not branch: return False
+    if not tree.GetBranchStatus(name):
+        logging.getLogger(__name__).warning('Branch %s of %s was not recorded, enabling it (record the branches again)' % (name, tree.GetName()))
+        tree.SetBranchStatus(name,1)
+        tree.AddBranchToCache(name,True)
+        if tree.GetReadEntry()>=0: branch.GetEntry(tree.GetReadEntry())
+    return True
+
+def loadBranches(branchFile):
+    '''Load the recorded branches, a dictionary of final state to list of branches.'''
+    if not os.path.isfile(branchFile): return {}
+    with open(branchFile,'r') as f:
+        return json.load(f)
+
+def saveBranches(branchFile, recorded):
+    '''Merge the recorded branches into the branch file (locked, jobs may record into the same file concurrently).'''
+    branchDir = os.path.dirname(branchFile)
+    if branchDir and not os.path.isdir(branchDir): os.makedirs(branchDir)
+    with open(branchFile+'.lock','w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        branches = loadBranches(branchFile)
+        for fs, names in recorded.iteritems():
+            branches[fs] = sorted(set(branches.get(fs,[])) | set(names))
+        tmpFile = '{0}.tmp{1}'.format(branchFile,os.getpid())
+        with open(tmpFile,'w') as f:
+            json.dump(branches, f, indent=4, sort_keys=True)
+        os.rename(tmpFile,branchFile)
+
+def activateBranches(tree, names, cacheSize=30000000):
+    '''
+    Disable all branches but names and cache them.
+    Returns the list of branches that were enabled.
+    '''
+    logger = logging.getLogger(__name__)
+    available = set([b.GetName() for b in tree.GetListOfBranches()])
+    enabled = [b for b in names if b in available]
+    missing = len(names)-len(enabled)
+    if missing: logger.debug('%i recorded branches not in %s' % (missing, tree.GetName()))
+    tree.SetBranchStatus('*',0)
+    for b in enabled:
+        tree.SetBranchStatus(b,1)
+    tree.SetCacheSize(cacheSize)
+    for b in enabled:
+        tree.AddBranchToCache(b,True)
+    tree.StopCacheLearningPhase()
+    return enabled
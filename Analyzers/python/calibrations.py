@@ -0,0 +1,190 @@
+'''
+A compiled bundle of the ISA calibrations.
+
+The scale factor, efficiency, fake rate, pileup and b-tag tables are read from
+many JSON, text, pickle, CSV and ROOT files. Each table is compiled by its
+consumer into numpy arrays and JSON metadata, buildCalibrations.py writes all of
+them into a single versioned bundle file:
+
+    magic (8 bytes) | header length (8 bytes) | JSON header | aligned arrays
+
+The header lists the tables with the offsets of their arrays and the size,
+modification time and sha1 hash of every source file. The bundle is memory
+mapped and a table is only decoded when it is requested, into the python lists
+and dictionaries its consumer queries (the decoded tables are not shared between
+processes). run.py decodes them once in the parent (preloadCalibrations in
+AnalyzerBase) so the forked workers skip the decoding. A table is rebuilt from
+its sources if the bundle is missing, of another version, or if any of its
+sources changed.
+
+Author: Devin N. Taylor, UW-Madison
+'''
+import os
+import json
+import struct
+import hashlib
+import logging
+
+import numpy as np
+
+BUNDLE_VERSION = 1
+MAGIC = 'ISACALIB'
+ALIGNMENT = 64
+
+baseDir = os.path.dirname(os.path.abspath(__file__))
+defaultBundle = os.path.join(baseDir, 'calibrations.bundle')
+
+def sourceName(path):
+    '''Name of a source file relative to the python directory (the .py of compiled modules)'''
+    if path.endswith('.pyc') or path.endswith('.pyo'): path = path[:-1]
+    return os.path.relpath(os.path.realpath(path), os.path.realpath(baseDir))
+
+def sourceInfo(name):
+    path = os.path.join(baseDir, name)
+    stat = os.stat(path)
+    with open(path, 'rb') as f:
+        sha1 = hashlib.sha1(f.read()).hexdigest()
+    return {'size': stat.st_size, 'mtime': stat.st_mtime, 'sha1': sha1}
+
+def encodeMeta(meta):
+    return np.frombuffer(json.dumps(meta), dtype=np.uint8)
+
+def decodeMeta(arr):
+    return json.loads(arr.tostring())
+
+class CalibrationBundle(object):
+    '''
+    A memory mapped calibration bundle.
+    '''
+    def __init__(self, fileName):
+        self.fileName = fileName
+        with open(fileName, 'rb') as f:
+            magic = f.read(len(MAGIC))
+            if magic!=MAGIC: raise ValueError('%s is not a calibration bundle' % fileName)
+            headerLength, = struct.unpack('<Q', f.read(8))
+            self.header = json.loads(f.read(headerLength))
+        self.dataStart = self.header['dataStart']
+        self.version = self.header['version']
+        self.data = None
+        self.freshSources = {}
+
+    def __contains__(self, name):
+        return name in self.header['tables']
+
+    def isFresh(self, name):
+        '''Check that the sources of a table are unchanged (size and mtime, or the hash if they differ)'''
+        for source in self.header['tables'][name]['sources']:
+            if source not in self.freshSources:
+                recorded = self.header['sources'][source]
+                path = os.path.join(baseDir, source)
+                if not os.path.isfile(path):
+                    fresh = False
+                else:
+                    stat = os.stat(path)
+                    fresh = stat.st_size==recorded['size'] and stat.st_mtime==recorded['mtime']
+                    if not fresh: fresh = sourceInfo(source)['sha1']==recorded['sha1']
+                self.freshSources[source] = fresh
+            if not self.freshSources[source]: return False
+        return True
+
+    def get(self, name):
+        '''The arrays (views of the mapped file) and metadata of a table'''
+        if self.data is None:
+            self.data = np.memmap(self.fileName, dtype=np.uint8, mode='r', offset=self.dataStart)
+        arrays = {}
+        for key, (offset, dtype, shape) in self.header['tables'][name]['arrays'].iteritems():
+            numBytes = int(np.prod(shape))*np.dtype(dtype).itemsize
+            arrays[key] = self.data[offset:offset+numBytes].view(dtype).reshape(shape)
+        meta = decodeMeta(arrays.pop('__meta__'))
+        return arrays, meta
+
+def writeBundle(fileName, tables):
+    '''
+    Write a bundle of tables, a dictionary name: (sources, arrays, meta).
+    '''
+    header = {'version': BUNDLE_VERSION, 'sources': {}, 'tables': {}}
+    blocks = []
+    offset = 0
+    for name in sorted(tables):
+        sources, arrays, meta = tables[name]
+        arrays = dict(arrays)
+        arrays['__meta__'] = encodeMeta(meta)
+        entry = {'sources': sources, 'arrays': {}}
+        for key in sorted(arrays):
+            arr = np.ascontiguousarray(arrays[key])
+            offset += -offset % ALIGNMENT
+            entry['arrays'][key] = (offset, arr.dtype.str, list(arr.shape))
+            blocks += [(offset, arr)]
+            offset += arr.nbytes
+        header['tables'][name] = entry
+        for source in sources:
+            if source not in header['sources']: header['sources'][source] = sourceInfo(source)
+    # the data starts aligned after the header, which contains the start
+    header['dataStart'] = 0
+    headerLength = len(json.dumps(header))
+    header['dataStart'] = len(MAGIC) + 8 + headerLength + 32
+    header['dataStart'] += -header['dataStart'] % ALIGNMENT
+    headerString = json.dumps(header)
+    tmpName = fileName + '.tmp'
+    with open(tmpName, 'wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack('<Q', len(headerString)))
+        f.write(headerString)
+        for blockOffset, arr in blocks:
+            f.seek(header['dataStart']+blockOffset)
+            f.write(arr.tostring())
+    os.rename(tmpName, fileName)
+
+bundleState = {'fileName': defaultBundle, 'bundle': None, 'enabled': True}
+loaded = {} # decoded tables
+built = {}  # name: (sources, arrays, meta) of the tables built from their sources
+
+def setBundle(fileName='', enabled=True):
+    '''Use another bundle file (or none)'''
+    bundleState['fileName'] = fileName or defaultBundle
+    bundleState['bundle'] = None
+    bundleState['enabled'] = enabled
+    loaded.clear()
+    built.clear()
+
+def getBundle():
+    '''The open bundle, None if there is no usable bundle'''
+    if not bundleState['enabled']: return None
+    if bundleState['bundle'] is None:
+        bundleState['bundle'] = False
+        fileName = bundleState['fileName']
+        if os.path.isfile(fileName):
+            try:
+                bundle = CalibrationBundle(fileName)
+            except (ValueError, IOError) as e:
+                logging.warning('Calibration bundle %s not readable (%s), reading the sources' % (fileName, e))
+            else:
+                if bundle.version==BUNDLE_VERSION:
+                    bundleState['bundle'] = bundle
+                else:
+                    logging.warning('Calibration bundle %s has version %s (expected %s), reading the sources' % (fileName, bundle.version, BUNDLE_VERSION))
+    return bundleState['bundle'] or None
+
+def load(name, sources, build, decode):
+    '''
+    A calibration table: build() compiles the sources into (arrays, meta) and decode(arrays, meta) returns the table.
+    The table is read from the bundle if it is there with unchanged sources, and is decoded once per process.
+    '''
+    if name in loaded: return loaded[name]
+    sources = [sourceName(s) for s in sources]
+    bundle = getBundle()
+    if bundle and name in bundle and bundle.header['tables'][name]['sources']==sources and bundle.isFresh(name):
+        arrays, meta = bundle.get(name)
+    else:
+        if bundle: logging.warning('Calibration %s is missing or out of date in %s, reading the sources (rerun buildCalibrations.py)' % (name, bundle.fileName))
+        arrays, meta = build()
+        built[name] = (sources, arrays, meta)
+    loaded[name] = decode(arrays, meta)
+    return loaded[name]
+
+def decodeJson(arrays, meta):
+    return meta
+
+def loadJson(name, sources, build):
+    '''A calibration stored as metadata only, build() returns the json-able object'''
+    return load(name, sources, lambda: ({}, build()), decodeJson)
@@ -0,0 +1,141 @@
+'''
+Chunked columnar access to FSA ntuples for ISA.
+
+The FSA final/Ntuple trees are read a chunk of entries at a time into numpy
+arrays, one array per branch. A ChunkRow stands in for the PyROOT tree inside
+the analyzer hooks, so getattr(rtrow, 'e1Pt') is served from the arrays instead
+of from the tree after a full GetEntry. Whole-chunk arrays are available through
+ChunkedTreeReader.column for cuts that can be evaluated vectorized, and their
+results are kept for the chunk with ChunkedTreeReader.derivedColumn (the lepton
+IDs of AnalyzerBase are evaluated this way).
+
+Author: Devin N. Taylor, UW-Madison
+'''
+import sys
+
+import numpy as np
+
+sys.argv.append('-b')
+import ROOT as rt
+sys.argv.pop()
+
+try:
+    from root_numpy import tree2array
+    hasRootNumpy = True
+except ImportError:
+    hasRootNumpy = False
+
+from branchActivation import enableBranch
+
+integerTypes = {
+    'Bool_t'    : np.int8,
+    'Char_t'    : np.int8,
+    'UChar_t'   : np.uint8,
+    'Short_t'   : np.int16,
+    'UShort_t'  : np.uint16,
+    'Int_t'     : np.int32,
+    'UInt_t'    : np.uint32,
+    'Long64_t'  : np.int64,
+    'ULong64_t' : np.uint64,
+}
+
+class ChunkRow(object):
+    '''
+    A single row of the current chunk. Attribute access mimics a PyROOT tree.
+    '''
+    __slots__ = ['_reader', '_columns', '_index']
+
+    def __init__(self, reader):
+        self._reader = reader
+        self._columns = reader.columns
+        self._index = 0
+
+    def __getattr__(self, name):
+        try:
+            return self._columns[name].item(self._index)
+        except KeyError:
+            return self._reader.value(name, self._index)
+
+    def getReader(self):
+        return self._reader
+
+    def getIndex(self):
+        return self._index
+
+class ChunkedTreeReader(object):
+    '''
+    Iterate over a tree in chunks of entries, reading branches into numpy arrays.
+
+    Branches listed in branches are read at the start of every chunk. Any other
+    branch is read for the whole chunk the first time it is accessed and is then
+    read eagerly for the remaining chunks (the list passed in is updated, so it
+    can be shared between files of the same final state).
+    '''
+    def __init__(self, tree, chunkSize=10000, branches=None):
+        self.tree = tree
+        self.chunkSize = chunkSize
+        self.branchNames = set([b.GetName() for b in tree.GetListOfBranches()])
+        self.branches = branches if branches is not None else []
+        self.columns = {}
+        self.derived = {}
+        self.start = 0
+        self.stop = 0
+
+    def __iter__(self):
+        row = ChunkRow(self)
+        numEntries = self.tree.GetEntries()
+        for start in xrange(0, numEntries, self.chunkSize):
+            self.load(start, min(start+self.chunkSize, numEntries))
+            for i in xrange(self.stop-self.start):
+                row._index = i
+                yield row
+
+    def __len__(self):
+        return self.stop-self.start
+
+    def load(self, start, stop):
+        '''Read the known branches for entries [start, stop).'''
+        self.start = start
+        self.stop = stop
+        self.columns.clear()
+        self.derived.clear()
+        names = [b for b in self.branches if b in self.branchNames]
+        if names: self.columns.update(self.read(names))
+
+    def read(self, names):
+        '''Return a dictionary of numpy arrays for the current chunk.'''
+        if hasRootNumpy:
+            arr = tree2array(self.tree, branches=names, start=self.start, stop=self.stop)
+            return dict([(name, arr[name]) for name in names])
+        # fall back to reading the individual branches
+        result = {}
+        for name in names:
+            leaf = self.tree.GetLeaf(name)
+            branch = leaf.GetBranch()
+            dtype = integerTypes.get(leaf.GetTypeName(), np.float64)
+            getter = leaf.GetValueLong64 if dtype in [np.int64, np.uint64] else leaf.GetValue
+            arr = np.empty(self.stop-self.start, dtype=dtype)
+            for i,entry in enumerate(xrange(self.start, self.stop)):
+                branch.GetEntry(entry)
+                arr[i] = getter()
+            result[name] = arr
+        return result
+
+    def column(self, name):
+        '''Get the array of a branch for the current chunk.'''
+        if name not in self.columns:
+            if name not in self.branchNames:
+                raise AttributeError('Branch {0} not in tree {1}'.format(name, self.tree.GetName()))
+            enableBranch(self.tree, name) # disabled if not recorded in activate mode
+            self.columns.update(self.read([name]))
+            self.branches.append(name)
+        return self.columns[name]
+
+    def derivedColumn(self, key, compute):
+        '''Get an array computed from the columns of the current chunk, compute() is called once per chunk and key.'''
+        if key not in self.derived: self.derived[key] = compute()
+        return self.derived[key]
+
+    def value(self, name, index):
+        '''Get a single value of a branch in the current chunk.'''
+        return self.column(name).item(index)
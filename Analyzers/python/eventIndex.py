@@ -0,0 +1,94 @@
+'''
+A compact index of event keys for ISA.
+
+Event keys (evt, lumi, run) are packed into two unsigned 64-bit words,
+evt and run<<32|lumi, and stored in sorted numpy arrays instead of a set of
+python tuples (about 16 bytes per event instead of ~150). New keys are
+buffered in a small set and flushed into sorted runs, runs of similar size are
+merged so a lookup only searches a few arrays. With a spill directory the
+large runs are written to disk and memory mapped, so the resident memory does
+not grow with the size of the sample.
+
+Author: Devin N. Taylor, UW-Madison
+'''
+import os
+import tempfile
+
+import numpy as np
+
+def packKeys(keys):
+    '''Pack a list of (evt, lumi, run) keys into two uint64 arrays'''
+    arr = np.array(keys, dtype=np.uint64).reshape(-1,3)
+    hi = arr[:,0].copy()
+    lo = (arr[:,2] << np.uint64(32)) | arr[:,1]
+    return hi, lo
+
+class EventKeyIndex(object):
+    '''
+    A set of event keys supporting add, update, in and len.
+    '''
+    def __init__(self, bufferSize=100000, spillDir='', spillSize=1000000):
+        self.bufferSize = bufferSize
+        self.spillDir = spillDir
+        self.spillSize = spillSize
+        self.pending = set()
+        self.runs = [] # (evt, run<<32|lumi, spill file)
+        self.numKeys = 0
+
+    def __len__(self):
+        return self.numKeys + len(self.pending)
+
+    def __contains__(self, key):
+        if key in self.pending: return True
+        if not self.runs: return False
+        hi = np.uint64(key[0])
+        lo = np.uint64((key[2] << 32) | key[1])
+        for runHi, runLo, runFile in self.runs:
+            start = runHi.searchsorted(hi, side='left')
+            stop = runHi.searchsorted(hi, side='right')
+            if start!=stop and lo in runLo[start:stop]: return True
+        return False
+
+    def add(self, key):
+        if key in self: return
+        self.pending.add(key)
+        if len(self.pending)>=self.bufferSize: self.flush()
+
+    def update(self, keys):
+        for key in keys:
+            self.add(key)
+
+    def flush(self):
+        '''Move the buffered keys into a sorted run'''
+        if not self.pending: return
+        hi, lo = packKeys(list(self.pending))
+        self.numKeys += len(self.pending)
+        self.pending = set()
+        order = np.lexsort((lo,hi))
+        self.runs += [(hi[order], lo[order], '')]
+        # merge runs of similar size
+        while len(self.runs)>1 and len(self.runs[-2][0])<=len(self.runs[-1][0]):
+            hi1, lo1, file1 = self.runs.pop()
+            hi0, lo0, file0 = self.runs.pop()
+            hi = np.concatenate((hi0,hi1))
+            lo = np.concatenate((lo0,lo1))
+            order = np.lexsort((lo,hi))
+            self.runs += [self.store(hi[order], lo[order])]
+            for fileName in [file0, file1]:
+                if fileName: os.remove(fileName)
+
+    def store(self, hi, lo):
+        '''Spill a large run to disk and memory map it'''
+        if not self.spillDir or len(hi)<self.spillSize: return (hi, lo, '')
+        if not os.path.isdir(self.spillDir): os.makedirs(self.spillDir)
+        fd, fileName = tempfile.mkstemp(suffix='.npy', prefix='eventIndex_', dir=self.spillDir)
+        os.close(fd)
+        np.save(fileName, np.vstack((hi,lo)))
+        arr = np.load(fileName, mmap_mode='r')
+        return (arr[0], arr[1], fileName)
+
+    def close(self):
+        '''Remove all spill files'''
+        for runHi, runLo, runFile in self.runs:
+            if runFile and os.path.isfile(runFile): os.remove(runFile)
+        self.runs = []
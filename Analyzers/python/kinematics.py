@@ -0,0 +1,117 @@
+'''
+Four-vector kinematics for ISA.
+
+Closed form replacements for the TLorentzVector operations used in the
+analyzers. A four-vector is a tuple (px, py, pz, e) built from (pt, eta, phi, m).
+The functions follow the TLorentzVector conventions (negative mass for
+spacelike vectors, eta of +-1e11 along the beam axis, phi of 0 for a null
+transverse momentum) and accept python floats or numpy arrays (evaluated
+element-wise).
+
+Author: Devin N. Taylor, UW-Madison
+'''
+import math
+
+import numpy as np
+
+def isArray(*vals):
+    for val in vals:
+        if isinstance(val, np.ndarray): return True
+    return False
+
+def p4(pt, eta, phi, m=0.):
+    '''Four-vector from pt, eta, phi, m (TLorentzVector::SetPtEtaPhiM)'''
+    if isArray(pt, eta, phi, m):
+        pt = np.abs(pt)
+        px = pt*np.cos(phi)
+        py = pt*np.sin(phi)
+        pz = pt*np.sinh(eta)
+        e = np.sqrt(px*px+py*py+pz*pz+m*m)
+    else:
+        pt = abs(pt)
+        px = pt*math.cos(phi)
+        py = pt*math.sin(phi)
+        pz = pt*math.sinh(eta)
+        e = math.sqrt(px*px+py*py+pz*pz+m*m)
+    return (px, py, pz, e)
+
+def add(*vecs):
+    '''Sum of four-vectors'''
+    px, py, pz, e = vecs[0]
+    for vec in vecs[1:]:
+        px = px + vec[0]
+        py = py + vec[1]
+        pz = pz + vec[2]
+        e = e + vec[3]
+    return (px, py, pz, e)
+
+def pt(vec):
+    px, py = vec[0], vec[1]
+    if isArray(px, py): return np.sqrt(px*px+py*py)
+    return math.sqrt(px*px+py*py)
+
+def mass(vec):
+    '''Invariant mass, negative for spacelike vectors'''
+    px, py, pz, e = vec
+    mm = e*e-(px*px+py*py+pz*pz)
+    if isArray(mm): return np.sign(mm)*np.sqrt(np.abs(mm))
+    return -math.sqrt(-mm) if mm<0. else math.sqrt(mm)
+
+def eta(vec):
+    '''Pseudorapidity, +-1e11 along the beam axis'''
+    px, py, pz, e = vec
+    if isArray(px, py, pz):
+        p = np.sqrt(px*px+py*py+pz*pz)
+        cosTheta = np.where(p==0., 1., pz/np.where(p==0., 1., p))
+        inside = cosTheta*cosTheta<1.
+        safe = np.where(inside, cosTheta, 0.)
+        val = -0.5*np.log((1.-safe)/(1.+safe))
+        edge = np.where(pz==0., 0., np.where(pz>0., 10e10, -10e10))
+        return np.where(inside, val, edge)
+    p = math.sqrt(px*px+py*py+pz*pz)
+    cosTheta = 1. if p==0. else pz/p
+    if cosTheta*cosTheta<1.: return -0.5*math.log((1.-cosTheta)/(1.+cosTheta))
+    if pz==0.: return 0.
+    return 10e10 if pz>0. else -10e10
+
+def phi(vec):
+    '''Azimuthal angle, 0 for a null transverse momentum'''
+    px, py = vec[0], vec[1]
+    if isArray(px, py): return np.where((px==0.) & (py==0.), 0., np.arctan2(py, px))
+    if px==0. and py==0.: return 0.
+    return math.atan2(py, px)
+
+def et(vec):
+    '''Transverse energy (TLorentzVector::Et)'''
+    px, py, pz, e = vec
+    pt2 = px*px+py*py
+    if isArray(pt2, pz, e):
+        et2 = np.where(pt2==0., 0., e*e*pt2/np.where(pt2==0., 1., pt2+pz*pz))
+        return np.where(e<0., -1., 1.)*np.sqrt(et2)
+    et2 = 0. if pt2==0. else e*e*pt2/(pt2+pz*pz)
+    return -math.sqrt(et2) if e<0. else math.sqrt(et2)
+
+def mt(cand, met):
+    '''Transverse mass of a candidate and the met'''
+    total = add(cand, met)
+    val = (et(cand)+et(met))**2 - pt(total)**2
+    if isArray(val): return np.sqrt(np.abs(val))
+    return math.sqrt(abs(val))
+
+def deltaPhi(phi0, phi1):
+    '''Difference in phi in (-pi, pi]'''
+    if isArray(phi0, phi1):
+        result = np.remainder(phi0-phi1+math.pi, 2*math.pi)-math.pi
+        return np.where(result<=-math.pi, result+2*math.pi, result)
+    result = phi0-phi1
+    while result>math.pi:
+        result -= 2*math.pi
+    while result<=-math.pi:
+        result += 2*math.pi
+    return result
+
+def deltaR(eta0, phi0, eta1, phi1):
+    deta = eta0-eta1
+    dphi = deltaPhi(phi0, phi1)
+    if isArray(deta, dphi): return np.sqrt(deta*deta+dphi*dphi)
+    return math.sqrt(deta**2+dphi**2)
@@ -6,196 +6,217 @@ Author: Devin N. Taylor, UW-Madison
 
 import sys
 
+import numpy as np
+
 sys.argv.append('b')
 import ROOT as rt
 sys.argv.pop()
 
 
+# met shifts changing the lepton IDs, the shifted ID flags have the suffix
+electronShifts = {
+    'ees+' : 'eesUp',
+    'ees-' : 'eesDown',
+}
+muonShifts = {
+    'mes+' : 'mesUp',
+    'mes-' : 'mesDown',
+}
+
+# IDs stored as flags in the ntuple: idType: (branch suffix, shifted)
+# cbid doesnt support met shift right now
+electronFlagIds = {
+    'Veto'            : ('CBIDVeto', False),
+    'Loose'           : ('CBIDLoose', False),
+    'Medium'          : ('CBIDMedium', False),
+    'Tight'           : ('CBIDTight', False),
+    'WWLoose'         : ('PassWZLoose', True),
+    'WWMedium'        : ('PassWZMedium', True),
+    'WWTight'         : ('PassWZTight', True),
+    'WZLooseTrigIso'  : ('PassWZLooseTrigIso', True),
+    'WZMediumTrigIso' : ('PassWZMediumTrigIso', True),
+    'WZTightTrigIso'  : ('PassWZTightTrigIso', True),
+    'WZLooseNoIso'    : ('PassWZLooseNoIso', True),
+    'WZMediumNoIso'   : ('PassWZMediumNoIso', True),
+    'WZTightNoIso'    : ('PassWZTightNoIso', True),
+    'VetoNoIso'       : ('CBIDVetoNoIso', False),
+    'LooseNoIso'      : ('CBIDLooseNoIso', False),
+    'MediumNoIso'     : ('CBIDMediumNoIso', False),
+    'TightNoIso'      : ('CBIDTightNoIso', False),
+}
+muonFlagIds = {
+    'WWLoose'         : ('PassWZLoose', True),
+    'WWMedium'        : ('PassWZMedium', True),
+    'WZLooseTrigIso'  : ('PassWZLooseTrigIso', True),
+    'WZTightTrigIso'  : ('PassWZTightTrigIso', True),
+    'WZMediumTrigIso' : ('PassWZMediumTrigIso', True),
+    'Loose'           : ('PFIDLoose', False),
+}
+# flags depending on the period
+electronPeriodFlagIds = {
+    13: {
+        'WZLoose'     : ('PassWZLoose', True),
+        'WZMedium'    : ('PassWZMedium', True),
+        'WZTight'     : ('PassWZTight', True),
+    },
+    8: {},
+}
+muonPeriodFlagIds = {
+    13: {
+        'WZTight'     : ('PassWZTight', True),
+        'WZMedium'    : ('PassWZMedium', True),
+    },
+    8: {
+        'Tight'       : ('PFIDTight', False),
+    },
+}
+tauFlags = ['DecayModeFinding', 'AgainstElectronMediumMVA5', 'AgainstMuonTight3'] # really should be old DM, but not available in PHYS14 right now, all miniAOD pass
+tauIsoFlags = {
+    'Loose'           : 'ByLooseCombinedIsolationDeltaBetaCorr3Hits',
+    'Medium'          : 'ByMediumCombinedIsolationDeltaBetaCorr3Hits',
+    'Tight'           : 'ByTightCombinedIsolationDeltaBetaCorr3Hits',
+}
+
+class MvaCut(object):
+    '''
+    A cut on an electron mva in bins of pt and |SCEta|: thresholds[i][j] for ptBins[i] and etaBins[j].
+    The bins are open intervals, a lepton on an edge or outside of the bins fails.
+    '''
+    def __init__(self, mva13, mva8, ptBins, etaBins, thresholds):
+        self.mva = {13: mva13, 8: mva8}
+        self.ptBins = ptBins
+        self.etaBins = etaBins
+        self.thresholds = thresholds
+
+    def names(self, l, period):
+        return '%sPt' % l, '%sSCEta' % l, '%s%s' % (l, self.mva[period])
+
+    def value(self, pt, eta, mva):
+        for (ptlo, pthi), thresholds in zip(self.ptBins, self.thresholds):
+            if not ptlo < pt < pthi: continue
+            for (etalo, etahi), threshold in zip(self.etaBins, thresholds):
+                if etalo < eta < etahi and mva > threshold: return True
+            return False
+        return False
+
+    def values(self, pt, eta, mva):
+        result = np.zeros(len(pt), dtype=bool)
+        for (ptlo, pthi), thresholds in zip(self.ptBins, self.thresholds):
+            inPt = (ptlo < pt) & (pt < pthi)
+            for (etalo, etahi), threshold in zip(self.etaBins, thresholds):
+                result |= inPt & (etalo < eta) & (eta < etahi) & (mva > threshold)
+        return result
+
+    def passes(self, rtrow, l, period):
+        ptName, etaName, mvaName = self.names(l, period)
+        return self.value(getattr(rtrow, ptName), abs(getattr(rtrow, etaName)), getattr(rtrow, mvaName))
+
+mvaEtaBins = [(float('-inf'), 0.8), (0.8, 1.479), (1.479, float('inf'))]
+mvaNonTrigZZ = MvaCut('MVANonTrigID', 'MVANonTrig', [(5.0, 10.0), (10.0, float('inf'))], mvaEtaBins, [[-0.265, -0.556, -0.551], [-0.072, -0.286, -0.267]])
+mvaNonTrig = MvaCut('MVANonTrigID', 'MVANonTrig', [(5.0, 10.0), (10.0, float('inf'))], mvaEtaBins, [[0.47, 0.004, 0.295], [-0.34, -0.65, 0.6]])
+mvaTrig = MvaCut('MVATrigID', 'MVATrig', [(10.0, 20.0), (20.0, float('inf'))], mvaEtaBins, [[0.00, 0.10, 0.62], [0.94, 0.85, 0.92]])
+
+class ColumnRow(object):
+    '''A row of a dictionary of arrays, for the IDs evaluated row by row'''
+    def __init__(self, column, index):
+        self._column = column
+        self._index = index
+
+    def __getattr__(self, name):
+        return self._column(name)[self._index]
+
+class IdPredicate(object):
+    '''
+    An ID of a lepton compiled for a period and met shift: the flags that must be set,
+    the mva cuts and the functions (old IDs) that must pass, in that order.
+    An ID without any requirement passes.
+    '''
+    def __init__(self, l, period, flags=[], mvaCuts=[], functions=[]):
+        self.l = l
+        self.period = period
+        self.flags = list(flags)
+        self.mvaCuts = [(cut, cut.names(l, period)) for cut in mvaCuts]
+        self.functions = list(functions)
+
+    def __call__(self, rtrow):
+        for name in self.flags:
+            if not getattr(rtrow, name): return False
+        for cut, (ptName, etaName, mvaName) in self.mvaCuts:
+            if not cut.value(getattr(rtrow, ptName), abs(getattr(rtrow, etaName)), getattr(rtrow, mvaName)): return False
+        for fun in self.functions:
+            if not fun(rtrow, self.l, self.period): return False
+        return True
+
+    def evaluate(self, column, numEntries):
+        '''Evaluate on arrays, column(name) returns the array of a branch (i.e. ChunkedTreeReader.column)'''
+        result = np.ones(numEntries, dtype=bool)
+        for name in self.flags:
+            result &= np.asarray(column(name)).astype(bool)
+        for cut, (ptName, etaName, mvaName) in self.mvaCuts:
+            result &= cut.values(np.asarray(column(ptName)), np.abs(column(etaName)), np.asarray(column(mvaName)))
+        for fun in self.functions:
+            for i in np.flatnonzero(result):
+                if not fun(ColumnRow(column, i), self.l, self.period): result[i] = False
+        return result
+
+def flagName(l, flag, shifted, shift, shifts):
+    if shifted and shift in shifts: return '%s%s_%s' % (l, flag, shifts[shift])
+    return '%s%s' % (l, flag)
+
+def compileId(l, period, idType, shift):
+    '''Compile the ID of a lepton'''
+    flags = []
+    mvaCuts = []
+    functions = []
+    if l[0]=='e':
+        if idType=='NonTrig': mvaCuts += [mvaNonTrig]
+        if idType=='Trig': mvaCuts += [mvaTrig]
+        for flagIds in [electronFlagIds, electronPeriodFlagIds.get(period,{})]:
+            if idType in flagIds: flags += [flagName(l, flagIds[idType][0], flagIds[idType][1], shift, electronShifts)]
+        # old 8 tev stuff
+        if period==8:
+            oldIds = {'ZZLoose': _elec_zz_loose, 'ZZTight': _elec_zz_tight, 'WZLoose': elec_WZ_loose, 'WZTight': elec_WZ_tight, '4l': elec_4l_id}
+            if idType in oldIds: functions += [oldIds[idType]]
+    elif l[0]=='m':
+        for flagIds in [muonFlagIds, muonPeriodFlagIds.get(period,{})]:
+            if idType in flagIds: flags += [flagName(l, flagIds[idType][0], flagIds[idType][1], shift, muonShifts)]
+        # old 8 tev stuff
+        if period==8:
+            oldIds = {'ZZLoose': _muon_zz_loose, 'ZZTight': _muon_zz_tight, 'WZLoose': muon_WZ_loose, 'WZTight': muon_WZ_tight, '4l': muon_4l_id}
+            if idType in oldIds: functions += [oldIds[idType]]
+    elif l[0]=='t':
+        flags += ['%s%s' % (l, flag) for flag in tauFlags]
+        if idType in tauIsoFlags: flags += ['%s%s' % (l, tauIsoFlags[idType])]
+    else:
+        raise ValueError('No ID for %s' % l)
+    return IdPredicate(l, period, flags=flags, mvaCuts=mvaCuts, functions=functions)
+
+idPredicates = {}
+
+def getIdPredicate(l, period, idType, shift=''):
+    '''The compiled ID of a lepton, compiled once per lepton, period, ID type and met shift'''
+    key = (l, period, idType, shift)
+    if key not in idPredicates: idPredicates[key] = compileId(l, period, idType, shift)
+    return idPredicates[key]
+
 def lep_id(rtrow, period, *lep, **kwargs):
     idType = kwargs.get('idType','')
     shift = kwargs.get('metShift','')
 
     if idType:
         for l in lep:
-            if l[0]=='e': lep_method = 'elec_id'
-            if l[0]=='m': lep_method = 'muon_id'
-            if l[0]=='t': lep_method = 'tau_id'
-            if not eval('%s(rtrow,l,period,idType,shift)'%lep_method): return False
-        
+            if not getIdPredicate(l, period, idType, shift)(rtrow): return False
+
     return True
 
 def elec_id(rtrow, l, period, idType, shift):
-    if idType=='NonTrig':
-        if not _elec_mva_nontriggering(rtrow, l, period): return False
-    if idType=='Trig':
-        if not _elec_mva_triggering(rtrow, l, period): return False
-    # cbid doesnt support met shift right now
-    if idType=='Veto':
-        if not getattr(rtrow, '%sCBIDVeto' % l): return False
-    if idType=='Loose':
-        if not getattr(rtrow, '%sCBIDLoose' % l): return False
-    if idType=='Medium':
-        if not getattr(rtrow, '%sCBIDMedium' % l): return False
-    if idType=='Tight':
-        if not getattr(rtrow, '%sCBIDTight' % l): return False
-    # check for ees+ or ees-
-    allowedShifts = {
-        'ees+' : 'eesUp',
-        'ees-' : 'eesDown',
-    }
-    if idType=='WWLoose':
-        if shift in allowedShifts:
-            if not getattr(rtrow, '%sPassWZLoose_%s' % (l,allowedShifts[shift])): return False
-        else:
-            if not getattr(rtrow, '%sPassWZLoose' % l): return False
-    if idType=='WWMedium':
-        if shift in allowedShifts:
-            if not getattr(rtrow, '%sPassWZMedium_%s' % (l,allowedShifts[shift])): return False
-        else:
-            if not getattr(rtrow, '%sPassWZMedium' % l): return False
-    if idType=='WWTight':
-        if shift in allowedShifts:
-            if not getattr(rtrow, '%sPassWZTight_%s' % (l,allowedShifts[shift])): return False
-        else:
-            if not getattr(rtrow, '%sPassWZTight' % l): return False
-    if idType=='WZLooseTrigIso':
-        if shift in allowedShifts:
-            if not getattr(rtrow, '%sPassWZLooseTrigIso_%s' % (l,allowedShifts[shift])): return False
-        else:
-            if not getattr(rtrow, '%sPassWZLooseTrigIso' % l): return False
-    if idType=='WZMediumTrigIso':
-        if shift in allowedShifts:
-            if not getattr(rtrow, '%sPassWZMediumTrigIso_%s' % (l,allowedShifts[shift])): return False
-        else:
-            if not getattr(rtrow, '%sPassWZMediumTrigIso' % l): return False
-    if idType=='WZTightTrigIso':
-        if shift in allowedShifts:
-            if not getattr(rtrow, '%sPassWZTightTrigIso_%s' % (l,allowedShifts[shift])): return False
-        else:
-            if not getattr(rtrow, '%sPassWZTightTrigIso' % l): return False
-    if idType=='WZLooseNoIso':
-        if shift in allowedShifts:
-            if not getattr(rtrow, '%sPassWZLooseNoIso_%s' % (l,allowedShifts[shift])): return False
-        else:
-            if not getattr(rtrow, '%sPassWZLooseNoIso' % l): return False
-    if idType=='WZMediumNoIso':
-        if shift in allowedShifts:
-            if not getattr(rtrow, '%sPassWZMediumNoIso_%s' % (l,allowedShifts[shift])): return False
-        else:
-            if not getattr(rtrow, '%sPassWZMediumNoIso' % l): return False
-    if idType=='WZTightNoIso':
-        if shift in allowedShifts:
-            if not getattr(rtrow, '%sPassWZTightNoIso_%s' % (l,allowedShifts[shift])): return False
-        else:
-            if not getattr(rtrow, '%sPassWZTightNoIso' % l): return False
-    if idType=='WZLoose' and period==13:
-        if shift in allowedShifts:
-            if not getattr(rtrow, '%sPassWZLoose_%s' % (l,allowedShifts[shift])): return False
-        else:
-            if not getattr(rtrow, '%sPassWZLoose' % l): return False
-    if idType=='WZMedium' and period==13:
-        if shift in allowedShifts:
-            if not getattr(rtrow, '%sPassWZMedium_%s' % (l,allowedShifts[shift])): return False
-        else:
-            if not getattr(rtrow, '%sPassWZMedium' % l): return False
-    if idType=='WZTight' and period==13:
-        if shift in allowedShifts:
-            if not getattr(rtrow, '%sPassWZTight_%s' % (l,allowedShifts[shift])): return False
-        else:
-            if not getattr(rtrow, '%sPassWZTight' % l): return False
-    # cbid doesnt support met shift right now
-    if idType=='VetoNoIso':
-        if not getattr(rtrow, '%sCBIDVetoNoIso' % l): return False
-    if idType=='LooseNoIso':
-        if not getattr(rtrow, '%sCBIDLooseNoIso' % l): return False
-    if idType=='MediumNoIso':
-        if not getattr(rtrow, '%sCBIDMediumNoIso' % l): return False
-    if idType=='TightNoIso':
-        if not getattr(rtrow, '%sCBIDTightNoIso' % l): return False
-    # old 8 tev stuff
-    if period==8:
-        if idType=='ZZLoose':
-            if not _elec_zz_loose(rtrow,l,period): return False
-        if idType=='ZZTight':
-            if not _elec_zz_tight(rtrow,l,period): return False
-        if idType=='WZLoose' and period==8:
-            if not elec_WZ_loose(rtrow,l,period): return False
-        if idType=='WZTight' and period==8:
-            if not elec_WZ_tight(rtrow,l,period): return False
-        if idType=='4l':
-            if not elec_4l_id(rtrow,l,period): return False
-    return True
+    return getIdPredicate(l, period, idType, shift)(rtrow)
 
 def muon_id(rtrow, l, period, idType, shift):
-    # check for metshift
-    allowedShifts = {
-        'mes+' : 'mesUp',
-        'mes-' : 'mesDown',
-    }
-    if idType=='WWLoose':
-        if shift in allowedShifts:
-            if not getattr(rtrow, '%sPassWZLoose_%s' % (l,allowedShifts[shift])): return False
-        else:
-            if not getattr(rtrow, '%sPassWZLoose' % l): return False
-    if idType=='WWMedium':
-        if shift in allowedShifts:
-            if not getattr(rtrow, '%sPassWZMedium_%s' % (l,allowedShifts[shift])): return False
-        else:
-            if not getattr(rtrow, '%sPassWZMedium' % l): return False
-    if idType=='WZTight' and period==13:
-        if shift in allowedShifts:
-            if not getattr(rtrow, '%sPassWZTight_%s' % (l,allowedShifts[shift])): return False
-        else:
-            if not getattr(rtrow,'%sPassWZTight'%l): return False
-    if idType=='WZMedium' and period==13:
-        if shift in allowedShifts:
-            if not getattr(rtrow, '%sPassWZMedium_%s' % (l,allowedShifts[shift])): return False
-        else:
-            if not getattr(rtrow,'%sPassWZMedium'%l): return False
-    if idType=='WZLooseTrigIso':
-        if shift in allowedShifts:
-            if not getattr(rtrow, '%sPassWZLooseTrigIso_%s' % (l,allowedShifts[shift])): return False
-        else:
-            if not getattr(rtrow,'%sPassWZLooseTrigIso'%l): return False
-    if idType=='WZTightTrigIso':
-        if shift in allowedShifts:
-            if not getattr(rtrow, '%sPassWZTightTrigIso_%s' % (l,allowedShifts[shift])): return False
-        else:
-            if not getattr(rtrow,'%sPassWZTightTrigIso'%l): return False
-    if idType=='WZMediumTrigIso':
-        if shift in allowedShifts:
-            if not getattr(rtrow, '%sPassWZMediumTrigIso_%s' % (l,allowedShifts[shift])): return False
-        else:
-            if not getattr(rtrow,'%sPassWZMediumTrigIso'%l): return False
-    if idType=='Loose':
-        if not getattr(rtrow,'%sPFIDLoose'%l): return False
-    # old 8 tev stuff
-    if period == 8:
-        if idType=='Tight':
-            if not getattr(rtrow,'%sPFIDTight'%l): return False
-        if idType=='ZZLoose':
-            if not _muon_zz_loose(rtrow,l,period): return False
-        if idType=='ZZTight':
-            if not _muon_zz_tight(rtrow,l,period): return False
-        if idType=='WZLoose':
-            if not muon_WZ_loose(rtrow,l,period): return False
-        if idType=='WZTight':
-            if not muon_WZ_tight(rtrow,l,period): return False
-        if idType=='4l':
-            if not muon_4l_id(rtrow,l,period): return False
-    return True
+    return getIdPredicate(l, period, idType, shift)(rtrow)
 
 def tau_id(rtrow, l, period, idType, shift):
-    if not getattr(rtrow, "%sDecayModeFinding" %l): return False  # really should be old DM, but not available in PHYS14 right now, all miniAOD pass
-    if not getattr(rtrow, "%sAgainstElectronMediumMVA5" % l): return False
-    if not getattr(rtrow, "%sAgainstMuonTight3" % l): return False
-    if idType=='Loose':
-        if not getattr(rtrow, "%sByLooseCombinedIsolationDeltaBetaCorr3Hits" %l): return False
-    if idType=='Medium':
-        if not getattr(rtrow, "%sByMediumCombinedIsolationDeltaBetaCorr3Hits" %l): return False
-    if idType=='Tight':
-        if not getattr(rtrow, "%sByTightCombinedIsolationDeltaBetaCorr3Hits" %l):return False
-    return True
+    return getIdPredicate(l, period, idType, shift)(rtrow)
 
 def _muon_zz_loose(rtrow, l, period):
     if getattr(rtrow, "%sPt" % l) < 5: return False
@@ -227,44 +248,13 @@ def _elec_zz_tight(rtrow, l, period):
     return _elec_mva_nontriggering_zz(rtrow,l,period)
 
 def _elec_mva_nontriggering_zz(rtrow, l, period):
-    pt = getattr(rtrow, "%sPt" % l)
-    eta = abs(getattr(rtrow, "%sSCEta" % l))
-    mva = getattr(rtrow, "%sMVANonTrigID" % l) if period == 13 else getattr(rtrow, "%sMVANonTrig" % l)
-
-    if 5.0 < pt < 10.0:
-        return (eta < 0.8 and mva > -0.265) or (0.8 < eta < 1.479 and mva > -0.556) or (1.479 < eta and mva > -0.551)
-    elif 10.0 < pt:
-        return (eta < 0.8 and mva > -0.072) or (0.8 < eta < 1.479 and mva > -0.286) or (1.479 < eta and mva > -0.267)
-    else:
-        return False
+    return mvaNonTrigZZ.passes(rtrow, l, period)
 
 def _elec_mva_nontriggering(rtrow, l, period):
-    pt = getattr(rtrow, "%sPt" % l)
-    eta = abs(getattr(rtrow, "%sSCEta" % l))
-    mva = getattr(rtrow, "%sMVANonTrigID" % l) if period == 13 else getattr(rtrow, "%sMVANonTrig" % l)
-
-    if 5.0 < pt < 10.0:
-        return (eta < 0.8 and mva > 0.47) or (0.8 < eta < 1.479 and mva > 0.004) or (1.479 < eta and mva > 0.295)
-
-    elif 10.0 < pt:
-        return (eta < 0.8 and mva > -0.34) or (0.8 < eta < 1.479 and mva > -0.65) or (1.479 < eta and mva > 0.6)
-
-    else:
-        return False
+    return mvaNonTrig.passes(rtrow, l, period)
 
 def _elec_mva_triggering(rtrow, l, period):
-    pt = getattr(rtrow, "%sPt" % l)
-    eta = abs(getattr(rtrow, "%sSCEta" % l))
-    mva = getattr(rtrow, "%sMVATrigID" % l) if period == 13 else getattr(rtrow, "%sMVATrig" % l)
-
-    if 10.0 < pt < 20.0:
-        return (eta < 0.8 and mva > 0.00) or (0.8 < eta < 1.479 and mva > 0.10) or (1.479 < eta and mva > 0.62)
-
-    elif 20.0 < pt:
-        return (eta < 0.8 and mva > 0.94) or (0.8 < eta < 1.479 and mva > 0.85) or (1.479 < eta and mva > 0.92)
-
-    else:
-        return False
+    return mvaTrig.passes(rtrow, l, period)
 
 ########################
 ### Old WZ 8 TeV IDs ###
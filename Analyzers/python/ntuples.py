@@ -1,28 +1,195 @@
 '''
 Utilities for building ntuples used in ISA.
 
+The C structs backing the ntuple branches are compiled once with ACLiC into
+libraries in a cache directory (ISA_STRUCT_CACHE, by default in
+$CMSSW_BASE/tmp), keyed by a hash of the definition and the ROOT version.
+Later processes and workers load the libraries instead of interpreting the
+definitions. With an empty structCacheDir the structs are declared with the
+interpreter as before.
+
 Author: Devin N. Taylor, UW-Madison
 '''
-from itertools import product
+from itertools import product, izip
+import os
+import re
+import fcntl
+import hashlib
+import tempfile
+import logging
+
+import numpy as np
 
 import ROOT as rt
 from array import array
 
+def defaultStructCacheDir():
+    if 'ISA_STRUCT_CACHE' in os.environ: return os.environ['ISA_STRUCT_CACHE']
+    if 'CMSSW_BASE' in os.environ: return os.path.join(os.environ['CMSSW_BASE'],'tmp','isaStructs')
+    return os.path.join(tempfile.gettempdir(),'isaStructs_{0}'.format(os.getuid()))
+
+structCacheDir = defaultStructCacheDir() # compiled struct libraries, '' to use the interpreter
+
+def loadStructLibrary(name, code):
+    '''
+    Load the compiled library of a struct from structCacheDir, compiling it first if it is not cached.
+    Workers load under a shared lock and compile under an exclusive one, so a library is never loaded while
+    another worker is writing it. Returns True if the struct is available.
+    '''
+    logger = logging.getLogger(__name__)
+    key = hashlib.md5('{0}\n{1}'.format(rt.gROOT.GetVersion(),code)).hexdigest()[:16]
+    base = os.path.join(structCacheDir,'{0}_{1}'.format(name,key))
+    header = base+'.h'
+    library = '{0}_h.{1}'.format(base,rt.gSystem.GetSoExt())
+    try:
+        if not os.path.isdir(structCacheDir): os.makedirs(structCacheDir)
+    except OSError:
+        pass # created by another worker
+    try:
+        with open(base+'.lock','w') as lock:
+            # a shared lock to load, the library (and its .pcm) may still be written by the worker compiling it
+            fcntl.flock(lock, fcntl.LOCK_SH)
+            if os.path.isfile(library) and rt.gSystem.Load(library)>=0: return hasattr(rt,name)
+            # the lock is released while converting it, another worker may have compiled in between
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if os.path.isfile(library) and rt.gSystem.Load(library)>=0: return hasattr(rt,name)
+            with open(header+'.tmp','w') as f:
+                f.write('#ifndef ISA_{0}_{1}\n#define ISA_{0}_{1}\n#include "Rtypes.h"\n{2};\n#endif\n'.format(name,key,code.strip().rstrip(';')))
+            os.rename(header+'.tmp',header)
+            if not rt.gSystem.CompileMacro(header,'kO'):
+                logger.warning('Failed to compile {0}, declaring it with the interpreter'.format(header))
+                return False
+        return hasattr(rt,name)
+    except (IOError, OSError) as e:
+        logger.warning('Struct cache {0} not usable ({1}), declaring {2} with the interpreter'.format(structCacheDir,e,name))
+        return False
+
+def declareStruct(name, code):
+    '''
+    Declare a struct to ROOT (once per process), from the struct cache if enabled.
+    '''
+    if hasattr(rt,name): return
+    if structCacheDir and loadStructLibrary(name,code): return
+    rt.gROOT.ProcessLine(code)
+
+# compression algorithms of TFile::SetCompressionSettings (lz4 needs ROOT 6.10)
+compressionAlgorithms = {'zlib': 1, 'lzma': 2, 'lz4': 4}
+
+# output writer presets: compression algorithm and level, basket size (bytes) and auto flush (entries if > 0, bytes if < 0)
+writerPresets = {
+    'default': {},
+    'read'   : {'compression': 'zlib', 'compressionLevel': 1, 'basketSize': 256000, 'autoFlush': -50000000},
+    'compact': {'compression': 'lzma', 'compressionLevel': 4, 'basketSize': 64000, 'autoFlush': -30000000},
+    'fast'   : {'compression': 'zlib', 'compressionLevel': 1},
+}
+
+def getWriterSettings(preset='default', **kwargs):
+    '''The writer settings of a preset, overridden by the settings given (None keeps the preset)'''
+    if preset not in writerPresets:
+        raise ValueError('Unknown writer preset {0}, allowed: {1}'.format(preset,', '.join(sorted(writerPresets))))
+    settings = dict(writerPresets[preset])
+    for key, val in kwargs.iteritems():
+        if key not in ['compression','compressionLevel','basketSize','autoFlush']:
+            raise ValueError('Unknown writer setting {0}'.format(key))
+        if val is not None: settings[key] = val
+    if settings.get('compression','zlib') not in compressionAlgorithms:
+        raise ValueError('Unknown compression {0}, allowed: {1}'.format(settings['compression'],', '.join(sorted(compressionAlgorithms))))
+    return settings
+
+def getCompressionSettings(settings):
+    '''The TFile compression settings (100*algorithm+level) of writer settings, None for the ROOT default'''
+    if 'compression' not in settings and 'compressionLevel' not in settings: return None
+    level = settings.get('compressionLevel',1)
+    if not level: return 0
+    return 100*compressionAlgorithms[settings.get('compression','zlib')]+level
+
+def setFileWriter(tfile, settings):
+    '''Set the compression of an output file, before its trees are built'''
+    compression = getCompressionSettings(settings)
+    if compression is not None: tfile.SetCompressionSettings(compression)
+
+def setTreeWriter(tree, settings):
+    '''Set the basket size and auto flush of an output tree'''
+    if settings.get('basketSize'): tree.SetBasketSize('*',settings['basketSize'])
+    if settings.get('autoFlush'): tree.SetAutoFlush(settings['autoFlush'])
+
 def buildCutTree(cutlabels,**kwargs):
+    packed = kwargs.pop('packed',False)
+    if packed: return buildPackedCutTree(cutlabels)
     eventLeafs = ['evt','run','lumi']
-    eventBranchLineToProcess = "struct eventBranch_t {ULong64_t evt; Int_t run; Int_t lumi;}"
     cutBranchLineToProcess = "struct cutBranch_t {" + " ".join(["Int_t {0};".format(x) for x in cutlabels]) + "}"
-    eventBranchStrForBranch = 'evt/l:run/I:lumi'
     cutBranchStrForBranch = '{0}/I:'.format(cutlabels[0]) + ':'.join(cutlabels[1:])
-    if not hasattr(rt,"eventBranch_t"): rt.gROOT.ProcessLine(eventBranchLineToProcess)
-    if not hasattr(rt,"cutBranch_t"): rt.gROOT.ProcessLine(cutBranchLineToProcess)
-    eventBranchStruct = rt.eventBranch_t()
+    declareStruct("cutBranch_t",cutBranchLineToProcess)
+    eventBranchStruct, eventBranchStrForBranch = getCutTreeEventStruct()
     cutBranchStruct = rt.cutBranch_t()
     tree = rt.TTree('cutTree','cutTree')
     tree.Branch('event',eventBranchStruct,eventBranchStrForBranch)
     tree.Branch('selections',cutBranchStruct,cutBranchStrForBranch)
     return (tree, eventBranchStruct, cutBranchStruct)
 
+def buildPackedCutTree(cutlabels):
+    '''
+    A cut tree storing the results of the cuts as the bits of a single mask (bit i for cutlabels[i]).
+    Each cut is an alias of the tree, so selections like 'trigger && looseID' work as for the unpacked tree.
+    '''
+    if len(cutlabels)>64: raise ValueError('At most 64 cuts can be packed, got {0}'.format(len(cutlabels)))
+    declareStruct("cutMask_t","struct cutMask_t {ULong64_t mask;}")
+    eventBranchStruct, eventBranchStrForBranch = getCutTreeEventStruct()
+    cutMaskStruct = rt.cutMask_t()
+    tree = rt.TTree('cutTree','cutTree')
+    tree.Branch('event',eventBranchStruct,eventBranchStrForBranch)
+    tree.Branch('selections',cutMaskStruct,'mask/l')
+    setCutAliases(tree,cutlabels)
+    return (tree, eventBranchStruct, cutMaskStruct)
+
+def setCutAliases(tree, cutlabels):
+    '''Alias each cut label of a packed cut tree to its bit'''
+    for i, label in enumerate(cutlabels):
+        tree.SetAlias(label,'((selections.mask>>{0})&1)'.format(i))
+
+def getCutLabels(tree):
+    '''The cut labels of a packed cut tree in bit order (from its aliases)'''
+    labels = {}
+    aliases = tree.GetListOfAliases()
+    if not aliases: return []
+    for alias in aliases:
+        match = re.match(r'\(\(selections\.mask>>(\d+)\)&1\)$', alias.GetTitle())
+        if match: labels[int(match.group(1))] = alias.GetName()
+    return [labels[i] for i in sorted(labels)]
+
+def decodeCutMask(mask, cutlabels):
+    '''The results (label: passed) of a packed cut mask'''
+    return dict([(label, bool((mask>>i)&1)) for i, label in enumerate(cutlabels)])
+
+def cutMaskSelection(cutlabels, *labels):
+    '''A selection string of a packed cut tree requiring the given cuts'''
+    mask = sum([1<<cutlabels.index(label) for label in labels])
+    return '(selections.mask&{0})=={0}'.format(mask)
+
+def getCutTreeEventStruct():
+    '''
+    The event struct of the cut tree, the address of the event branch is the struct.
+    '''
+    eventBranchLineToProcess = "struct eventBranch_t {ULong64_t evt; Int_t run; Int_t lumi;}"
+    eventBranchStrForBranch = 'evt/l:run/I:lumi'
+    declareStruct("eventBranch_t",eventBranchLineToProcess)
+    return rt.eventBranch_t(), eventBranchStrForBranch
+
+def getEventStruct():
+    '''
+    The event struct of the ISA ntuple, the address of the event branch is the struct (gen_weight is the first member).
+    '''
+    eventVars = {}
+    eventVars['I'] = ['run','lumi','nvtx','GenNUP']
+    eventVars['l'] = ['evt'] # ULong64
+    eventVars['F'] = ['gen_weight','charge_uncertainty','trig_prescale']
+    scaleVars = ['lep_scale','lep_scale_e','lep_scale_m','pu_weight','fakerate','trig_scale']
+    for v in scaleVars:
+        for t in ['','_up','_down']:
+            eventVars['F'] += ['{0}{1}'.format(v,t)]
+    eventName = 'structEvent_t'
+    return getStruct(eventName,eventVars)
+
 def getStruct(name,varDict):
     strToProcess = 'struct {0}'.format(name) + ' {'
     strForBranch = ''
@@ -37,10 +204,189 @@ def getStruct(name,varDict):
                 strForBranch += '{0}:'.format(var)
     strToProcess += '};'
     strForBranch = strForBranch[:-1]
-    if not hasattr(rt,name): rt.gROOT.ProcessLine(strToProcess)
+    declareStruct(name,strToProcess)
     struct = getattr(rt,name)()
     return struct, strForBranch
 
+class BranchSlots(dict):
+    '''
+    Row slots of the variables of a branch (with an optional index suffix, i.e. Pt -> Pt1).
+    Variables not in the branch are mapped to the discard slot.
+    '''
+    def __init__(self, slots, discard, suffix=''):
+        dict.__init__(self)
+        self.slots = slots
+        self.discard = discard
+        self.suffix = suffix
+
+    def __missing__(self, var):
+        slot = self.slots.get(var+self.suffix, self.discard)
+        self[var] = slot
+        return slot
+
+class SourceNames(dict):
+    '''
+    FSA branch names of an object (i.e. PVDXY -> e1PVDXY), formatted once per object.
+    '''
+    def __init__(self, prefix):
+        dict.__init__(self)
+        self.prefix = prefix
+
+    def __missing__(self, var):
+        name = self.prefix+var
+        self[var] = name
+        return name
+
+# numpy types of the ntuple leaves, character arrays (the channels) are stored as objects
+leafTypes = {
+    'Bool_t'    : np.bool_,
+    'Short_t'   : np.int16,
+    'UShort_t'  : np.uint16,
+    'Int_t'     : np.int32,
+    'UInt_t'    : np.uint32,
+    'Long64_t'  : np.int64,
+    'ULong64_t' : np.uint64,
+    'Float_t'   : np.float32,
+    'Double_t'  : np.float64,
+}
+
+class RowLayout(object):
+    '''
+    The layout of an ISA ntuple row compiled from the tree and structs of buildNtuple.
+    A row is a list of values, one per (struct, variable) slot, None for slots not filled.
+    The last slot is a discard slot for values not in the ntuple.
+    '''
+    def __init__(self, tree, branches):
+        self.setters = []
+        self.slots = {}
+        types = []
+        for branch in tree.GetListOfBranches():
+            name = branch.GetName()
+            self.slots[name] = {}
+            for leaf in branch.GetListOfLeaves():
+                self.slots[name][leaf.GetName()] = len(self.setters)
+                self.setters += [(branches[name], leaf.GetName())]
+                types += [leafTypes.get(leaf.GetTypeName(), 'O')]
+        self.discard = len(self.setters)
+        self.branchSlots = {}
+        # the record of a row in a RowBuffer
+        self.dtype = np.dtype([('s%i' % i, t) for i, t in enumerate(types)])
+
+    def branch(self, name, index=''):
+        '''Get the slots of a branch'''
+        key = (name, index)
+        if key not in self.branchSlots:
+            self.branchSlots[key] = BranchSlots(self.slots.get(name,{}), self.discard, str(index))
+        return self.branchSlots[key]
+
+    def newRow(self):
+        return [None] * (self.discard+1)
+
+    def write(self, row, filled=None):
+        '''Fill the structs from a row, the slots not filled (None, or false in filled) are not written'''
+        if filled is None:
+            for setter, val in izip(self.setters, row):
+                if val is not None: setattr(setter[0], setter[1], val)
+        else:
+            for setter, val, f in izip(self.setters, row, filled):
+                if f: setattr(setter[0], setter[1], val)
+
+class RowBuffer(object):
+    '''
+    The pending rows of an ISA ntuple, keyed by event, in a preallocated structured array with the
+    record of a RowLayout (a few bytes per value instead of a python object and a list entry).
+    The filled slots of each row are kept as a bitmask, unfilled slots are not written (as RowLayout.write).
+    Storing a row for a key already pending replaces it in place, the array doubles when full.
+    The rows are still built as lists by the analyzer (store_row), the buffer only saves the memory held
+    until the end of the file and decodes the rows a block at a time when writing.
+    '''
+    def __init__(self, layout, blockSize=1000):
+        self.layout = layout
+        self.blockSize = blockSize
+        self.numSlots = layout.discard
+        self.data = np.zeros(blockSize, dtype=layout.dtype)
+        self.filled = np.zeros((blockSize, (self.numSlots+7)//8), dtype=np.uint8)
+        self.index = {}
+        self.keys = []
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def __iter__(self):
+        return iter(self.keys)
+
+    def grow(self):
+        size = max(2*len(self.data), self.blockSize)
+        data = np.zeros(size, dtype=self.layout.dtype)
+        data[:len(self.data)] = self.data
+        filled = np.zeros((size, self.filled.shape[1]), dtype=np.uint8)
+        filled[:len(self.filled)] = self.filled
+        self.data = data
+        self.filled = filled
+
+    def store(self, key, row):
+        '''Store a row (a list of slot values) for an event key, replacing a pending row of the key'''
+        index = self.index.get(key)
+        if index is None:
+            index = len(self.keys)
+            if index==len(self.data): self.grow()
+            self.index[key] = index
+            self.keys += [key]
+        row = row[:self.numSlots]
+        mask = [val is not None for val in row]
+        self.data[index] = tuple([0 if val is None else val for val in row])
+        self.filled[index] = np.packbits(mask)
+
+    def __getitem__(self, key):
+        '''The row of an event key as a list of slot values (None for slots not filled, and the discard slot)'''
+        index = self.index[key]
+        mask = np.unpackbits(self.filled[index])[:self.numSlots]
+        row = [val if m else None for val, m in izip(self.data[index].tolist(), mask)]
+        return row + [None]
+
+    def blocks(self):
+        '''
+        The pending rows in blocks, in the order they were first stored, as (keys, rows, filled):
+        the slot values and filled flags of the rows (for RowLayout.write), decoded once per block.
+        '''
+        for start in xrange(0, len(self.keys), self.blockSize):
+            stop = min(start+self.blockSize, len(self.keys))
+            rows = self.data[start:stop].tolist()
+            filled = np.unpackbits(self.filled[start:stop], axis=1)[:,:self.numSlots].tolist()
+            yield self.keys[start:stop], rows, filled
+
+    def clear(self):
+        '''Drop the pending rows, the array is kept for the next file'''
+        self.index = {}
+        self.keys = []
+
+# optional groups of output fields
+outputGroups = {
+    'lepScale' : 'lepton ID scale factors (LepScale)',
+    'lepEff'   : 'lepton efficiencies (LepEff)',
+    'lepFake'  : 'lepton fake rates measured in data (LepFake)',
+    'lepFakeMC': 'lepton fake rates measured in MC (LepFakeMC)',
+    'gen'      : 'generator matching of the leptons (GenIsPrompt, GenPdgId, GenPatPdgId, MotherGenPdgId)',
+    'metUnc'   : 'met uncertainties (with doMetUnc)',
+}
+
+# output profiles: the groups of fields written (and computed), the MC weights are only computed for MC
+outputProfiles = {
+    'full'        : ['lepScale','lepEff','lepFake','lepFakeMC','gen','metUnc'],
+    'fakerate'    : ['lepScale','lepEff','lepFake','lepFakeMC','gen'],
+    'data-fakes'  : ['lepFake'],
+    'data-minimal': [],
+}
+
+def getOutputGroups(profile):
+    '''The groups of fields of an output profile'''
+    if profile not in outputProfiles:
+        raise ValueError('Unknown output profile {0}, allowed: {1}'.format(profile,', '.join(sorted(outputProfiles))))
+    return set(outputProfiles[profile])
+
 def buildNtuple(object_definitions,states,channelName,final_states,**kwargs):
     '''
     A function to build an initial state ntuple for AnalyzerBase.py
@@ -48,6 +394,8 @@ def buildNtuple(object_definitions,states,channelName,final_states,**kwargs):
     alternateIds = kwargs.pop('altIds',[])
     doVBF = kwargs.pop('doVBF',False)
     doMetUnc = kwargs.pop('doMetUnc',False)
+    groups = kwargs.pop('outputGroups',outputGroups.keys()) # the optional fields written
+    writer = kwargs.pop('writer',{}) # basket size and auto flush of the tree (see getWriterSettings)
 
     finalStateObjects = 'emtjgn'
     structureDict = {}
@@ -76,7 +424,7 @@ def buildNtuple(object_definitions,states,channelName,final_states,**kwargs):
     metVars += baseMetVars
     baseLepMetVars = ['mass','Pt','sT','dPhi']
     lepMetVars = []
-    if doMetUnc:
+    if doMetUnc and 'metUnc' in groups:
         for s in ['JetRes','JetEn','MuonEn','ElectronEn','TauEn','UnclusteredEn','PhotonEn']:
             for d in ['Up','Down']:
                 for m in baseMetVars:
@@ -87,12 +435,14 @@ def buildNtuple(object_definitions,states,channelName,final_states,**kwargs):
     lepFloats = ['Pt', 'Eta', 'Phi', 'Iso', 'Dxy', 'Dz', 'SigmaIEtaIEta', 'DEtaIn', 'DPhiIn', 'HOverE', 'OoEmOoP', 'TriggeringMVA', 'NonTriggeringMVA', 'NormalizedChi2', 'JetPt', 'JetBTag']
     for t in ['','_up','_down']:
         for l in ['Loose','Medium','Tight']:
-            lepFloats += ['LepScale{0}{1}'.format(l,t)]
+            if 'lepScale' in groups: lepFloats += ['LepScale{0}{1}'.format(l,t)]
             if l=='Loose': continue
-            lepFloats += ['LepEff{0}{1}'.format(l,t)]
-            lepFloats += ['LepFake{0}{1}'.format(l,t)]
-            lepFloats += ['LepFakeMC{0}{1}'.format(l,t)]
-    lepInts = ['Chg', 'PassLoose', 'PassMedium', 'PassTight', 'GenIsPrompt', 'GenPdgId', 'GenPatPdgId', 'MotherGenPdgId', 'ChargeConsistent', 'ExpectedMissingInnerHits', 'PassConversionVeto', 'IsGlobalMuon', 'IsPFMuon', 'IsTrackerMuon', 'ValidMuonHits', 'MatchedStations', 'ValidPixelHits', 'TrackerLayers']
+            if 'lepEff' in groups: lepFloats += ['LepEff{0}{1}'.format(l,t)]
+            if 'lepFake' in groups: lepFloats += ['LepFake{0}{1}'.format(l,t)]
+            if 'lepFakeMC' in groups: lepFloats += ['LepFakeMC{0}{1}'.format(l,t)]
+    lepInts = ['Chg', 'PassLoose', 'PassMedium', 'PassTight']
+    if 'gen' in groups: lepInts += ['GenIsPrompt', 'GenPdgId', 'GenPatPdgId', 'MotherGenPdgId']
+    lepInts += ['ChargeConsistent', 'ExpectedMissingInnerHits', 'PassConversionVeto', 'IsGlobalMuon', 'IsPFMuon', 'IsTrackerMuon', 'ValidMuonHits', 'MatchedStations', 'ValidPixelHits', 'TrackerLayers']
 
 
 
@@ -119,25 +469,15 @@ def buildNtuple(object_definitions,states,channelName,final_states,**kwargs):
     structOrder += ['select']    
 
     # define common root classes
-    eventVars = {}
-    eventVars['I'] = ['run','lumi','nvtx','GenNUP']
-    eventVars['l'] = ['evt'] # ULong64
-    eventVars['F'] = ['gen_weight','charge_uncertainty','trig_prescale']
-    scaleVars = ['lep_scale','lep_scale_e','lep_scale_m','pu_weight','fakerate','trig_scale']
-    for v in scaleVars:
-        for t in ['','_up','_down']:
-            eventVars['F'] += ['{0}{1}'.format(v,t)]
-    eventName = 'structEvent_t'
-    eventStruct, eventStrForBranch = getStruct(eventName,eventVars)
+    eventStruct, eventStrForBranch = getEventStruct()
     structOrder += ['event']
     structureDict['event'] = [eventStruct,eventStruct,eventStrForBranch]
 
     # add channels
-    if not hasattr(rt,'structChannel_t'):
-        rt.gROOT.ProcessLine(
+    declareStruct('structChannel_t',
         "struct structChannel_t {\
            Char_t  channel[9];\
-        };");
+        };")
     channelStruct = rt.structChannel_t()
     structureDict['channel'] = [channelStruct, rt.AddressOf(channelStruct,'channel'),'channel/C']
     structOrder += ['channel']
@@ -179,11 +519,10 @@ def buildNtuple(object_definitions,states,channelName,final_states,**kwargs):
     objVars['I'] = lepInts
     objName = 'structObject_t'
 
-    if not hasattr(rt,'structObjChar_t'):
-        rt.gROOT.ProcessLine(
+    declareStruct('structObjChar_t',
         "struct structObjChar_t {\
            Char_t  Flv[2];\
-        };");
+        };")
 
     lepCount = 0
     jetCount = 0
@@ -241,11 +580,10 @@ def buildNtuple(object_definitions,states,channelName,final_states,**kwargs):
             structureDict[key] = [initialStruct, initialStruct, initialStrForBranch]
             structOrder += [key]
 
-    if not hasattr(rt,'structInitialChar_t'):
-        rt.gROOT.ProcessLine(
+    declareStruct('structInitialChar_t',
         "struct structInitialChar_t {\
            Char_t  Flv[3];\
-        };");
+        };")
     for key in object_definitions:
         initialFlvStruct = rt.structInitialChar_t()
         structureDict['%sFlv' % key] = [initialFlvStruct,rt.AddressOf(initialFlvStruct,'Flv'),'Flv/C']
@@ -258,6 +596,7 @@ def buildNtuple(object_definitions,states,channelName,final_states,**kwargs):
         val = structureDict[key]
         tree.Branch(key,val[1],val[2])
         allBranches[key] = val[0]
+    setTreeWriter(tree,writer)
 
     return (tree, allBranches)
 
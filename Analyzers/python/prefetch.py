@@ -0,0 +1,136 @@
+'''
+Background prefetching of the ISA input files.
+
+The analyzer reads its input files one after the other over xrootd (or HDFS),
+so every file starts with the open and first basket latency of the remote store.
+A FilePrefetcher copies the next files into a local scratch directory in a
+background thread while the current one is analyzed. At most numAhead files
+past the current one are staged and staging waits while the staged files exceed
+maxSize bytes (a single file larger than the cap is still staged). A file that
+can not be staged is read from its original location.
+
+Files are copied with xrdcp for root:// names and as plain files otherwise, so a
+local directory can stand in for the remote store (see validatePrefetch.py). The
+size of a remote file is taken from xrdfs stat before it is copied; if it can
+not be found the file is counted against the cap only once it is staged.
+
+Author: Devin N. Taylor, UW-Madison
+'''
+import os
+import shutil
+import tempfile
+import threading
+import subprocess
+import logging
+
+def fileSize(fileName):
+    '''Size of an input file (from xrdfs stat if it is remote), 0 if it can not be found'''
+    if fileName.startswith('root://'): return remoteFileSize(fileName)
+    try:
+        return os.path.getsize(fileName)
+    except OSError:
+        return 0
+
+def remoteFileSize(fileName):
+    '''Size of a root:// file, 0 if xrdfs can not stat it'''
+    host, _, path = fileName[len('root://'):].partition('/')
+    try:
+        with open(os.devnull, 'w') as devnull:
+            output = subprocess.check_output(['xrdfs', host, 'stat', '/'+path.lstrip('/')], stderr=devnull)
+    except (OSError, subprocess.CalledProcessError):
+        return 0
+    for line in output.splitlines():
+        if line.startswith('Size:'): return int(line.split()[1])
+    return 0
+
+def copyFile(source, destination):
+    '''Copy an input file, with xrdcp if it is remote'''
+    if source.startswith('root://'):
+        status = subprocess.call(['xrdcp','-s','-f',source,destination])
+        if status: raise IOError('xrdcp %s failed with status %i' % (source, status))
+    else:
+        shutil.copyfile(source, destination)
+
+class FilePrefetcher(object):
+    '''
+    Stage a list of files ahead of the reader. Call get(i) for the local name of file i
+    and release(i) once it is read, in order.
+    '''
+    def __init__(self, fileNames, cacheDir, numAhead=2, maxSize=2000000000, copy=copyFile):
+        self.fileNames = list(fileNames)
+        if not os.path.isdir(cacheDir): os.makedirs(cacheDir)
+        self.stageDir = tempfile.mkdtemp(prefix='prefetch_', dir=cacheDir)
+        self.numAhead = numAhead
+        self.maxSize = maxSize
+        self.copy = copy
+        self.staged = {}      # index: local name (None if it could not be staged)
+        self.sizes = {}
+        self.stagedSize = 0
+        self.peakSize = 0
+        self.current = 0
+        self.stopped = False
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def canStage(self, index, size):
+        if index>self.current+self.numAhead: return False
+        return not self.stagedSize or self.stagedSize+size<=self.maxSize
+
+    def run(self):
+        logger = logging.getLogger(__name__)
+        for index, fileName in enumerate(self.fileNames):
+            size = fileSize(fileName)
+            with self.condition:
+                while not self.stopped and not self.canStage(index, size):
+                    self.condition.wait(1.)
+                if self.stopped: return
+            localName = os.path.join(self.stageDir, '%i_%s' % (index, os.path.basename(fileName)))
+            try:
+                self.copy(fileName, localName+'.tmp')
+                os.rename(localName+'.tmp', localName)
+                size = os.path.getsize(localName)
+            except (IOError, OSError) as e:
+                logger.warning('Could not prefetch %s (%s), reading it remotely' % (fileName, e))
+                if os.path.isfile(localName+'.tmp'): os.remove(localName+'.tmp')
+                localName = None
+                size = 0
+            with self.condition:
+                self.staged[index] = localName
+                self.sizes[index] = size
+                self.stagedSize += size
+                self.peakSize = max(self.peakSize, self.stagedSize)
+                self.condition.notify_all()
+
+    def get(self, index):
+        '''The local name of file index (its original name if it could not be staged), waits until it is staged'''
+        with self.condition:
+            self.current = index
+            self.condition.notify_all()
+            while index not in self.staged and self.thread.is_alive():
+                self.condition.wait(1.)
+            return self.staged.get(index) or self.fileNames[index]
+
+    def release(self, index):
+        '''Remove the local copy of a file that was read'''
+        with self.condition:
+            localName = self.staged.pop(index, None)
+            if localName and os.path.isfile(localName): os.remove(localName)
+            self.stagedSize -= self.sizes.pop(index, 0)
+            self.current = index+1
+            self.condition.notify_all()
+
+    def close(self):
+        '''Stop staging and remove the staged files'''
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+        self.thread.join()
+        shutil.rmtree(self.stageDir, ignore_errors=True)
@@ -0,0 +1,131 @@
+'''
+Profiling of the ISA analyzers.
+
+A Profiler accumulates the wall time and the number of calls of named stages:
+the preselection, selection and cut tree cuts, the analyzer hooks (choose_objects,
+ID, getScales, store_row, write_row) and the input/output (opening the files,
+reading the rows, filling the trees). The times are inclusive, a cut calling ID
+is counted in both. The events and bytes read and the time spent on each input
+file are recorded as well, and the report is written as JSON next to the output
+ntuple (<output>_profile.json). The reports of the parts of a sample are summed
+into the report of the merged output by mergeReportFiles.
+
+Author: Devin N. Taylor, UW-Madison
+'''
+import os
+import json
+import time
+
+def profileName(outName):
+    '''The report of an output ntuple'''
+    return '%s_profile.json' % os.path.splitext(outName)[0]
+
+def finishReport(report):
+    '''Fill the rates and fractions of a report from its totals'''
+    total = report['seconds']
+    for stage in report['stages'].itervalues():
+        stage['fraction'] = stage['seconds']/total if total else 0.
+        stage['us/call'] = stage['seconds']/stage['calls']*1e6 if stage['calls'] else 0.
+    report['events/s'] = report['events']/total if total else 0.
+    report['MB/s'] = report['MB']/total if total else 0.
+    return report
+
+def mergeReports(reports):
+    '''Sum the reports of the parts of a sample (the seconds are summed over the parts, not wall time)'''
+    merged = {'seconds': 0., 'events': 0, 'MB': 0., 'stages': {}, 'files': [], 'parts': len(reports)}
+    for report in reports:
+        for key in ['seconds','events','MB']:
+            merged[key] += report[key]
+        for name, stage in report['stages'].iteritems():
+            mergedStage = merged['stages'].setdefault(name, {'calls': 0, 'seconds': 0.})
+            mergedStage['calls'] += stage['calls']
+            mergedStage['seconds'] += stage['seconds']
+        merged['files'] += report['files']
+    return finishReport(merged)
+
+def mergeReportFiles(fileNames, outName):
+    '''Write the sum of the reports in fileNames to outName'''
+    reports = []
+    for fileName in fileNames:
+        with open(fileName, 'r') as f:
+            reports += [json.load(f)]
+    with open(outName, 'w') as f:
+        json.dump(mergeReports(reports), f, indent=2, sort_keys=True)
+
+class Profiler(object):
+    '''
+    Wall time and call counts of named stages, and the throughput of each input file.
+    '''
+    def __init__(self):
+        self.stages = {} # name: [calls, seconds]
+        self.files = []
+        self.start = time.time()
+
+    def add(self, name, seconds, calls=1):
+        stage = self.stages.setdefault(name, [0, 0.])
+        stage[0] += calls
+        stage[1] += seconds
+
+    def call(self, name, fun, *args, **kwargs):
+        '''Call fun, timing it as stage name'''
+        start = time.time()
+        try:
+            return fun(*args, **kwargs)
+        finally:
+            self.add(name, time.time()-start)
+
+    def timed(self, name, fun):
+        '''A function timing each call of fun as stage name'''
+        def timedFun(*args, **kwargs):
+            return self.call(name, fun, *args, **kwargs)
+        return timedFun
+
+    def iterate(self, name, iterable):
+        '''Iterate, timing the retrieval of each item as stage name'''
+        iterator = iter(iterable)
+        while True:
+            start = time.time()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.add(name, time.time()-start, calls=0)
+                return
+            self.add(name, time.time()-start)
+            yield item
+
+    def addFile(self, fileName, events, bytesRead, seconds):
+        '''Record the throughput of an input file'''
+        self.files += [{
+            'file'      : fileName,
+            'events'    : events,
+            'MB'        : bytesRead/1e6,
+            'seconds'   : seconds,
+            'events/s'  : events/seconds if seconds else 0.,
+            'MB/s'      : bytesRead/1e6/seconds if seconds else 0.,
+        }]
+
+    def report(self):
+        '''The run report as a dictionary'''
+        stages = {}
+        for name, (calls, seconds) in self.stages.iteritems():
+            stages[name] = {'calls': calls, 'seconds': seconds}
+        return finishReport({
+            'seconds' : time.time()-self.start,
+            'events'  : sum([f['events'] for f in self.files]),
+            'MB'      : sum([f['MB'] for f in self.files]),
+            'stages'  : stages,
+            'files'   : self.files,
+        })
+
+    def write(self, fileName):
+        with open(fileName, 'w') as f:
+            json.dump(self.report(), f, indent=2, sort_keys=True)
+
+    def summary(self, numStages=10):
+        '''Lines of the stages taking the most time'''
+        report = self.report()
+        lines = ['%.1f s, %i events (%.1f events/s), %.1f MB (%.2f MB/s)' % (report['seconds'], report['events'], report['events/s'], report['MB'], report['MB/s'])]
+        stages = sorted(report['stages'].iteritems(), key=lambda x: x[1]['seconds'], reverse=True)
+        for name, stage in stages[:numStages]:
+            lines += ['%-40s %10i calls %9.2f s %5.1f%% %9.1f us/call' % (name, stage['calls'], stage['seconds'], stage['fraction']*100, stage['us/call'])]
+        return lines
@@ -4,32 +4,36 @@ import json
 
 from math import floor
 
+import numpy as np
+
 sys.argv.append('-b')
 import ROOT as rt
 sys.argv.pop()
 
+try:
+    from ..calibrations import load
+except ValueError: # an analyzer run as a script (condor jobs), the python directory is the top level
+    from calibrations import load
 
 class PileupWeights(object):
 
     def __init__(self):
-        path = os.path.join(os.path.dirname(__file__), 'pu_weights.json')
-        with open(path, 'r') as pu_file:
-            self.pu_weights = json.load(pu_file)
-        path = os.path.join(os.path.dirname(__file__), 'pileup_RunIISpring2015_Run2015D_13TeV.root')
-        self.scale_13tev = {}
-        self.scale_13tev_up = {}
-        self.scale_13tev_down = {}
-        rootfile = rt.TFile(path)
-        hist_scale = rootfile.Get('pileup_scale')
-        for b in range(hist_scale.GetNbinsX()):
-            self.scale_13tev[b] = hist_scale.GetBinContent(b+1)
-        hist_scale = rootfile.Get('pileup_scale_up')
-        for b in range(hist_scale.GetNbinsX()):
-            self.scale_13tev_up[b] = hist_scale.GetBinContent(b+1)
-        hist_scale = rootfile.Get('pileup_scale_down')
-        for b in range(hist_scale.GetNbinsX()):
-            self.scale_13tev_down[b] = hist_scale.GetBinContent(b+1)
-        rootfile.Close()
+        # read through the calibration bundle (see calibrations.py)
+        jsonPath = os.path.join(os.path.dirname(__file__), 'pu_weights.json')
+        rootPath = os.path.join(os.path.dirname(__file__), 'pileup_RunIISpring2015_Run2015D_13TeV.root')
+        def build():
+            with open(jsonPath, 'r') as pu_file:
+                pu_weights = json.load(pu_file)
+            arrays = {}
+            rootfile = rt.TFile(rootPath)
+            for name in ['pileup_scale','pileup_scale_up','pileup_scale_down']:
+                hist_scale = rootfile.Get(name)
+                arrays[name] = np.array([hist_scale.GetBinContent(b+1) for b in range(hist_scale.GetNbinsX())], dtype=np.float64)
+            rootfile.Close()
+            return arrays, pu_weights
+        def decode(arrays, pu_weights):
+            return pu_weights, arrays['pileup_scale'].tolist(), arrays['pileup_scale_up'].tolist(), arrays['pileup_scale_down'].tolist()
+        self.pu_weights, self.scale_13tev, self.scale_13tev_up, self.scale_13tev_down = load('pu_weights', [jsonPath, rootPath, __file__], build, decode)
 
 
     def weight(self, rtrow, **kwargs):
@@ -4,16 +4,68 @@ import glob
 import pickle
 import json
 import csv
+import math
 from operator import itemgetter, attrgetter
 
+import numpy as np
+
 sys.argv.append('-b')
 import ROOT as rt
 sys.argv.pop()
 
+import binned
+from binned import BinnedLookup, BinnedMap, compileTables, tablesToArrays, tablesFromArrays
+try:
+    from ..calibrations import load, loadJson
+except ValueError: # an analyzer run as a script (condor jobs), the python directory is the top level
+    from calibrations import load, loadJson
+
+# the tables are read through the calibration bundle (see calibrations.py),
+# their sources are the data files and the modules compiling them
+def sourcePath(fileName):
+    return os.path.join(os.path.dirname(__file__),fileName)
+
+def sources(fileName):
+    return [sourcePath(fileName), __file__, binned.__file__]
+
+def loadTables(fileName, xlo, xhi, ylo, yhi, parse=json.load):
+    '''The bin lists of a file (JSON by default) compiled into a dictionary of BinnedLookups'''
+    def build():
+        with open(sourcePath(fileName),'r') as f:
+            return tablesToArrays(compileTables(parse(f),xlo,xhi,ylo,yhi))
+    return load(fileName, sources(fileName), build, tablesFromArrays)
+
+def loadLookup(fileName, xlo, xhi, ylo, yhi, parse):
+    '''The bin list of a file compiled into a BinnedLookup'''
+    def build():
+        with open(sourcePath(fileName),'r') as f:
+            return BinnedLookup(parse(f),xlo,xhi,ylo,yhi).toArrays()
+    return load(fileName, sources(fileName), build, BinnedLookup.fromArrays)
+
+def loadHist(fileName, histName):
+    '''A histogram of a ROOT file extracted into a BinnedMap'''
+    def build():
+        rootfile = rt.TFile.Open(sourcePath(fileName),'READ')
+        hist = BinnedMap.fromHist(rootfile.Get(histName))
+        rootfile.Close()
+        return hist.toArrays()
+    return load('%s:%s' % (fileName,histName), sources(fileName), build, BinnedMap.fromArrays)
+
+def readHists(fileName, *histNames):
+    '''The histograms histNames of a ROOT file as BinnedMaps'''
+    return [loadHist(fileName,histName) for histName in histNames]
+
+def loadFile(fileName, parse=json.load):
+    '''A file parsed (JSON by default) into python objects, kept as JSON in the bundle'''
+    def build():
+        with open(sourcePath(fileName),'r') as f:
+            return parse(f)
+    return loadJson(fileName, [sourcePath(fileName), __file__], build)
+
 class ChargeIdSystematics(object):
 
     def __init__(self):
-        self.missid = {
+        missid = {
             'EB': {
                 10 : 0.00350,
                 20 : 0.00331,
@@ -31,8 +83,14 @@ class ChargeIdSystematics(object):
                 100: 0.06232,
             }
         }
-
-
+        # (pt, abseta) map, the last pt bin open ended, no missid below 10 GeV
+        ptEdges = sorted(missid['EB'].keys()) + [float('inf')]
+        etaEdges = [0., 1.479, float('inf')]
+        contents = [0.]*(len(ptEdges)+1)
+        for eta_reg in ['EB','EE']:
+            contents += [0.] + [missid[eta_reg][pt_reg] for pt_reg in ptEdges[:-1]] + [0.]
+        contents += [0.]*(len(ptEdges)+1)
+        self.missid = BinnedMap(ptEdges, etaEdges, contents, [0.]*len(contents))
 
     def systematic(self, rtrow, *leps, **kwargs):
         val = 1.
@@ -40,32 +98,36 @@ class ChargeIdSystematics(object):
             if l[0]=='e':
                 pt = getattr(rtrow,'%sPt' %l)
                 eta = getattr(rtrow,'%sEta' %l)
-                pt_reg = [x for x in [10,20,30,40,60,100,200] if pt>=x][0]
-                eta_reg = 'EB' if abs(eta)<1.479 else 'EE'
-                val *= (1.-self.missid[eta_reg][pt_reg])
+                missid, err = self.missid.value(pt,abs(eta))
+                val *= (1.-missid)
         return 1+(1-val)
                 
 
 class TriggerScaleFactors(object):
 
     def __init__(self):
-        self.ww_scales = self.init_ww_scales()
+        self.ww_scales = loadTables('WW_140416_TriggerEfficiencies.txt',0,1,2,3,parse=self.init_ww_scales)
         # WZ 13 TeV
-        with open(os.path.join(os.path.dirname(__file__),'muons_13TeV.json'),'r') as ef:
-            self.muons_13TeV = json.load(ef)
-        with open(os.path.join(os.path.dirname(__file__),'electrons_13TeV.json'),'r') as ef:
-            self.electrons_13TeV = json.load(ef)
-        with open(os.path.join(os.path.dirname(__file__),'electronTrigger_13TeV.json'),'r') as ef:
-            self.electronTrigger_13TeV = json.load(ef)
-        with open(os.path.join(os.path.dirname(__file__),'trackerMuonDZ_13TeV.json'),'r') as ef:
-            self.trackerMuonDZ_13TeV = json.load(ef)
-        with open(os.path.join(os.path.dirname(__file__),'globalMuonDZ_13TeV.json'),'r') as ef:
-            self.globalMuonDZ_13TeV = json.load(ef)
+        # (tables compiled into BinnedLookups, see get_eff_err)
+        self.muons_13TeV = loadTables('muons_13TeV.json','pt_lo','pt_hi','abseta_lo','abseta_hi')
+        self.electrons_13TeV = loadTables('electrons_13TeV.json','pt_lo','pt_hi','abseta_lo','abseta_hi')
+        self.electronTrigger_13TeV = loadTables('electronTrigger_13TeV.json','pt_lo','pt_hi','abseta_lo','abseta_hi')
+        self.trackerMuonDZ_13TeV = loadTables('trackerMuonDZ_13TeV.json','pt_lo','pt_hi','abseta_lo','abseta_hi')
+        self.globalMuonDZ_13TeV = loadTables('globalMuonDZ_13TeV.json','pt_lo','pt_hi','abseta_lo','abseta_hi')
         # HWW 13 TeV
-        with open(os.path.join(os.path.dirname(__file__),'HLT_Ele23_WPLoose.txt'),'r') as ef:
-            self.hww_singleEle23 = self.init_hww_scales_e(ef)
-        with open(os.path.join(os.path.dirname(__file__),'SingleMu_IsoTkMu20_Run2015D_25ns_PTvsETA_HWW.txt'),'r') as ef:
-            self.hww_singleMu20 = self.init_hww_scales_m(ef)
+        self.hww_singleEle23 = loadLookup('HLT_Ele23_WPLoose.txt','pt_lo','pt_hi','eta_lo','eta_hi',self.init_hww_scales_e)
+        self.hww_singleMu20 = loadLookup('SingleMu_IsoTkMu20_Run2015D_25ns_PTvsETA_HWW.txt','pt_lo','pt_hi','eta_lo','eta_hi',self.init_hww_scales_m)
+        # tables (and averaged tables) of the 13 TeV trigger legs
+        self.legs_13 = {
+            ('single','e'): [(self.hww_singleEle23,'')],
+            ('lead','e')  : [(self.electronTrigger_13TeV,'passingHLTEle17Ele12Leg1')],
+            ('trail','e') : [(self.electronTrigger_13TeV,'passingHLTEle17Ele12Leg2')],
+            ('dz','e')    : [(self.electronTrigger_13TeV,'passingHLTDZFilter')],
+            ('single','m'): [(self.hww_singleMu20,'')],
+            ('lead','m')  : [(self.muons_13TeV,'passingMu17')],
+            ('trail','m') : [(self.muons_13TeV,'passingMu8'),(self.muons_13TeV,'passingTkMu8')],
+            ('dz','m')    : [(self.globalMuonDZ_13TeV,'passingDZ'),(self.trackerMuonDZ_13TeV,'passingDZ')],
+        }
 
     def init_hww_scales_e(self,ef):
         result = []
@@ -95,18 +157,32 @@ class TriggerScaleFactors(object):
             result += [element]
         return result
 
-    def init_ww_scales(self):
+    def init_ww_scales(self,file):
         scales = {}
-        with open(os.path.join(os.path.dirname(__file__),'WW_140416_TriggerEfficiencies.txt'),'r') as file:
-            for line in file.readlines()[1:]:
-                line.rstrip()
-                leg, etalow, etahigh, ptlow, pthigh, eff, errdown, errup = line.split()
-                if leg not in scales:
-                    scales[leg] = []
-                scales[leg].append([float(etalow),float(etahigh),float(ptlow),float(pthigh),float(eff),float(errdown),float(errup)])
+        for line in file.readlines()[1:]:
+            line.rstrip()
+            leg, etalow, etahigh, ptlow, pthigh, eff, errdown, errup = line.split()
+            if leg not in scales:
+                scales[leg] = []
+            scales[leg].append([float(etalow),float(etahigh),float(ptlow),float(pthigh),float(eff),float(errdown),float(errup)])
         return scales
 
     def scale_factor(self, rtrow, *lep_list, **kwargs):
+        '''Trigger efficiency for data (useData) or mc, shifted with shiftUp or shiftDown'''
+        shiftUp = kwargs.pop('shiftUp',False)
+        shiftDown = kwargs.pop('shiftDown',False)
+        useData = kwargs.pop('useData',True)
+        data, mc = self.scale_factors(rtrow, *lep_list, **kwargs)
+        effs = data if useData else mc
+        if shiftUp: return effs[1]
+        if shiftDown: return effs[2]
+        return effs[0]
+
+    def scale_factors(self, rtrow, *lep_list, **kwargs):
+        '''
+        Trigger efficiencies for data and mc with their uncertainty shifts, each leg is evaluated once.
+        Returns [data, data up, data down], [mc, mc up, mc down].
+        '''
         shift = kwargs.get('metShift','')
         def getObjPt(l):
             ptString = '{0}Pt'.format(l)
@@ -121,94 +197,65 @@ class TriggerScaleFactors(object):
         lep_objs = [(x, getObjPt(x), getObjEta(x)) for x in lep_list]
         lep_ord = sorted(lep_objs, key=itemgetter(1), reverse=True)
         period = kwargs.pop('period',8)
+        numLeps = len(lep_ord)
         if period==8:
-            if len(lep_ord)==3:
-                eff = 1-(\
-                        (1-self.double_lead_eff(*lep_ord[0])) * (1-self.double_lead_eff(*lep_ord[1])) * (1-self.double_lead_eff(*lep_ord[2]))\
-                        + self.double_lead_eff(*lep_ord[0]) * (1-self.double_trail_eff(*lep_ord[1])) * (1-self.double_trail_eff(*lep_ord[2]))\
-                        + self.double_lead_eff(*lep_ord[1]) * (1-self.double_trail_eff(*lep_ord[2])) * (1-self.double_trail_eff(*lep_ord[0]))\
-                        + self.double_lead_eff(*lep_ord[2]) * (1-self.double_trail_eff(*lep_ord[0])) * (1-self.double_trail_eff(*lep_ord[1]))\
-                        )
-            elif len(lep_ord) == 4:
-                eff = 1 - (\
-                        (1 - self.double_lead_eff(*lep_ord[0])) * \
-                        (1 - self.double_lead_eff(*lep_ord[1])) * \
-                        (1 - self.double_lead_eff(*lep_ord[2])) * \
-                        (1 - self.double_lead_eff(*lep_ord[3])) \
-
-                      + self.double_lead_eff(*lep_ord[0]) * \
-                        (1 - self.double_trail_eff(*lep_ord[1])) * \
-                        (1 - self.double_trail_eff(*lep_ord[2])) * \
-                        (1 - self.double_trail_eff(*lep_ord[3])) \
-
-                      + self.double_lead_eff(*lep_ord[1]) * \
-                        (1 - self.double_trail_eff(*lep_ord[2])) * \
-                        (1 - self.double_trail_eff(*lep_ord[3])) * \
-                        (1 - self.double_trail_eff(*lep_ord[0])) \
-
-                      + self.double_lead_eff(*lep_ord[2]) * \
-                        (1 - self.double_trail_eff(*lep_ord[3])) * \
-                        (1 - self.double_trail_eff(*lep_ord[0])) * \
-                        (1 - self.double_trail_eff(*lep_ord[1])) \
-
-                      + self.double_lead_eff(*lep_ord[3]) * \
-                        (1 - self.double_trail_eff(*lep_ord[0])) * \
-                        (1 - self.double_trail_eff(*lep_ord[1])) * \
-                        (1 - self.double_trail_eff(*lep_ord[2])) \
-                        )
-            elif len(lep_ord)==2:
-                eff = 1-(\
-                        (1-self.double_lead_eff(*lep_ord[0])) * (1-self.double_lead_eff(*lep_ord[1]))\
-                        + self.double_lead_eff(*lep_ord[0]) * (1-self.double_trail_eff(*lep_ord[1]))\
-                        + self.double_lead_eff(*lep_ord[1]) * (1-self.double_trail_eff(*lep_ord[0]))\
-                        )
-                #eff = self.double_lead_eff(*lep_ord[0]) * self.double_trail_eff(*lep_ord[1])
-            else:
-                eff = 1
-        else:
-            if len(lep_ord)==3:
-                # single * double efficiency
-                eff = 1-(\
-                        # none pass single
-                        ((1-self.single_eff_13(*lep_ord[0],**kwargs)) * (1-self.single_eff_13(*lep_ord[1],**kwargs)) * (1-self.single_eff_13(*lep_ord[2],**kwargs)))\
-                        # none pass lead
-                        *((1-self.double_lead_eff_13(*lep_ord[0],**kwargs)) * (1-self.double_lead_eff_13(*lep_ord[1],**kwargs)) * (1-self.double_lead_eff_13(*lep_ord[2],**kwargs))\
-                        # one pass lead but none pass trail
-                        + self.double_lead_eff_13(*lep_ord[0],**kwargs) * (1-self.double_trail_eff_13(*lep_ord[1],**kwargs)) * (1-self.double_trail_eff_13(*lep_ord[2],**kwargs))\
-                        + self.double_lead_eff_13(*lep_ord[1],**kwargs) * (1-self.double_trail_eff_13(*lep_ord[2],**kwargs)) * (1-self.double_trail_eff_13(*lep_ord[0],**kwargs))\
-                        + self.double_lead_eff_13(*lep_ord[2],**kwargs) * (1-self.double_trail_eff_13(*lep_ord[0],**kwargs)) * (1-self.double_trail_eff_13(*lep_ord[1],**kwargs))\
-                        # one pass lead, one pass trail, one fail trail, fail dz
-                        + self.double_lead_eff_13(*lep_ord[0],**kwargs) * self.double_trail_eff_13(*lep_ord[1],**kwargs) * (1-self.double_trail_eff_13(*lep_ord[2])) * (1-self.double_dz_eff_13(lep_ord[0][0],*lep_ord[1],**kwargs))\
-                        + self.double_lead_eff_13(*lep_ord[0],**kwargs) * self.double_trail_eff_13(*lep_ord[2],**kwargs) * (1-self.double_trail_eff_13(*lep_ord[1])) * (1-self.double_dz_eff_13(lep_ord[0][0],*lep_ord[2],**kwargs))\
-                        + self.double_lead_eff_13(*lep_ord[1],**kwargs) * self.double_trail_eff_13(*lep_ord[2],**kwargs) * (1-self.double_trail_eff_13(*lep_ord[0])) * (1-self.double_dz_eff_13(lep_ord[1][0],*lep_ord[2],**kwargs))\
-                        + self.double_lead_eff_13(*lep_ord[1],**kwargs) * self.double_trail_eff_13(*lep_ord[0],**kwargs) * (1-self.double_trail_eff_13(*lep_ord[2])) * (1-self.double_dz_eff_13(lep_ord[1][0],*lep_ord[0],**kwargs))\
-                        + self.double_lead_eff_13(*lep_ord[2],**kwargs) * self.double_trail_eff_13(*lep_ord[0],**kwargs) * (1-self.double_trail_eff_13(*lep_ord[1])) * (1-self.double_dz_eff_13(lep_ord[2][0],*lep_ord[0],**kwargs))\
-                        + self.double_lead_eff_13(*lep_ord[2],**kwargs) * self.double_trail_eff_13(*lep_ord[1],**kwargs) * (1-self.double_trail_eff_13(*lep_ord[0])) * (1-self.double_dz_eff_13(lep_ord[2][0],*lep_ord[1],**kwargs))\
-                        # one pass lead, two pass trail, both fail dz
-                        + self.double_lead_eff_13(*lep_ord[0],**kwargs) * self.double_trail_eff_13(*lep_ord[1],**kwargs) * self.double_trail_eff_13(*lep_ord[2])\
-                          * (1-self.double_dz_eff_13(lep_ord[0][0],*lep_ord[1],**kwargs)) * (1-self.double_dz_eff_13(lep_ord[0][0],*lep_ord[2],**kwargs))\
-                        + self.double_lead_eff_13(*lep_ord[1],**kwargs) * self.double_trail_eff_13(*lep_ord[2],**kwargs) * self.double_trail_eff_13(*lep_ord[0])\
-                          * (1-self.double_dz_eff_13(lep_ord[1][0],*lep_ord[2],**kwargs)) * (1-self.double_dz_eff_13(lep_ord[1][0],*lep_ord[0],**kwargs))\
-                        + self.double_lead_eff_13(*lep_ord[2],**kwargs) * self.double_trail_eff_13(*lep_ord[0],**kwargs) * self.double_trail_eff_13(*lep_ord[1])\
-                          * (1-self.double_dz_eff_13(lep_ord[2][0],*lep_ord[0],**kwargs)) * (1-self.double_dz_eff_13(lep_ord[2][0],*lep_ord[1],**kwargs)))\
-                        )
-                #eff = 1. # override, i dont have single lepton efficiencies
-            elif len(lep_ord)==2: # for or of double lepton triggers
-                eff = 1-(\
-                        # none pass lead
-                        (1-self.double_lead_eff_13(*lep_ord[0],**kwargs)) * (1-self.double_lead_eff_13(*lep_ord[1],**kwargs))\
-                        # one pass lead but none pass trail
-                        + self.double_lead_eff_13(*lep_ord[0],**kwargs) * (1-self.double_trail_eff_13(*lep_ord[1],**kwargs))\
-                        + self.double_lead_eff_13(*lep_ord[1],**kwargs) * (1-self.double_trail_eff_13(*lep_ord[0],**kwargs))\
-                        # one pass lead, one pass trail, fail dz
-                        + self.double_lead_eff_13(*lep_ord[0],**kwargs) * self.double_trail_eff_13(*lep_ord[1],**kwargs) * (1-self.double_dz_eff_13(lep_ord[0][0],*lep_ord[1],**kwargs))\
-                        + self.double_lead_eff_13(*lep_ord[1],**kwargs) * self.double_trail_eff_13(*lep_ord[0],**kwargs) * (1-self.double_dz_eff_13(lep_ord[1][0],*lep_ord[0],**kwargs))\
-                        )
-            elif len(lep_ord)==1: # just get the trail leg one
-                eff = self.double_trail_eff_13(*lep_ord[0],**kwargs) if lep_ord[0][0]=='e' or lep_ord[0][1]<20 else self.double_lead_eff_13(*lep_ord[0],**kwargs)
-            else:
-                eff = 1.
-        return eff
+            if numLeps not in [2,3,4]: return [1,1,1], [1,1,1]
+            lead = [self.double_lead_eff(*x) for x in lep_ord]
+            trail = [self.double_trail_eff(*x) for x in lep_ord]
+            noDZ = [[1.]*numLeps for x in lep_ord]
+            eff = self.combine([0.]*numLeps, lead, trail, noDZ)
+            return [eff]*3, [eff]*3
+        if numLeps not in [1,2,3]: return [1.]*3, [1.]*3
+        legs = [dict([(leg, self.leg_eff_13(leg,*x)) for leg in ['single','lead','trail','dz']]) for x in lep_ord]
+        effs = []
+        for v in range(6):
+            if numLeps==1: # just get the trail leg one
+                l, pt, eta = lep_ord[0]
+                effs += [legs[0]['trail'][v] if l[0]=='e' or pt<20 else legs[0]['lead'][v]]
+                continue
+            # single lepton efficiency only for 3 leptons
+            single = [x['single'][v] for x in legs] if numLeps==3 else [0.]*numLeps
+            lead = [x['lead'][v] for x in legs]
+            trail = [x['trail'][v] for x in legs]
+            dz = [[legs[j]['dz'][v] if lep_ord[i][0][0]==lep_ord[j][0][0] else 1. for j in range(numLeps)] for i in range(numLeps)]
+            effs += [self.combine(single, lead, trail, dz)]
+        return effs[:3], effs[3:]
+
+    def combine(self, single, lead, trail, dz):
+        '''
+        Efficiency of the OR of the single lepton trigger and the double lepton trigger
+        (a lead and a trail leg with a dz filter, dz[i][j] for lead i and trail j) for any number of leptons:
+            1 - prod(1-single) * [prod(1-lead) + sum_i lead_i * prod_{j!=i} (1-trail_j*dz_ij)]
+        none pass lead, or one passes lead and every other fails trail or passes trail but fails dz.
+        '''
+        noSingle = 1.
+        for s in single: noSingle *= 1-s
+        noDouble = 1.
+        for l in lead: noDouble *= 1-l
+        for i in range(len(lead)):
+            term = lead[i]
+            for j in range(len(lead)):
+                if j!=i: term *= 1-trail[j]*dz[i][j]
+            noDouble += term
+        return 1-noSingle*noDouble
+
+    def shifted(self, effs):
+        '''[nominal, up, down] for a (val,err) or the average of two'''
+        if len(effs)==1:
+            val, err = effs[0]
+            return [val, val+err, val-err]
+        (valMu,errMu), (valTkMu,errTkMu) = effs
+        return [(valMu+valTkMu)/2., (valMu+errMu+valTkMu+errTkMu)/2., (valMu-errMu+valTkMu-errTkMu)/2.]
+
+    def leg_eff_13(self,leg,l,pt,eta):
+        '''[data, data up, data down, mc, mc up, mc down] efficiency of a trigger leg'''
+        if (leg,l[0]) not in self.legs_13: return [1.]*6
+        tables = self.legs_13[(leg,l[0])]
+        if leg=='single': # data only
+            return self.shifted([self.get_eff_err_mod(pt,eta,t) for t,k in tables])*2
+        data = self.shifted([self.get_eff_err(pt,eta,t,k,useData=True) for t,k in tables])
+        mc = self.shifted([self.get_eff_err(pt,eta,t,k,useData=False) for t,k in tables])
+        return data+mc
 
     def single_eff_13(self,l,pt,eta,**kwargs):
         if l[0]=='e': return self.single_e_13(pt,eta,**kwargs)
@@ -305,31 +352,33 @@ class TriggerScaleFactors(object):
         return val
 
     def get_eff_err(self,pt,eta,effDict,effKey,**kwargs):
+        '''First bin of effDict[effKey] (pt,abseta) containing the lepton, (1,0) if none'''
         useData = kwargs.pop('useData',True)
-        efflist = effDict[effKey]
-        for eff in efflist:
-            ptlow = eff['pt_lo']
-            pthi = eff['pt_hi']
-            etalow = eff['abseta_lo']
-            etahi = eff['abseta_hi']
-            if pt>=ptlow and pt<pthi and abs(eta)>=etalow and abs(eta)<etahi:
-                val = eff['data'] if useData else eff['mc']
-                err = eff['data_err'] if useData else eff['mc_err']
-                return val, err
-        return 1.0, 0.0
+        eff = effDict[effKey].find(pt,abs(eta))
+        if eff is None: return 1.0, 0.0
+        val = eff['data'] if useData else eff['mc']
+        err = eff['data_err'] if useData else eff['mc_err']
+        return val, err
+
+    def get_eff_err_array(self,pts,etas,effDict,effKey,**kwargs):
+        '''Vectorized get_eff_err for arrays of pt and eta'''
+        useData = kwargs.pop('useData',True)
+        lookup = effDict[effKey]
+        val = lookup.values(pts,np.abs(etas),'data' if useData else 'mc',1.0)
+        err = lookup.values(pts,np.abs(etas),'data_err' if useData else 'mc_err',0.0)
+        return val, err
 
     def get_eff_err_mod(self,pt,eta,efflist,**kwargs):
+        '''First bin of efflist (pt,eta) containing the lepton, (1,0) if none'''
         useData = kwargs.pop('useData',True)
-        for eff in efflist:
-            ptlow = eff['pt_lo']
-            pthi = eff['pt_hi']
-            etalow = eff['eta_lo']
-            etahi = eff['eta_hi']
-            if pt>=ptlow and pt<pthi and eta>=etalow and eta<etahi:
-                val = eff['data']
-                err = eff['data_err']
-                return val, err
-        return 1.0, 0.0
+        eff = efflist.find(pt,eta)
+        if eff is None: return 1.0, 0.0
+        return eff['data'], eff['data_err']
+
+    def get_eff_err_mod_array(self,pts,etas,efflist,**kwargs):
+        '''Vectorized get_eff_err_mod for arrays of pt and eta'''
+        useData = kwargs.pop('useData',True)
+        return efflist.values(pts,etas,'data',1.0), efflist.values(pts,etas,'data_err',0.0)
 
 
     # 8TeV stuff
@@ -349,10 +398,12 @@ class TriggerScaleFactors(object):
         return 1.
 
     def get_eff(self,leg,pt,eta):
-        for etalow, etahigh, ptlow, pthigh, eff, errdown, errup in self.ww_scales[leg]:
-            if eta>=etalow and eta<etahigh and pt>=ptlow and pt<pthigh:
-                return eff
-        return 1.
+        scale = self.ww_scales[leg].find(eta,pt)
+        return 1. if scale is None else scale[4]
+
+    def get_eff_array(self,leg,pts,etas):
+        '''Vectorized get_eff for arrays of pt and eta'''
+        return self.ww_scales[leg].values(etas,pts,4,1.)
 
     def single_e(self,pt,eta):
         return self.get_eff('SingleEl',pt,eta)
@@ -438,26 +489,15 @@ class LeptonEfficiency(object):
 
     def __init__(self):
         # WZ 13TeV
-        with open(os.path.join(os.path.dirname(__file__),'muons_13TeV.json'),'r') as mf:
-            self.m_id_dict_13tev = json.load(mf)
-        with open(os.path.join(os.path.dirname(__file__),'electrons_13TeV.json'),'r') as ef:
-            self.e_id_dict_13tev = json.load(ef)
+        self.m_id_dict_13tev = loadTables('muons_13TeV.json','pt_lo','pt_hi','abseta_lo','abseta_hi')
+        self.e_id_dict_13tev = loadTables('electrons_13TeV.json','pt_lo','pt_hi','abseta_lo','abseta_hi')
         # MIT efficiencies
-        efilename = os.path.join(os.path.dirname(__file__),'SingleElectron_efficiencies_electronTnP.root')
-        self.eEffTfile = rt.TFile.Open(efilename,'READ')
-        self.eEffHist_loose = self.eEffTfile.Get('eff_Loose_ele')
-        self.eEffHist_medium = self.eEffTfile.Get('eff_Medium_ele')
-        self.eEffHist_tight = self.eEffTfile.Get('eff_Tight_ele')
-        mfilename = os.path.join(os.path.dirname(__file__),'SingleMuon_efficiencies_muonTnP.root')
-        self.mEffTfile = rt.TFile.Open(mfilename,'READ')
-        self.mEffHist_loose = self.mEffTfile.Get('eff_Loose_mu')
-        self.mEffHist_medium = self.mEffTfile.Get('eff_Medium_mu')
-        self.mEffHist_tight = self.mEffTfile.Get('eff_Medium_mu')
-
+        # (histograms extracted into BinnedMaps, see readHists)
+        self.eEffHist_loose, self.eEffHist_medium, self.eEffHist_tight = readHists('SingleElectron_efficiencies_electronTnP.root','eff_Loose_ele','eff_Medium_ele','eff_Tight_ele')
+        self.mEffHist_loose, self.mEffHist_medium, self.mEffHist_tight = readHists('SingleMuon_efficiencies_muonTnP.root','eff_Loose_mu','eff_Medium_mu','eff_Medium_mu')
 
     def close(self):
-        self.eEffTfile.Close()
-        self.mEffTfile.Close()
+        return
 
     def scale_factor(self, row, *lep_list, **kwargs):
         period = kwargs.pop('period',13)
@@ -540,9 +580,13 @@ class LeptonEfficiency(object):
     def get_eff_err_new(self,pt,eta,hist,**kwargs):
         if eta>2.4: eta = 2.39 # TODO: stupid hack for electrons!!!
         if pt<10: pt = 10.1
-        val = hist.GetBinContent(hist.FindBin(eta,pt))
-        err = hist.GetBinError(hist.FindBin(eta,pt))
-        return val,err
+        return hist.value(eta,pt)
+
+    def get_eff_err_new_array(self,pts,etas,hist,**kwargs):
+        '''Vectorized get_eff_err_new for arrays of pt and abs(eta)'''
+        etas = np.where(np.asarray(etas)>2.4, 2.39, etas)
+        pts = np.where(np.asarray(pts)<10, 10.1, pts)
+        return hist.values(etas,pts)
 
     def get_eff_err(self,pt,eta,effDict,effKey,**kwargs):
         useData = kwargs.pop('useData',True)
@@ -566,35 +610,19 @@ class LeptonFakeRate(object):
         #with open(os.path.join(os.path.dirname(__file__),'fakes.json'),'r') as f:
         #with open(os.path.join(os.path.dirname(__file__),'fakes_trigIso_dijet_13TeV.json'),'r') as f:
         #with open(os.path.join(os.path.dirname(__file__),'fakes_trigIso_13TeV.json'),'r') as f:
-        with open(os.path.join(os.path.dirname(__file__),'fakes_veryTight_dijet_13TeV.json'),'r') as f:
-            self.fake_dict_13tev = json.load(f)
+        self.fake_dict_13tev = loadFile('fakes_veryTight_dijet_13TeV.json')
         # WZ 8TeV
-        with open(os.path.join(os.path.dirname(__file__),'fakes_8TeV.json'),'r') as f:
-            self.fake_dict_8tev = json.load(f)
+        self.fake_dict_8tev = loadFile('fakes_8TeV.json')
         # spain fake rates
-        efilename = os.path.join(os.path.dirname(__file__),'EGFR_RunII_25ns_jet35_08Jan.root')
-        self.efrTfile = rt.TFile.Open(efilename,'READ')
-        self.eFakeHist = self.efrTfile.Get('FR_pT_eta_EWKcorr')
-        mfilename = os.path.join(os.path.dirname(__file__),'MuFR_RunII_25ns_jet20_08Jan.root')
-        self.mfrTfile = rt.TFile.Open(mfilename,'READ')
-        self.mFakeHist = self.mfrTfile.Get('FR_pT_eta_EWKcorr')
+        # (histograms extracted into BinnedMaps, see readHists)
+        self.eFakeHist, = readHists('EGFR_RunII_25ns_jet35_08Jan.root','FR_pT_eta_EWKcorr')
+        self.mFakeHist, = readHists('MuFR_RunII_25ns_jet20_08Jan.root','FR_pT_eta_EWKcorr')
         # my fakerates
-        filename = os.path.join(os.path.dirname(__file__),'fakes_dijet_13TeV.root')
-        self.fakeTfile = rt.TFile.Open(filename,'READ')
-        self.eTightFakeHist = self.fakeTfile.Get('FakeRateProbeElecTight')
-        self.eMediumFakeHist = self.fakeTfile.Get('FakeRateProbeElecMedium')
-        self.mMediumFakeHist = self.fakeTfile.Get('FakeRateProbeMuonMedium')
-        filename = os.path.join(os.path.dirname(__file__),'fakes_dijet_13TeV_fromMC.root')
-        self.fakeTfile_mc = rt.TFile.Open(filename,'READ')
-        self.eTightFakeHist_mc = self.fakeTfile_mc.Get('FakeRateProbeElecTight')
-        self.eMediumFakeHist_mc = self.fakeTfile_mc.Get('FakeRateProbeElecMedium')
-        self.mMediumFakeHist_mc = self.fakeTfile_mc.Get('FakeRateProbeMuonMedium')
+        self.eTightFakeHist, self.eMediumFakeHist, self.mMediumFakeHist = readHists('fakes_dijet_13TeV.root','FakeRateProbeElecTight','FakeRateProbeElecMedium','FakeRateProbeMuonMedium')
+        self.eTightFakeHist_mc, self.eMediumFakeHist_mc, self.mMediumFakeHist_mc = readHists('fakes_dijet_13TeV_fromMC.root','FakeRateProbeElecTight','FakeRateProbeElecMedium','FakeRateProbeMuonMedium')
 
     def close(self):
-        self.efrTfile.Close()
-        self.mfrTfile.Close()
-        self.fakeTfile.Close()
-        self.fakeTfile_mc.Close()
+        return
 
     def scale_factor(self, row, *lep_list, **kwargs):
         period = kwargs.pop('period',13)
@@ -634,8 +662,7 @@ class LeptonFakeRate(object):
                 hist = self.eMediumFakeHist_mc if mc else self.eMediumFakeHist
             if numer=='Tight':
                 hist = self.eTightFakeHist_mc if mc else self.eTightFakeHist
-        fake = hist.GetBinContent(hist.FindBin(pt,eta))
-        err = hist.GetBinError(hist.FindBin(pt,eta))
+        fake, err = hist.value(pt,eta)
         return fake,err
         #fakelist = self.fake_dict_13tev[fakename] if period == 13 else self.fake_dict_8tev[fakename]
         #for fakedict in fakelist:
@@ -680,45 +707,25 @@ class LeptonScaleFactors(object):
 
     def __init__(self):
         # WZ 8TeV
-        with open(os.path.join(os.path.dirname(__file__),'MuonEfficiencies_Run2012ReReco_53X.pkl'),'r') as mf:
-            self.m_id_dict = pickle.load(mf)
-        
-        with open(os.path.join(os.path.dirname(__file__),'MuonEfficiencies_ISO_Run_2012ReReco_53X.pkl'),'r') as mf:
-            self.m_iso_dict = pickle.load(mf)
+        self.m_id_dict = loadFile('MuonEfficiencies_Run2012ReReco_53X.pkl',parse=pickle.load)
+        self.m_iso_dict = loadFile('MuonEfficiencies_ISO_Run_2012ReReco_53X.pkl',parse=pickle.load)
 
-        path = os.path.join(os.path.dirname(__file__), 'MuonScaleFactors_2011_2012.root')
-        self.m_rtfile = rt.TFile(path, 'READ')
-        self.m_hist = self.m_rtfile.Get("TH2D_ALL_2012")
+        # (histograms extracted into BinnedMaps, see readHists)
+        self.m_hist, = readHists('MuonScaleFactors_2011_2012.root',"TH2D_ALL_2012")
 
         # WZ 13TeV
-        with open(os.path.join(os.path.dirname(__file__),'muons_13TeV.json'),'r') as mf:
-            self.m_id_dict_13tev = json.load(mf)
-        with open(os.path.join(os.path.dirname(__file__),'electrons_13TeV.json'),'r') as ef:
-            self.e_id_dict_13tev = json.load(ef)
+        self.m_id_dict_13tev = loadTables('muons_13TeV.json','pt_lo','pt_hi','abseta_lo','abseta_hi')
+        self.e_id_dict_13tev = loadTables('electrons_13TeV.json','pt_lo','pt_hi','abseta_lo','abseta_hi')
 
         # 4l 8TeV
-        path = os.path.join(os.path.dirname(__file__),'CombinedMethod_ScaleFactors_RecoIdIsoSip.root')
-        self.e_rtfile = rt.TFile(path, 'READ')
-        self.e_hist = self.e_rtfile.Get("h_electronScaleFactor_RecoIdIsoSip")
+        self.e_hist, = readHists('CombinedMethod_ScaleFactors_RecoIdIsoSip.root',"h_electronScaleFactor_RecoIdIsoSip")
 
         # MIT scale factors
-        efilename = os.path.join(os.path.dirname(__file__),'scalefactors_ele.root')
-        self.eScaleTfile = rt.TFile.Open(efilename,'READ')
-        self.eScaleHist_loose = self.eScaleTfile.Get('unfactorized_scalefactors_Loose_ele')
-        self.eScaleHist_medium = self.eScaleTfile.Get('unfactorized_scalefactors_Medium_ele')
-        self.eScaleHist_tight = self.eScaleTfile.Get('unfactorized_scalefactors_Tight_ele')
-        mfilename = os.path.join(os.path.dirname(__file__),'scalefactors_mu.root')
-        self.mScaleTfile = rt.TFile.Open(mfilename,'READ')
-        self.mScaleHist_loose = self.mScaleTfile.Get('unfactorized_scalefactors_Loose_mu')
-        self.mScaleHist_medium = self.mScaleTfile.Get('unfactorized_scalefactors_Medium_mu')
-        self.mScaleHist_tight = self.mScaleTfile.Get('unfactorized_scalefactors_Medium_mu')
-
+        self.eScaleHist_loose, self.eScaleHist_medium, self.eScaleHist_tight = readHists('scalefactors_ele.root','unfactorized_scalefactors_Loose_ele','unfactorized_scalefactors_Medium_ele','unfactorized_scalefactors_Tight_ele')
+        self.mScaleHist_loose, self.mScaleHist_medium, self.mScaleHist_tight = readHists('scalefactors_mu.root','unfactorized_scalefactors_Loose_mu','unfactorized_scalefactors_Medium_mu','unfactorized_scalefactors_Medium_mu')
 
     def close(self):
-        self.e_rtfile.Close()
-        self.m_rtfile.Close()
-        self.mScaleTfile.Close()
-        self.eScaleTfile.Close()
+        return
 
     def scale_factor(self, row, *lep_list, **kwargs):
         period = kwargs.pop('period',8)
@@ -762,17 +769,14 @@ class LeptonScaleFactors(object):
         if l[0]=='m' and shift=='mes-': pt = getattr(row, "%sPt_MuonEnDown" % l)
         eta = abs(getattr(row, "%sSCEta" % l)) if l[0]=='e' else abs(getattr(row, "%sEta" % l))
         ldict = getattr(self,'{0}_id_dict_13tev'.format(l[0]))
-        idlist = ldict[idname]
-        for iddict in idlist:
-            ptlow = iddict['pt_lo']
-            pthi = iddict['pt_hi']
-            etalow = iddict['abseta_lo']
-            etahi = iddict['abseta_hi']
-            if pt>=ptlow and pt<pthi and eta>=etalow and eta<etahi:
-                scale = iddict['ratio']
-                err = iddict['ratio_err']
-                return scale, err
-        return 1.0, 0.0
+        iddict = ldict[idname].find(pt,eta)
+        if iddict is None: return 1.0, 0.0
+        return iddict['ratio'], iddict['ratio_err']
+
+    def get_scale_err_array(self,lepType,pts,etas,idname):
+        '''Vectorized get_scale_err for arrays of pt and abs(eta) of lepton type lepType (e or m)'''
+        idlist = getattr(self,'{0}_id_dict_13tev'.format(lepType))[idname]
+        return idlist.values(pts,etas,'ratio',1.0), idlist.values(pts,etas,'ratio_err',0.0)
 
     def get_scale_err_new(self,row,l,hist,shift):
         pt = getattr(row, "%sPt" % l)
@@ -782,9 +786,7 @@ class LeptonScaleFactors(object):
         if l[0]=='m' and shift=='mes-': pt = getattr(row, "%sPt_MuonEnDown" % l)
         eta = abs(getattr(row, "%sSCEta" % l)) if l[0]=='e' else abs(getattr(row, "%sEta" % l))
         if eta>2.4: eta = 2.39 # TODO: stupid hack for MIT electrons
-        val = hist.GetBinContent(hist.FindBin(eta,pt))
-        err = hist.GetBinError(hist.FindBin(eta,pt))
-        return val,err
+        return hist.value(eta,pt)
 
     def m_wz_scale(self, row, l, shift, lepType):
         hists = {
@@ -921,9 +923,7 @@ class LeptonScaleFactors(object):
     def e_4l_scale(self, row, l):
         pt = getattr(row, "%sPt" % l)
         eta = getattr(row, "%sEta" % l)
-        global_bin = self.e_hist.FindBin(pt, eta)
-        scl = self.e_hist.GetBinContent(global_bin)
-        err = self.e_hist.GetBinError(global_bin)
+        scl, err = self.e_hist.value(pt, eta)
 
         if scl < 0.1:
             scl = 1.0
@@ -934,9 +934,7 @@ class LeptonScaleFactors(object):
     def m_4l_scale(self, row, l):
         pt = getattr(row, "%sPt" % l)
         eta = getattr(row, "%sEta" % l)
-        global_bin = self.m_hist.FindBin(pt, eta)
-        scl = self.m_hist.GetBinContent(global_bin)
-        err = self.m_hist.GetBinError(global_bin)
+        scl, err = self.m_hist.value(pt, eta)
 
         if scl < 0.1:
             scl = 1.0
@@ -948,8 +946,20 @@ class BjetScaleFactors(object):
 
     def __init__(self):
         # WZ 13TeV
-        with open(os.path.join(os.path.dirname(__file__),'CSVv2_13TeV_74X.csv'),'rb') as csv:
-            self.btag_scales = csv.reader(csv,delimiter=',')
+        self.btag_scales = loadFile('CSVv2_13TeV_74X.csv',parse=self.init_btag_scales)
+        # the formulas of the mujets light flavor rows, compiled once per operating point
+        functions = dict([(f, getattr(math,f)) for f in dir(math) if not f.startswith('_')])
+        self.btag_formulas = {}
+        for OperatingPoint, measurementType, sysType, jetFlavor, etaMin, etaMax, ptMin, ptMax, discrMin, discrMax, formula in self.btag_scales:
+            if measurementType=='mujets' and int(jetFlavor)==0:
+                thisFormula = eval('lambda x: {0}'.format(formula),functions)
+                self.btag_formulas.setdefault(int(OperatingPoint),[]).append((sysType,float(etaMin),float(etaMax),float(ptMin),float(ptMax),thisFormula))
+
+    def init_btag_scales(self,f):
+        '''The rows of a b-tag scale factor CSV file, without the header'''
+        reader = csv.reader(f,delimiter=',',skipinitialspace=True)
+        rows = [[x.strip() for x in row] for row in reader if row]
+        return rows[1:]
 
     def close(self):
         return
@@ -985,16 +995,14 @@ class BjetScaleFactors(object):
             scale[0] *= thisScale[0]
             scale[1] *= thisScale[1]
             scale[2] *= thisScale[2]
+        return scale
 
     def bjet_scale(self,opPoint,pt,eta):
         thisScale = [1.,1.,1.]
-        for s in self.btag_scales[1:]:
-            OperatingPoint, measurementType, sysType, jetFlavor, etaMin, etaMax, ptMin, ptMax, discrMin, discrMax, formula = s
-            if int(OperatingPoint)==opPoint and measurementType=='mujets' and int(jetFlavor)==0:
-                if eta>float(etaMin) and eta<float(etaMax) and pt>float(ptMin) and pt<float(ptMax):
-                    thisFormula = formula.replace(x,str(pt))
-                    val = eval(thisFormula)
-                    if sysType=='central': thisScale[0] = val if False else 1-val
-                    if sysType=='up': thisScale[1] = val if False else 1-val
-                    if sysType=='down': thisScale[2] = val if False else 1-val
+        for sysType, etaMin, etaMax, ptMin, ptMax, formula in self.btag_formulas.get(opPoint,[]):
+            if eta>etaMin and eta<etaMax and pt>ptMin and pt<ptMax:
+                val = formula(pt)
+                if sysType=='central': thisScale[0] = val if False else 1-val
+                if sysType=='up': thisScale[1] = val if False else 1-val
+                if sysType=='down': thisScale[2] = val if False else 1-val
         return thisScale
@@ -0,0 +1,211 @@
+'''
+Indexed binned lookups for the scale factor tables.
+
+The JSON and text tables are lists of bins with [lo,hi) edges in two variables,
+and a value is found by taking the first bin in the list containing the point.
+A BinnedLookup compiles such a list at load time: the distinct edges of each
+variable are sorted and every cell of the resulting grid stores the index of the
+first bin containing it. A query is then two bisections and a table lookup, and
+returns exactly the bin the linear scan would have found (including overlapping
+bins, gaps and points outside of the table).
+
+A BinnedMap holds the edges, contents and errors of a two dimensional histogram
+(including the underflow and overflow bins) extracted with fromHist, and finds
+bins as TH2::FindBin does, so the histograms are not queried through ROOT for
+every lepton.
+
+Author: Devin N. Taylor, UW-Madison
+'''
+from bisect import bisect_right
+
+import numpy as np
+
+class BinnedLookup(object):
+    '''
+    A list of bins with the edges of the first variable in bins[i][xlo], bins[i][xhi]
+    and of the second in bins[i][ylo], bins[i][yhi].
+    '''
+    def __init__(self, bins, xlo, xhi, ylo, yhi):
+        self.bins = bins
+        self.xedges = sorted(set([b[xlo] for b in bins] + [b[xhi] for b in bins]))
+        self.yedges = sorted(set([b[ylo] for b in bins] + [b[yhi] for b in bins]))
+        self.nx = len(self.xedges)-1
+        self.ny = len(self.yedges)-1
+        # cell (i,j) covers [xedges[i],xedges[i+1]) x [yedges[j],yedges[j+1])
+        self.cells = [-1] * max(self.nx*self.ny,0)
+        for index in reversed(range(len(bins))):
+            b = bins[index]
+            i0 = bisect_right(self.xedges, b[xlo])-1
+            i1 = bisect_right(self.xedges, b[xhi])-1
+            j0 = bisect_right(self.yedges, b[ylo])-1
+            j1 = bisect_right(self.yedges, b[yhi])-1
+            for i in range(i0,i1):
+                for j in range(j0,j1):
+                    self.cells[i*self.ny+j] = index
+        self.cellArray = np.array(self.cells + [-1], dtype=np.int64)
+        self.columns = {}
+
+    def __len__(self):
+        return len(self.bins)
+
+    def __iter__(self):
+        return iter(self.bins)
+
+    def index(self, x, y):
+        '''Index of the first bin containing (x,y), -1 if none'''
+        i = bisect_right(self.xedges, x)-1
+        if i<0 or i>=self.nx: return -1
+        j = bisect_right(self.yedges, y)-1
+        if j<0 or j>=self.ny: return -1
+        return self.cells[i*self.ny+j]
+
+    def find(self, x, y):
+        '''The first bin containing (x,y), None if none'''
+        index = self.index(x, y)
+        return None if index<0 else self.bins[index]
+
+    def indices(self, xs, ys):
+        '''Vectorized index: array of the first bin containing each (x,y), -1 if none'''
+        xs = np.asarray(xs, dtype=np.float64)
+        ys = np.asarray(ys, dtype=np.float64)
+        i = np.searchsorted(self.xedges, xs, side='right')-1
+        j = np.searchsorted(self.yedges, ys, side='right')-1
+        inside = (i>=0) & (i<self.nx) & (j>=0) & (j<self.ny)
+        cell = np.where(inside, i*self.ny+j, len(self.cells))
+        return self.cellArray[cell]
+
+    def column(self, key):
+        '''The values bins[i][key] as an array'''
+        if key not in self.columns:
+            self.columns[key] = np.array([b[key] for b in self.bins], dtype=np.float64)
+        return self.columns[key]
+
+    def values(self, xs, ys, key, default=0.):
+        '''Vectorized find: array of bins[i][key] for each (x,y), default if none'''
+        index = self.indices(xs, ys)
+        column = np.append(self.column(key), default)
+        return column[index]
+
+    def toArrays(self):
+        '''Arrays and metadata for a calibration bundle (the bin values must be numbers)'''
+        isList = not isinstance(self.bins[0], dict)
+        keys = range(len(self.bins[0])) if isList else sorted(self.bins[0].keys())
+        arrays = {
+            'xedges': np.array(self.xedges, dtype=np.float64),
+            'yedges': np.array(self.yedges, dtype=np.float64),
+            'cells' : self.cellArray,
+        }
+        for n, key in enumerate(keys):
+            arrays['col%i' % n] = self.column(key)
+        return arrays, {'keys': keys, 'isList': isList}
+
+    @classmethod
+    def fromArrays(cls, arrays, meta):
+        '''A lookup from the arrays and metadata of toArrays'''
+        lookup = cls.__new__(cls)
+        lookup.xedges = arrays['xedges'].tolist()
+        lookup.yedges = arrays['yedges'].tolist()
+        lookup.nx = len(lookup.xedges)-1
+        lookup.ny = len(lookup.yedges)-1
+        lookup.cellArray = arrays['cells']
+        lookup.cells = lookup.cellArray[:-1].tolist()
+        keys = meta['keys']
+        columns = [arrays['col%i' % n] for n in range(len(keys))]
+        lookup.columns = dict(zip(keys, columns))
+        rows = zip(*[c.tolist() for c in columns])
+        lookup.bins = [list(row) for row in rows] if meta['isList'] else [dict(zip(keys, row)) for row in rows]
+        return lookup
+
+def compileTables(tables, xlo, xhi, ylo, yhi):
+    '''Compile the bin lists of a dictionary (i.e. a loaded JSON file) into BinnedLookups, other entries are kept'''
+    compiled = {}
+    for key, bins in tables.items():
+        compiled[key] = BinnedLookup(bins, xlo, xhi, ylo, yhi) if isinstance(bins, list) else bins
+    return compiled
+
+def tablesToArrays(tables):
+    '''Arrays and metadata of a dictionary of BinnedLookups for a calibration bundle'''
+    arrays = {}
+    meta = {'lookups': {}, 'other': {}}
+    for key, table in tables.items():
+        if isinstance(table, BinnedLookup):
+            tableArrays, meta['lookups'][key] = table.toArrays()
+            for name, arr in tableArrays.items():
+                arrays['%s/%s' % (key, name)] = arr
+        else:
+            meta['other'][key] = table
+    return arrays, meta
+
+def tablesFromArrays(arrays, meta):
+    '''A dictionary of BinnedLookups from the arrays and metadata of tablesToArrays'''
+    tables = dict(meta['other'])
+    for key, tableMeta in meta['lookups'].items():
+        prefix = '%s/' % key
+        tableArrays = dict([(name[len(prefix):], arr) for name, arr in arrays.items() if name.startswith(prefix)])
+        tables[key] = BinnedLookup.fromArrays(tableArrays, tableMeta)
+    return tables
+
+class BinnedMap(object):
+    '''
+    Contents and errors of a two dimensional histogram, indexed by the ROOT global bin
+    (binx + (nx+2)*biny, with underflow 0 and overflow n+1 on each axis).
+    '''
+    def __init__(self, xedges, yedges, contents, errors):
+        self.xedges = [float(x) for x in xedges]
+        self.yedges = [float(y) for y in yedges]
+        self.nx = len(self.xedges)-1
+        self.ny = len(self.yedges)-1
+        self.contentArray = np.asarray(contents, dtype=np.float64)
+        self.errorArray = np.asarray(errors, dtype=np.float64)
+        self.contents = self.contentArray.tolist()
+        self.errors = self.errorArray.tolist()
+
+    @classmethod
+    def fromHist(cls, hist):
+        '''Extract a TH2'''
+        xaxis = hist.GetXaxis()
+        yaxis = hist.GetYaxis()
+        nx = hist.GetNbinsX()
+        ny = hist.GetNbinsY()
+        xedges = [xaxis.GetBinLowEdge(i) for i in range(1,nx+2)]
+        yedges = [yaxis.GetBinLowEdge(j) for j in range(1,ny+2)]
+        numBins = (nx+2)*(ny+2)
+        contents = [hist.GetBinContent(b) for b in range(numBins)]
+        errors = [hist.GetBinError(b) for b in range(numBins)]
+        return cls(xedges, yedges, contents, errors)
+
+    def findBin(self, x, y):
+        '''Global bin of (x,y), as TH2::FindBin'''
+        # the number of edges <= x is the bin number, 0 below the first edge and n+1 from the last
+        return bisect_right(self.xedges, x) + (self.nx+2)*bisect_right(self.yedges, y)
+
+    def value(self, x, y):
+        '''(content, error) of the bin containing (x,y)'''
+        b = self.findBin(x, y)
+        return self.contents[b], self.errors[b]
+
+    def findBins(self, xs, ys):
+        '''Vectorized findBin'''
+        i = np.searchsorted(self.xedges, np.asarray(xs, dtype=np.float64), side='right')
+        j = np.searchsorted(self.yedges, np.asarray(ys, dtype=np.float64), side='right')
+        return i + (self.nx+2)*j
+
+    def values(self, xs, ys):
+        '''Vectorized value: arrays of the contents and errors'''
+        b = self.findBins(xs, ys)
+        return self.contentArray[b], self.errorArray[b]
+
+    def toArrays(self):
+        '''Arrays and metadata for a calibration bundle'''
+        arrays = {
+            'xedges'  : np.array(self.xedges, dtype=np.float64),
+            'yedges'  : np.array(self.yedges, dtype=np.float64),
+            'contents': self.contentArray,
+            'errors'  : self.errorArray,
+        }
+        return arrays, {}
+
+    @classmethod
+    def fromArrays(cls, arrays, meta):
+        '''A map from the arrays of toArrays'''
+        return cls(arrays['xedges'], arrays['yedges'], arrays['contents'], arrays['errors'])
@@ -0,0 +1,290 @@
+'''
+Synthetic FSA ntuples for running the ISA analyzers offline.
+
+The branches an analyzer reads are discovered by running its selection on
+SyntheticRows, rows that generate a value for any branch requested and record
+its name (or are taken from a branch file recorded with --branchMode record).
+Ntuples with those branches are then written in the FSA layout, a
+<fs>/final/Ntuple tree and a <fs>/metaInfo tree for each final state.
+
+The values follow the branch names: the leptons get falling pt spectra, flat
+eta and phi and random charges, with a fraction of events containing a Z
+(a same flavor, opposite sign pair at the Z mass); the pair masses and
+separations are computed from the leptons; IDs, triggers and vetoes pass with
+configurable rates; other branches get small positive values. The content is
+not meant to be physical, only to exercise the analyzers realistically.
+
+Author: Devin N. Taylor, UW-Madison
+'''
+import os
+import re
+import sys
+import json
+import math
+import random
+import shutil
+import tempfile
+import logging
+from array import array
+
+sys.argv.append('-b')
+import ROOT as rt
+sys.argv.pop()
+
+ZMASS = 91.1876
+flavorMasses = {'e': 0.511e-3, 'm': 0.1057, 't': 1.777, 'j': 0., 'g': 0.}
+flavorPdgIds = {'e': 11, 'm': 13, 't': 15, 'j': 1, 'g': 22}
+
+intBranches = ['run', 'lumi', 'nvtx', 'NUP']
+pairPattern = re.compile(r'^([emtjg]\d?)_([emtjg]\d?)_(\w+)$')
+objectPattern = re.compile(r'^([emtjg]\d?)([A-Z_]\w*)$')
+
+class SyntheticModel(object):
+    '''
+    Generates the values of FSA branches for the events of a final state.
+    '''
+    def __init__(self, final_state, seed=12345, **kwargs):
+        self.objects = enumerateObjects(final_state)
+        self.leptons = [o for o in self.objects if o[0] in 'emt']
+        self.idRate = kwargs.pop('idRate', 0.9)
+        self.triggerRate = kwargs.pop('triggerRate', 0.9)
+        self.vetoRate = kwargs.pop('vetoRate', 0.1)
+        self.zFraction = kwargs.pop('zFraction', 0.7)
+        self.random = random.Random(seed)
+        self.event = {}
+
+    def branchType(self, name):
+        '''array type code of a branch'''
+        if name=='evt': return 'L'
+        if name in intBranches: return 'i'
+        return 'f'
+
+    def newEvent(self, evt):
+        '''Generate the leptons of a new event'''
+        rand = self.random
+        kin = {}
+        for obj in self.objects:
+            kin[obj] = [10.+rand.expovariate(1./30.), rand.uniform(-2.4,2.4), rand.uniform(-math.pi,math.pi), rand.choice([-1,1])]
+        # a same flavor, opposite sign pair at the Z mass
+        pairs = [(a,b) for i,a in enumerate(self.leptons) for b in self.leptons[i+1:] if a[0]==b[0]]
+        if pairs and rand.random()<self.zFraction:
+            a, b = rand.choice(pairs)
+            pta = max(rand.gauss(45.,8.),25.)
+            ptb = max(rand.gauss(45.,8.),25.)
+            mass = rand.gauss(ZMASS,2.5)
+            cosdphi = max(min(1.-mass*mass/(2.*pta*ptb),1.),-1.)
+            kin[a] = [pta, kin[a][1], kin[a][2], 1]
+            kin[b] = [ptb, kin[a][1], kin[a][2]+math.acos(cosdphi), -1]
+        self.event = {'evt': evt, 'kin': kin, 'values': {}}
+        return self.event
+
+    def pairValue(self, a, b, var):
+        kinA = self.event['kin'][a]
+        kinB = self.event['kin'][b]
+        deta = kinA[1]-kinB[1]
+        dphi = (kinA[2]-kinB[2]+math.pi) % (2*math.pi) - math.pi
+        if var=='Mass':
+            ma, mb = flavorMasses[a[0]], flavorMasses[b[0]]
+            m2 = ma*ma + mb*mb + 2*(math.sqrt((ma*ma+kinA[0]**2)*(mb*mb+kinB[0]**2))*math.cosh(deta) - kinA[0]*kinB[0]*math.cos(dphi))
+            return math.sqrt(max(m2,0.))
+        if var=='DR': return math.sqrt(deta*deta+dphi*dphi)
+        if var=='SS': return float(kinA[3]==kinB[3])
+        if var=='DPhi': return abs(dphi)
+        if var=='Pt':
+            px = kinA[0]*math.cos(kinA[2]) + kinB[0]*math.cos(kinB[2])
+            py = kinA[0]*math.sin(kinA[2]) + kinB[0]*math.sin(kinB[2])
+            return math.hypot(px, py)
+        return 0.
+
+    def objectValue(self, obj, var):
+        rand = self.random
+        pt, eta, phi, charge = self.event['kin'][obj]
+        if var in ['Pt','PtUncorr'] or var.startswith('Pt_'): return pt
+        if var in ['Eta','SCEta','EtaUncorr']: return eta
+        if var=='AbsEta': return abs(eta)
+        if var=='Phi' or var.startswith('Phi_'): return phi
+        if var=='Charge': return float(charge)
+        if var=='Mass': return flavorMasses[obj[0]]
+        if var=='PVDXY': return rand.gauss(0.,0.005)
+        if var=='PVDZ': return rand.gauss(0.,0.01)
+        if var=='GenPdgId' or var=='GenParticle': return float(-charge*flavorPdgIds[obj[0]])
+        if var=='GenMotherPdgId': return 23.
+        if var=='GenPrompt': return 1.
+        if var=='MissingHits': return 0.
+        if var.endswith('Hits') or var.endswith('Stations') or var.endswith('Measurement'): return float(rand.randint(5,15))
+        if var=='ecalEnergy' or var=='JetPt': return pt*rand.uniform(1.,1.2)
+        if var=='eSuperClusterOverP': return rand.uniform(0.9,1.1)
+        if 'Iso' in var: return rand.expovariate(1./0.05)
+        if var.startswith('Is') or var.startswith('Pass') or var.startswith('Matches') or var.startswith('ChargeId') \
+           or 'ID' in var or 'Id' in var or 'MVA' in var:
+            return float(rand.random()<self.idRate)
+        if var.startswith('Has'): return float(rand.random()>self.idRate)
+        return rand.uniform(0.,0.1)
+
+    def eventValue(self, name):
+        rand = self.random
+        if name=='evt': return self.event['evt']
+        if name=='run': return 1
+        if name=='lumi': return self.event['evt']//1000+1
+        if name=='nvtx': return max(int(rand.gauss(15,4)),1)
+        if name=='NUP': return 5
+        if name=='GenWeight': return 1.
+        if 'Veto' in name: return float(rand.random()<self.vetoRate)
+        if name.endswith('Pass') or name.startswith('single') or name.startswith('double') or name.startswith('triple'):
+            return float(rand.random()<self.triggerRate)
+        if 'Met' in name or 'MET' in name:
+            if 'Phi' in name: return rand.uniform(-math.pi,math.pi)
+            return rand.expovariate(1./30.)
+        if name=='Ht': return sum([k[0] for k in self.event['kin'].itervalues()])
+        return rand.uniform(0.,0.1)
+
+    def value(self, name):
+        '''The value of a branch in the current event'''
+        values = self.event['values']
+        if name not in values:
+            pair = pairPattern.match(name)
+            obj = objectPattern.match(name)
+            if pair and pair.group(1) in self.event['kin'] and pair.group(2) in self.event['kin']:
+                values[name] = self.pairValue(*pair.groups())
+            elif obj and obj.group(1) in self.event['kin'] and 'Veto' not in name:
+                values[name] = self.objectValue(*obj.groups())
+            else:
+                values[name] = self.eventValue(name)
+        return values[name]
+
+class SyntheticRow(object):
+    '''
+    A row of generated values standing in for an FSA tree, recording the names read.
+    '''
+    __slots__ = ['_model', '_accessed']
+
+    def __init__(self, model, accessed):
+        self._model = model
+        self._accessed = accessed
+
+    def __getattr__(self, name):
+        if name.startswith('__'): raise AttributeError(name)
+        self._accessed.add(name)
+        return self._model.value(name)
+
+def enumerateObjects(final_state):
+    '''The objects of a final state, as AnalyzerBase.enumerate_objects'''
+    out = []
+    for i in ['e', 'm', 't', 'j', 'g']:
+        N = final_state.count(i)
+        if N==1:
+            out += [i]
+        else:
+            out += ['%s%i' % (i, n) for n in xrange(1, N+1)]
+    return out
+
+def discoverBranches(analyzerClass, period, numRows=500, seed=12345, sampleNames=['data_DoubleMuon','WZTo3LNu'], **kwargs):
+    '''
+    The branches read by an analyzer (a dictionary of final state to sorted list of branches).
+    The selection is run on data and MC rows for every met shift, once with rows passing the
+    IDs, triggers and vetoes and once with the default rates, to reach every branch read.
+    Rows failing with synthetic values are counted, raises a RuntimeError if every row of a final state fails.
+    '''
+    logger = logging.getLogger(__name__)
+    branches = {}
+    tmpDir = tempfile.mkdtemp(prefix='discover_')
+    try:
+        for sample in sampleNames:
+            outName = os.path.join(tmpDir, '%s.root' % sample)
+            with analyzerClass(sample, [], outName, period, metShifts='all', loglevel='WARNING') as analyzer:
+                for fs in analyzer.final_states:
+                    accessed = branches.setdefault(fs, set())
+                    numErrors = 0
+                    numTried = 0
+                    for rates in [{'idRate': 1., 'triggerRate': 1., 'vetoRate': 0., 'zFraction': 1.}, kwargs]:
+                        model = SyntheticModel(fs, seed=seed, **dict(rates))
+                        row = SyntheticRow(model, accessed)
+                        analyzer.objects = analyzer.enumerate_objects(fs)
+                        for i in xrange(numRows):
+                            model.newEvent(i)
+                            analyzer.cache = {}
+                            for state in analyzer.shiftStates:
+                                analyzer.useShift(state)
+                                numTried += 1
+                                try:
+                                    analyzer.analyze_row(row, (long(i), 1, 1), state)
+                                except Exception as e:
+                                    if not numErrors: logger.warning('%s %s: first failure: %s' % (sample, fs, e))
+                                    numErrors += 1
+                                    logger.debug('%s %s: %s' % (sample, fs, e))
+                            for state in analyzer.shiftStates:
+                                state.nextFile()
+                    if numErrors==numTried:
+                        raise RuntimeError('%s %s: all %i rows failed with synthetic values, the branches read are unknown' % (sample, fs, numTried))
+                    if numErrors: logger.warning('%s %s: %i of %i rows failed with synthetic values' % (sample, fs, numErrors, numTried))
+    finally:
+        shutil.rmtree(tmpDir, ignore_errors=True)
+    for fs in branches:
+        branches[fs] = sorted(branches[fs] | set(['evt','run','lumi']))
+    return branches
+
+def writeNtuple(fileName, branches, numEvents, seed=12345, firstEvent=1, **kwargs):
+    '''
+    Write a synthetic FSA ntuple with the branches of each final state (a dictionary of final state to branches).
+    The same event numbers are used in every final state, as an event appears in several of them in FSA.
+    '''
+    tfile = rt.TFile(fileName, 'recreate')
+    rootTypes = {'L': 'l', 'i': 'I', 'f': 'F'}
+    for n, fs in enumerate(sorted(branches)):
+        model = SyntheticModel(fs, seed=seed+n, **dict(kwargs))
+        fsDir = tfile.mkdir(fs)
+        fsDir.mkdir('final').cd()
+        tree = rt.TTree('Ntuple', 'Ntuple')
+        buffers = []
+        for name in branches[fs]:
+            typeCode = model.branchType(name)
+            buf = array(typeCode, [0])
+            tree.Branch(name, buf, '%s/%s' % (name, rootTypes[typeCode]))
+            buffers += [(name, buf)]
+        summedWeights = 0.
+        for i in xrange(numEvents):
+            model.newEvent(firstEvent+i)
+            for name, buf in buffers:
+                buf[0] = model.value(name)
+            summedWeights += model.value('GenWeight')
+            tree.Fill()
+        tree.Write()
+        fsDir.cd()
+        metaTree = rt.TTree('metaInfo', 'metaInfo')
+        nevents = array('i', [numEvents])
+        weights = array('f', [summedWeights])
+        metaTree.Branch('nevents', nevents, 'nevents/I')
+        metaTree.Branch('summedWeights', weights, 'summedWeights/F')
+        metaTree.Fill()
+        metaTree.Write()
+    tfile.Close()
+
+def writeNtuples(outDir, branches, numFiles, numEvents, seed=12345, **kwargs):
+    '''Write numFiles synthetic ntuples of numEvents events per final state, returns the file names'''
+    if not os.path.isdir(outDir): os.makedirs(outDir)
+    fileNames = []
+    for i in range(numFiles):
+        fileName = os.path.join(outDir, 'synthetic_%i.root' % i)
+        writeNtuple(fileName, branches, numEvents, seed=seed+1000*i, firstEvent=1+i*numEvents, **kwargs)
+        fileNames += [fileName]
+    return fileNames
+
+def cachedNtuples(analyzerClass, period, outDir, numFiles, numEvents, seed=12345):
+    '''
+    Synthetic ntuples of an analyzer, written unless they exist with the same configuration
+    (stored in synthetic.json in outDir). Returns the file names and the branches of each final state.
+    '''
+    logger = logging.getLogger(__name__)
+    config = {'analysis': analyzerClass.__name__, 'period': period, 'numFiles': numFiles, 'numEvents': numEvents, 'seed': seed}
+    configName = os.path.join(outDir, 'synthetic.json')
+    if os.path.isfile(configName):
+        with open(configName, 'r') as f:
+            stored = json.load(f)
+        if stored['config']==config:
+            return stored['fileNames'], stored['branches']
+    logger.info('Generating %i files of %i events per final state for %s' % (numFiles, numEvents, analyzerClass.__name__))
+    branches = discoverBranches(analyzerClass, period, seed=seed)
+    fileNames = writeNtuples(outDir, branches, numFiles, numEvents, seed=seed)
+    with open(configName, 'w') as f:
+        json.dump({'config': config, 'fileNames': fileNames, 'branches': branches}, f, indent=1)
+    return fileNames, branches
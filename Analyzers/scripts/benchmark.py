@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+'''
+A script to benchmark the ISA analyzers on synthetic FSA ntuples.
+
+Synthetic ntuples are generated for each analyzer (see synthetic.py, they are
+reused while the configuration is unchanged) and the analyzer is run on them in
+each mode in a new python process (benchmarkCase.py). For every analyzer and
+mode the startup time (importing and constructing the analyzer and loading the
+calibrations), the events/s of the event loop and the peak memory of the
+process are reported and written to benchmark.json in
+the work directory.
+
+The results are compared to a stored baseline (written with --update) and any
+analyzer and mode slower, or using more memory or startup time, than the
+baseline by more than the tolerance is flagged, with a non zero exit code.
+Baselines are only comparable on the same machine.
+
+Author: Devin N. Taylor, UW-Madison
+'''
+
+import os
+import sys
+import json
+import argparse
+import logging
+import subprocess
+
+from InitialStateAnalysis.Analyzers.synthetic import cachedNtuples
+from InitialStateAnalysis.Analyzers.AnalyzerWZ import AnalyzerWZ
+from InitialStateAnalysis.Analyzers.AnalyzerHpp3l import AnalyzerHpp3l
+from InitialStateAnalysis.Analyzers.AnalyzerHpp4l import AnalyzerHpp4l
+
+analyzers = {
+    'WZ'   : AnalyzerWZ,
+    'Hpp3l': AnalyzerHpp3l,
+    'Hpp4l': AnalyzerHpp4l,
+}
+
+# analyzer options of each mode
+modes = {
+    'row'     : {},
+    'chunk'   : {'chunkSize': 1000},
+    'activate': {'branchMode': 'activate'},
+    'shifts'  : {'metShifts': 'all'},
+    'packed'  : {'packCutTree': True},
+    'profile' : {'profile': True},
+}
+
+samples = {
+    'mc'  : 'WZTo3LNu',
+    'data': 'data_DoubleMuon',
+}
+
+caseScript = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmarkCase.py')
+
+def run_process(analysis, options, fileNames, outName, period, sample):
+    '''Run a case in a new python process (benchmarkCase.py), None if it failed'''
+    case = {'analysis': analysis, 'options': options, 'fileNames': fileNames, 'outName': outName, 'period': period, 'sample': sample}
+    resultName = os.path.splitext(outName)[0]+'_result.json'
+    if os.path.isfile(resultName): os.remove(resultName)
+    status = subprocess.call([sys.executable, caseScript, json.dumps(case), resultName])
+    if status or not os.path.isfile(resultName): return None
+    with open(resultName, 'r') as f:
+        return json.load(f)
+
+def benchmark(analysis, mode, fileNames, numEvents, workDir, period, sample):
+    logger = logging.getLogger(__name__)
+    options = dict(modes[mode])
+    outName = os.path.join(workDir, 'output', '%s_%s.root' % (analysis, mode))
+    if mode=='activate':
+        options['branchFile'] = os.path.join(workDir, 'output', '%s_branches.json' % analysis)
+        if os.path.isfile(options['branchFile']): os.remove(options['branchFile'])
+        recordOptions = dict(options, branchMode='record', metShifts='all')
+        if run_process(analysis, recordOptions, fileNames, outName, period, sample) is None:
+            logger.error('%s %s: recording the branches failed' % (analysis, mode))
+            return None
+    result = run_process(analysis, options, fileNames, outName, period, sample)
+    if result is None:
+        logger.error('%s %s: failed' % (analysis, mode))
+        return None
+    result['events'] = numEvents
+    result['events/s'] = numEvents/result['loop'] if result['loop'] else 0.
+    return result
+
+def compare(results, baseline, tolerance):
+    '''The regressions of the results with respect to the baseline'''
+    regressions = []
+    for analysis in sorted(results):
+        for mode in sorted(results[analysis]):
+            result = results[analysis][mode]
+            base = baseline.get(analysis,{}).get(mode)
+            if not result or not base: continue
+            if result['events/s']<base['events/s']*(1-tolerance):
+                regressions += ['%s %s: %.1f events/s, baseline %.1f' % (analysis, mode, result['events/s'], base['events/s'])]
+            if result['memory']>base['memory']*(1+tolerance):
+                regressions += ['%s %s: %.1f MB peak memory, baseline %.1f' % (analysis, mode, result['memory'], base['memory'])]
+            if result['startup']>base['startup']*(1+tolerance):
+                regressions += ['%s %s: %.2f s startup, baseline %.2f' % (analysis, mode, result['startup'], base['startup'])]
+    return regressions
+
+def parse_command_line(argv):
+    parser = argparse.ArgumentParser(description="Benchmark the analyzers on synthetic ntuples")
+
+    parser.add_argument('-a','--analyses',nargs='+',type=str,default=['WZ','Hpp3l','Hpp4l'],choices=sorted(analyzers.keys()),help='Analyzers to benchmark')
+    parser.add_argument('-m','--modes',nargs='+',type=str,default=['row','chunk','activate','shifts'],choices=sorted(modes.keys()),help='Modes to benchmark')
+    parser.add_argument('-p','--period',type=int,default=13,choices=[8,13],help='Energy (TeV)')
+    parser.add_argument('-s','--sample',type=str,default='mc',choices=sorted(samples.keys()),help='Run as MC or data')
+    parser.add_argument('-n','--numEvents',type=int,default=2000,help='Number of events per final state and file')
+    parser.add_argument('-nf','--numFiles',type=int,default=2,help='Number of files')
+    parser.add_argument('-d','--workDir',type=str,default='./benchmark',help='Directory of the ntuples, outputs and results')
+    parser.add_argument('-b','--baseline',type=str,default='',help='Baseline file (default: baseline.json in the work directory)')
+    parser.add_argument('-u','--update',action='store_true',help='Store the results as the baseline')
+    parser.add_argument('-tol','--tolerance',type=float,default=0.15,help='Relative change flagged as a regression')
+    parser.add_argument('--seed',type=int,default=12345,help='Random seed of the ntuples')
+    parser.add_argument('-l','--log',nargs='?',type=str,const='INFO',default='INFO',choices=['INFO','DEBUG','WARNING','ERROR','CRITICAL'],help='Log level for logger')
+    args = parser.parse_args(argv)
+
+    return args
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+
+    args = parse_command_line(argv)
+
+    loglevel = getattr(logging,args.log)
+    logging.basicConfig(format='%(asctime)s.%(msecs)03d %(levelname)s %(name)s: %(message)s', level=loglevel, datefmt='%Y-%m-%d %H:%M:%S')
+    logger = logging.getLogger(__name__)
+
+    baselineName = args.baseline or os.path.join(args.workDir, 'baseline.json')
+    outDir = os.path.join(args.workDir, 'output')
+    if not os.path.isdir(outDir): os.makedirs(outDir)
+
+    results = {}
+    failed = False
+    for analysis in args.analyses:
+        ntupleDir = os.path.join(args.workDir, '%s_%iTeV' % (analysis, args.period))
+        fileNames, branches = cachedNtuples(analyzers[analysis], args.period, ntupleDir, args.numFiles, args.numEvents, args.seed)
+        numEvents = args.numEvents*args.numFiles*len(branches)
+        results[analysis] = {}
+        for mode in args.modes:
+            result = benchmark(analysis, mode, fileNames, numEvents, args.workDir, args.period, samples[args.sample])
+            results[analysis][mode] = result
+            if result is None:
+                failed = True
+                continue
+            logger.info('%-6s %-9s %9.1f events/s %8.2f s startup %8.1f MB' % (analysis, mode, result['events/s'], result['startup'], result['memory']))
+
+    with open(os.path.join(args.workDir, 'benchmark.json'), 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.update:
+        with open(baselineName, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        logger.info('Stored the baseline in %s' % baselineName)
+    elif os.path.isfile(baselineName):
+        with open(baselineName, 'r') as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        for regression in regressions:
+            logger.error('Regression: %s' % regression)
+        if regressions: failed = True
+        else: logger.info('No regressions with respect to %s' % baselineName)
+    else:
+        logger.info('No baseline in %s, store one with --update' % baselineName)
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    status = main()
+    sys.exit(status)
@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+'''
+Run one case of benchmark.py: an analyzer on synthetic ntuples with the options of a mode.
+
+benchmark.py runs every case with this script in a new python process, so the
+startup time includes importing the analyzer and the peak memory is that of the
+case alone. The case is given as JSON and the startup time, loop time and peak
+memory are written as JSON to the result file.
+
+Author: Devin N. Taylor, UW-Madison
+'''
+
+import time
+scriptStart = time.time() # before importing the analyzer
+
+import sys
+import json
+import resource
+import argparse
+import importlib
+import logging
+
+def encode(obj):
+    '''The strings of a JSON object as str (the analyzers and ROOT expect str)'''
+    if isinstance(obj, unicode): return str(obj)
+    if isinstance(obj, list): return [encode(x) for x in obj]
+    if isinstance(obj, dict): return dict((encode(k), encode(v)) for k, v in obj.iteritems())
+    return obj
+
+def run_case(analysis, options, fileNames, outName, period, sample):
+    '''Run an analyzer, returns the startup time, the loop time and the peak memory'''
+    module = importlib.import_module('InitialStateAnalysis.Analyzers.Analyzer%s' % analysis)
+    analyzer = getattr(module, 'Analyzer%s' % analysis)(sample, fileNames, outName, period, loglevel='WARNING', **options)
+    analyzer.begin()
+    startup = time.time()-scriptStart
+    start = time.time()
+    analyzer.analyze()
+    loop = time.time()-start
+    analyzer.finish()
+    return {'startup': startup, 'loop': loop, 'memory': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.}
+
+def parse_command_line(argv):
+    parser = argparse.ArgumentParser(description="Run one benchmark case (see benchmark.py)")
+
+    parser.add_argument('case',type=str,help='The case as JSON: analysis, options, fileNames, outName, period and sample')
+    parser.add_argument('result',type=str,help='File the result is written to as JSON')
+    parser.add_argument('-l','--log',nargs='?',type=str,const='INFO',default='WARNING',choices=['INFO','DEBUG','WARNING','ERROR','CRITICAL'],help='Log level for logger')
+    args = parser.parse_args(argv)
+
+    return args
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+
+    args = parse_command_line(argv)
+
+    loglevel = getattr(logging,args.log)
+    logging.basicConfig(format='%(asctime)s.%(msecs)03d %(levelname)s %(name)s: %(message)s', level=loglevel, datefmt='%Y-%m-%d %H:%M:%S')
+
+    case = encode(json.loads(args.case))
+    result = run_case(case['analysis'], case['options'], case['fileNames'], case['outName'], case['period'], case['sample'])
+
+    with open(args.result, 'w') as f:
+        json.dump(result, f, indent=2, sort_keys=True)
+
+    return 0
+
+
+if __name__ == "__main__":
+    status = main()
+    sys.exit(status)
@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+'''
+A script to benchmark the output writer presets of the ISA analyzers.
+
+An analyzer is run on synthetic FSA ntuples (see synthetic.py, they are reused
+while the configuration is unchanged) once for every writer preset, in a fresh
+process. For each preset the write time (filling the output trees and closing
+the file), the size of the output and the time PlotterBase takes to draw the
+usual distributions from it are reported, with the ratios to the first preset,
+and written to writer.json in the work directory.
+
+The read time is measured with the output in the page cache, so it is dominated
+by the decompression and deserialization of the baskets, as for ntuples on a
+local disk. Results are only comparable on the same machine.
+
+Author: Devin N. Taylor, UW-Madison
+'''
+
+import os
+import sys
+import json
+import time
+import argparse
+import logging
+from multiprocessing import Process, Queue
+
+from InitialStateAnalysis.Analyzers.synthetic import cachedNtuples
+from InitialStateAnalysis.Analyzers.ntuples import writerPresets
+from InitialStateAnalysis.Analyzers.AnalyzerWZ import AnalyzerWZ
+from InitialStateAnalysis.Analyzers.AnalyzerHpp3l import AnalyzerHpp3l
+from InitialStateAnalysis.Analyzers.AnalyzerHpp4l import AnalyzerHpp4l
+
+analyzers = {
+    'WZ'   : AnalyzerWZ,
+    'Hpp3l': AnalyzerHpp3l,
+    'Hpp4l': AnalyzerHpp4l,
+}
+
+samples = {
+    'mc'  : 'WZTo3LNu',
+    'data': 'data_DoubleMuon',
+}
+
+# distributions drawn from the output, as by the plotters
+plotVariables = [
+    ('finalstate.mass', [50,0,500]),
+    ('finalstate.met',  [40,0,200]),
+    ('finalstate.sT',   [50,0,500]),
+    ('l1.Pt',           [40,0,200]),
+    ('l1.Eta',          [30,-3.,3.]),
+    ('l2.Pt',           [40,0,200]),
+    ('event.nvtx',      [50,0,50]),
+]
+scaleFactor = 'event.gen_weight*event.pu_weight*event.lep_scale*event.trig_scale'
+
+def write_case(analysis, preset, fileNames, outName, period, sample, queue):
+    '''Run an analyzer with a writer preset (in its own process), reports the write time and the output tree'''
+    analyzer = analyzers[analysis](sample, fileNames, outName, period, loglevel='WARNING', profile=True, writerPreset=preset)
+    analyzer.begin()
+    analyzer.analyze()
+    start = time.time()
+    analyzer.finish()
+    close = time.time()-start
+    fill = analyzer.profiler.stages.get('fill',[0,0.])[1]
+    queue.put({'fill': fill, 'close': close, 'write': fill+close, 'tree': analyzer.channel})
+
+def read_case(outName, treeName, numReads, isData, queue):
+    '''Draw the distributions from an output (in its own process), reports the best time of numReads'''
+    from InitialStateAnalysis.Plotters.PlotterBase import getHist
+    import ROOT as rt
+    times = []
+    for i in range(numReads):
+        tfile = rt.TFile.Open(outName)
+        tree = tfile.Get(treeName)
+        start = time.time()
+        for v, (variable, binning) in enumerate(plotVariables):
+            getHist(['h_%i_%i' % (i,v), tree, variable, binning, '1' if isData else scaleFactor, 'select.passTight'])
+        times += [time.time()-start]
+        tfile.Close()
+    queue.put({'read': min(times)})
+
+def run_process(target, args):
+    '''Run a case in a fresh process, None if it failed'''
+    queue = Queue()
+    p = Process(target=target, args=args+(queue,))
+    p.start()
+    p.join()
+    if p.exitcode: return None
+    return queue.get()
+
+def benchmark(analysis, preset, fileNames, workDir, period, sample, numReads):
+    logger = logging.getLogger(__name__)
+    outName = os.path.join(workDir, 'writer', '%s_%s.root' % (analysis, preset))
+    result = run_process(write_case, (analysis, preset, fileNames, outName, period, sample))
+    if result is None:
+        logger.error('%s %s: writing failed' % (analysis, preset))
+        return None
+    result['MB'] = os.path.getsize(outName)/1e6
+    read = run_process(read_case, (outName, result['tree'], numReads, sample.startswith('data')))
+    if read is None:
+        logger.error('%s %s: reading failed' % (analysis, preset))
+        return None
+    result['read'] = read['read']
+    result['settings'] = writerPresets[preset]
+    return result
+
+def parse_command_line(argv):
+    parser = argparse.ArgumentParser(description="Benchmark the output writer presets on synthetic ntuples")
+
+    parser.add_argument('-a','--analysis',type=str,default='WZ',choices=sorted(analyzers.keys()),help='Analyzer to benchmark')
+    parser.add_argument('-wp','--writerPresets',nargs='+',type=str,default=['default','read','compact','fast'],choices=sorted(writerPresets.keys()),help='Writer presets to benchmark (the first is the reference)')
+    parser.add_argument('-p','--period',type=int,default=13,choices=[8,13],help='Energy (TeV)')
+    parser.add_argument('-s','--sample',type=str,default='mc',choices=sorted(samples.keys()),help='Run as MC or data')
+    parser.add_argument('-n','--numEvents',type=int,default=5000,help='Number of events per final state and file')
+    parser.add_argument('-nf','--numFiles',type=int,default=2,help='Number of files')
+    parser.add_argument('-r','--numReads',type=int,default=3,help='Number of reads of each output (the fastest is kept)')
+    parser.add_argument('-d','--workDir',type=str,default='./benchmark',help='Directory of the ntuples, outputs and results')
+    parser.add_argument('--seed',type=int,default=12345,help='Random seed of the ntuples')
+    parser.add_argument('-l','--log',nargs='?',type=str,const='INFO',default='INFO',choices=['INFO','DEBUG','WARNING','ERROR','CRITICAL'],help='Log level for logger')
+    args = parser.parse_args(argv)
+
+    return args
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+
+    args = parse_command_line(argv)
+
+    loglevel = getattr(logging,args.log)
+    logging.basicConfig(format='%(asctime)s.%(msecs)03d %(levelname)s %(name)s: %(message)s', level=loglevel, datefmt='%Y-%m-%d %H:%M:%S')
+    logger = logging.getLogger(__name__)
+
+    outDir = os.path.join(args.workDir, 'writer')
+    if not os.path.isdir(outDir): os.makedirs(outDir)
+
+    ntupleDir = os.path.join(args.workDir, '%s_%iTeV' % (args.analysis, args.period))
+    fileNames, branches = cachedNtuples(analyzers[args.analysis], args.period, ntupleDir, args.numFiles, args.numEvents, args.seed)
+
+    results = {}
+    failed = False
+    reference = None
+    for preset in args.writerPresets:
+        result = benchmark(args.analysis, preset, fileNames, args.workDir, args.period, samples[args.sample], args.numReads)
+        results[preset] = result
+        if result is None:
+            failed = True
+            continue
+        if reference is None: reference = result
+        logger.info('%-8s %8.2f s write (x%.2f) %8.2f MB (x%.2f) %8.3f s read (x%.2f)' % (preset,
+            result['write'], result['write']/reference['write'] if reference['write'] else 0.,
+            result['MB'], result['MB']/reference['MB'] if reference['MB'] else 0.,
+            result['read'], result['read']/reference['read'] if reference['read'] else 0.))
+
+    with open(os.path.join(args.workDir, 'writer.json'), 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    status = main()
+    sys.exit(status)
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+'''
+A script to compile the ISA calibrations into a bundle.
+
+Every scale factor, efficiency, fake rate, pileup and b-tag table is built from
+its sources and written to a single memory mapped bundle (see calibrations.py),
+which the analyzers then read instead of parsing the sources. Rerun after
+changing any of the sources, tables with changed sources are read from the
+sources (with a warning) until then.
+
+Author: Devin N. Taylor, UW-Madison
+'''
+
+import os
+import sys
+import time
+import argparse
+import logging
+
+import InitialStateAnalysis.Analyzers.calibrations as calibrations
+from InitialStateAnalysis.Analyzers.scale_factors import LeptonScaleFactors, TriggerScaleFactors, ChargeIdSystematics, LeptonEfficiency, LeptonFakeRate, BjetScaleFactors
+from InitialStateAnalysis.Analyzers.pu_weights import PileupWeights
+
+calibrationClasses = [LeptonScaleFactors, TriggerScaleFactors, ChargeIdSystematics, LeptonEfficiency, LeptonFakeRate, BjetScaleFactors, PileupWeights]
+
+def build_calibrations():
+    '''Build every table from its sources'''
+    calibrations.setBundle(enabled=False)
+    for calibrationClass in calibrationClasses:
+        calibrationClass()
+    return dict(calibrations.built)
+
+def load_calibrations(fileName):
+    '''Load every table from the bundle, returns the time taken and the names of the tables read from the sources'''
+    calibrations.setBundle(fileName)
+    start = time.time()
+    for calibrationClass in calibrationClasses:
+        calibrationClass()
+    return time.time()-start, sorted(calibrations.built)
+
+def parse_command_line(argv):
+    parser = argparse.ArgumentParser(description="Compile the calibrations into a bundle")
+
+    parser.add_argument('-o','--output',type=str,default=calibrations.defaultBundle,help='Bundle file')
+    parser.add_argument('-l','--log',nargs='?',type=str,const='INFO',default='INFO',choices=['INFO','DEBUG','WARNING','ERROR','CRITICAL'],help='Log level for logger')
+    args = parser.parse_args(argv)
+
+    return args
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+
+    args = parse_command_line(argv)
+
+    loglevel = getattr(logging,args.log)
+    logging.basicConfig(format='%(asctime)s.%(msecs)03d %(levelname)s %(name)s: %(message)s', level=loglevel, datefmt='%Y-%m-%d %H:%M:%S')
+    logger = logging.getLogger(__name__)
+
+    start = time.time()
+    tables = build_calibrations()
+    buildTime = time.time()-start
+    for name in sorted(tables):
+        logger.debug('%s: %s' % (name, ', '.join(tables[name][0])))
+    calibrations.writeBundle(args.output, tables)
+    logger.info('Wrote %i tables to %s (%.1f kB), reading the sources took %.3f s' % (len(tables), args.output, os.path.getsize(args.output)/1024., buildTime))
+
+    loadTime, rebuilt = load_calibrations(args.output)
+    if rebuilt:
+        logger.error('Tables not read from the bundle: %s' % ', '.join(rebuilt))
+        return 1
+    logger.info('Loading from the bundle took %.3f s' % loadTime)
+    return 0
+
+
+if __name__ == "__main__":
+    status = main()
+    sys.exit(status)
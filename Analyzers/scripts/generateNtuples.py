@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+'''
+A script to generate synthetic FSA ntuples for an ISA analyzer.
+
+The branches read by the analyzer are discovered by running it on synthetic
+rows (or taken from a branch file recorded with run.py --branchMode record) and
+ntuples of the requested size are written to the output directory, in the FSA
+layout, with the event content described in synthetic.py. The ntuples can be
+run with run.py --customDir or analyzed directly, no HDFS or xrootd access is
+needed.
+
+Author: Devin N. Taylor, UW-Madison
+'''
+
+import sys
+import argparse
+import logging
+
+from InitialStateAnalysis.Analyzers.synthetic import discoverBranches, writeNtuples
+from InitialStateAnalysis.Analyzers.branchActivation import loadBranches
+from InitialStateAnalysis.Analyzers.AnalyzerWZ import AnalyzerWZ
+from InitialStateAnalysis.Analyzers.AnalyzerHpp3l import AnalyzerHpp3l
+from InitialStateAnalysis.Analyzers.AnalyzerHpp4l import AnalyzerHpp4l
+
+analyzers = {
+    'WZ'   : AnalyzerWZ,
+    'Hpp3l': AnalyzerHpp3l,
+    'Hpp4l': AnalyzerHpp4l,
+}
+
+def getBranches(analysis, period, branchFile='', seed=12345, **kwargs):
+    '''The branches of each final state, recorded or discovered'''
+    logger = logging.getLogger(__name__)
+    if branchFile:
+        branches = loadBranches(branchFile)
+        if branches:
+            return dict([(fs, sorted(set(names) | set(['evt','run','lumi']))) for fs, names in branches.iteritems()])
+        logger.warning('No branches in %s, discovering them' % branchFile)
+    return discoverBranches(analyzers[analysis], period, seed=seed, **kwargs)
+
+def parse_command_line(argv):
+    parser = argparse.ArgumentParser(description="Generate synthetic FSA ntuples for an analyzer")
+
+    parser.add_argument('analysis', type=str, choices=sorted(analyzers.keys()), help='Analyzer to generate the branches of')
+    parser.add_argument('outDir', type=str, help='Output directory')
+    parser.add_argument('-p','--period',type=int,default=13,choices=[8,13],help='Energy (TeV)')
+    parser.add_argument('-n','--numEvents',type=int,default=10000,help='Number of events per final state and file')
+    parser.add_argument('-nf','--numFiles',type=int,default=1,help='Number of files')
+    parser.add_argument('-bf','--branchFile',type=str,default='',help='Recorded branches to write (default: discover them)')
+    parser.add_argument('-id','--idRate',type=float,default=0.9,help='Rate of leptons passing each ID')
+    parser.add_argument('-tr','--triggerRate',type=float,default=0.9,help='Rate of events passing each trigger')
+    parser.add_argument('-vr','--vetoRate',type=float,default=0.1,help='Rate of events with each veto object')
+    parser.add_argument('-zf','--zFraction',type=float,default=0.7,help='Fraction of events with a Z')
+    parser.add_argument('-s','--seed',type=int,default=12345,help='Random seed')
+    parser.add_argument('-l','--log',nargs='?',type=str,const='INFO',default='INFO',choices=['INFO','DEBUG','WARNING','ERROR','CRITICAL'],help='Log level for logger')
+    args = parser.parse_args(argv)
+
+    return args
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+
+    args = parse_command_line(argv)
+
+    loglevel = getattr(logging,args.log)
+    logging.basicConfig(format='%(asctime)s.%(msecs)03d %(levelname)s %(name)s: %(message)s', level=loglevel, datefmt='%Y-%m-%d %H:%M:%S')
+    logger = logging.getLogger(__name__)
+
+    rates = {'idRate': args.idRate, 'triggerRate': args.triggerRate, 'vetoRate': args.vetoRate, 'zFraction': args.zFraction}
+    branches = getBranches(args.analysis, args.period, branchFile=args.branchFile, seed=args.seed, **rates)
+    for fs in sorted(branches):
+        logger.info('%s: %i branches' % (fs, len(branches[fs])))
+    fileNames = writeNtuples(args.outDir, branches, args.numFiles, args.numEvents, seed=args.seed, **rates)
+    logger.info('Wrote %i files of %i events per final state to %s' % (len(fileNames), args.numEvents, args.outDir))
+    return 0
+
+
+if __name__ == "__main__":
+    status = main()
+    sys.exit(status)
@@ -8,6 +8,7 @@ Author: Devin N. Taylor, UW-Madison
 import os
 import sys
 import glob
+import json
 import pwd
 import argparse
 import errno
@@ -15,10 +16,16 @@ import socket
 import signal
 import logging
 import math
+import shutil
 
-from multiprocessing import Pool
+from multiprocessing import Pool, cpu_count
 
 from InitialStateAnalysis.Utilities.utilities import *
+from InitialStateAnalysis.Utilities.mergeUtils import buildWorkUnits, getUnitSize, mergeParts, readCheckpoint, writeCheckpoint, inputFingerprint, sourceHash, cacheConfig, configKey, cacheKey
+from InitialStateAnalysis.Analyzers.AnalyzerBase import allowedMetShifts, shiftFileName, preloadCalibrations
+from InitialStateAnalysis.Analyzers.calibrations import baseDir
+from InitialStateAnalysis.Analyzers.profiling import profileName, mergeReportFiles
+from InitialStateAnalysis.Analyzers.ntuples import outputProfiles, writerPresets, compressionAlgorithms
 from InitialStateAnalysis.Analyzers.AnalyzerZ import AnalyzerZ
 from InitialStateAnalysis.Analyzers.AnalyzerWZ import AnalyzerWZ, AnalyzerWZ_ZFakeRate, AnalyzerWZ_TTFakeRate
 from InitialStateAnalysis.Analyzers.AnalyzerWZ_W import AnalyzerWZ_WFakeRate
@@ -27,44 +34,61 @@ from InitialStateAnalysis.Analyzers.AnalyzerHpp2l import AnalyzerHpp2l, Analyzer
 from InitialStateAnalysis.Analyzers.AnalyzerHpp3l import AnalyzerHpp3l, AnalyzerHpp3l_WZ, AnalyzerHpp3l_LowMass
 from InitialStateAnalysis.Analyzers.AnalyzerHpp4l import AnalyzerHpp4l, AnalyzerHpp4l_ZZ
 
+analyzerMap = {
+    'Z'       : {
+                'Z'       : AnalyzerZ,
+                },
+    'Hpp2l'   : {
+                'Hpp2l'   : AnalyzerHpp2l,
+                'Z'       : AnalyzerHpp2l_Z,
+                'Charge'  : AnalyzerHpp2l_Charge,
+                'TT'      : AnalyzerHpp2l_TT,
+                },
+    'WZ'      : {
+                'WZ'      : AnalyzerWZ,
+                'FakeRate': AnalyzerWZ_ZFakeRate,
+                'TTFakeRate': AnalyzerWZ_TTFakeRate,
+                 },
+    'WZ_W'    : {
+                'FakeRate': AnalyzerWZ_WFakeRate,
+                },
+    'WZ_Dijet': {
+                'FakeRate': AnalyzerWZ_DijetFakeRate,
+                },
+    'Hpp3l'   : {
+                'Hpp3l'   : AnalyzerHpp3l,
+                'WZ'      : AnalyzerHpp3l_WZ,
+                'LowMass' : AnalyzerHpp3l_LowMass,
+                },
+    'Hpp4l'   : {
+                'Hpp4l'   : AnalyzerHpp4l,
+                'ZZ'      : AnalyzerHpp4l_ZZ,
+                },
+}
+
 def run_analyzer(args):
     '''Run the analysis'''
-    analysis, channel, sample_name, filelist, outfile, period, metShift, loglevel = args
-    analyzerMap = {
-        'Z'       : {
-                    'Z'       : AnalyzerZ,
-                    },
-        'Hpp2l'   : {
-                    'Hpp2l'   : AnalyzerHpp2l,
-                    'Z'       : AnalyzerHpp2l_Z,
-                    'Charge'  : AnalyzerHpp2l_Charge,
-                    'TT'      : AnalyzerHpp2l_TT,
-                    },
-        'WZ'      : {
-                    'WZ'      : AnalyzerWZ,
-                    'FakeRate': AnalyzerWZ_ZFakeRate,
-                    'TTFakeRate': AnalyzerWZ_TTFakeRate,
-                     },
-        'WZ_W'    : {
-                    'FakeRate': AnalyzerWZ_WFakeRate,
-                    },
-        'WZ_Dijet': {
-                    'FakeRate': AnalyzerWZ_DijetFakeRate,
-                    },
-        'Hpp3l'   : {
-                    'Hpp3l'   : AnalyzerHpp3l,
-                    'WZ'      : AnalyzerHpp3l_WZ,
-                    'LowMass' : AnalyzerHpp3l_LowMass,
-                    },
-        'Hpp4l'   : {
-                    'Hpp4l'   : AnalyzerHpp4l,
-                    'ZZ'      : AnalyzerHpp4l_ZZ,
-                    },
-    }
+    analysis, channel, sample_name, filelist, outfile, period, metShift, loglevel, options = args
     theAnalyzer = analyzerMap[analysis][channel]
-    with theAnalyzer(sample_name,filelist,outfile,period,metShift=metShift,loglevel=loglevel) as analyzer:
+    with theAnalyzer(sample_name,filelist,outfile,period,metShift=metShift,loglevel=loglevel,**options) as analyzer:
         analyzer.analyze()
 
+def run_part(args):
+    '''Run the analysis of a checkpointed part, returns the sample and file index once the part is written'''
+    sample, index, analyzerArgs = args
+    run_analyzer(analyzerArgs)
+    return sample, index
+
+def run_cached(args):
+    '''Run the analysis of an input file into its cache entry, the (nominal) entry only exists once the output is complete'''
+    sample, index, cacheName, analyzerArgs = args
+    run_analyzer(analyzerArgs)
+    tmpName = analyzerArgs[4]
+    for shift in allowedMetShifts + ['']:
+        if os.path.isfile(shiftFileName(tmpName,shift)): os.rename(shiftFileName(tmpName,shift), shiftFileName(cacheName,shift))
+    if os.path.isfile(profileName(tmpName)): os.rename(profileName(tmpName), profileName(cacheName))
+    return sample, index
+
 def get_sample_names(analysis,period,samples,**kwargs):
     '''Get unix sample names'''
     customDir = kwargs.pop('customDir','')
@@ -145,8 +169,15 @@ def run_ntuples(analysis, channel, period, samples, loglevel, **kwargs):
     logger = logging.getLogger(__name__)
     test = kwargs.pop('test',False)
     metShift = kwargs.pop('metShift','')
+    options = kwargs.pop('analyzerOptions',{})
+    numCores = min(cpu_count(), kwargs.pop('numCores',8) or cpu_count())
+    unitSize = kwargs.pop('unitSize',0)*1000000
+    checkpoint = kwargs.pop('checkpoint',False)
+    incremental = kwargs.pop('incremental',False)
+    hashInputs = kwargs.pop('hashInputs',False)
     ntup_dir = './ntuples/%s_%iTeV_%s' % (analysis, period, channel)
     python_mkdir(ntup_dir)
+    if 'branchFile' not in options: options['branchFile'] = '%s/branches.json' % ntup_dir
     root_dir, sample_names = get_sample_names(analysis,period,samples,**kwargs)
 
 
@@ -155,16 +186,42 @@ def run_ntuples(analysis, channel, period, samples, loglevel, **kwargs):
         sampledir = '%s/%s' % (root_dir, sample)
         filelists[sample] = ['%s/%s' % (sampledir, x) for x in os.listdir(sampledir)]
 
-    if len(sample_names)==1 or test: # only one, its a test, dont use map
+    if test: # its a test, dont use map
         name = sample_names[0]
-        outname =  "%s/%s.root" % (ntup_dir, name)
-        if test: outname = 'test.root'
-        run_analyzer((analysis, channel, name, filelists[name], outname, period, metShift, loglevel))
+        outname = 'test.root'
+        run_analyzer((analysis, channel, name, filelists[name], outname, period, metShift, loglevel, options))
         return 0
 
-    p = Pool(8)
+    # decode the calibrations before the workers are forked, they are then shared
+    preloadCalibrations()
+
+    if incremental:
+        return run_incremental(analysis, channel, period, filelists, ntup_dir, metShift, loglevel, options, numCores, hashInputs)
+    if checkpoint:
+        return run_checkpointed(analysis, channel, period, filelists, ntup_dir, metShift, loglevel, options, numCores)
+
+    # split the samples into units of files, largest first
+    if not unitSize: unitSize = getUnitSize(filelists,numCores)
+    units = buildWorkUnits(filelists,unitSize)
+    if not units:
+        logger.warning('No input files found')
+        return 0
+    if len(units)==1: # only one, dont use map
+        name = units[0][0]
+        run_analyzer((analysis, channel, name, filelists[name], "%s/%s.root" % (ntup_dir, name), period, metShift, loglevel, options))
+        return 0
+
+    part_dir = '%s/parts' % ntup_dir
+    python_mkdir(part_dir)
+    numUnits = {}
+    for sample, index, files, size in units:
+        numUnits[sample] = max(numUnits.get(sample,0),index+1)
+    logger.info('Running %i samples in %i units on %i cores' % (len(numUnits), len(units), min(numCores,len(units))))
+
+    p = Pool(min(numCores,len(units)))
     try:
-        p.map_async(run_analyzer, [(analysis, channel, name, filelists[name], "%s/%s.root" % (ntup_dir, name), period, metShift, loglevel) for name in sample_names]).get(999999)
+        p.map_async(run_analyzer, [(analysis, channel, sample, files, "%s/%s_%i.root" % (part_dir, sample, index), period, metShift, loglevel, options) for sample, index, files, size in units], chunksize=1).get(999999)
+        p.map_async(merge_sample, [(channel, "%s/%s.root" % (ntup_dir, sample), ["%s/%s_%i.root" % (part_dir, sample, i) for i in range(numUnits[sample])], options.get('metShifts',[]), False) for sample in sorted(numUnits)], chunksize=1).get(999999)
     except KeyboardInterrupt:
         p.terminate()
         logger.info('Analyzer cancelled')
@@ -172,6 +229,127 @@ def run_ntuples(analysis, channel, period, samples, loglevel, **kwargs):
    
     return 0
 
+def run_checkpointed(analysis, channel, period, filelists, ntup_dir, metShift, loglevel, options, numCores):
+    '''
+    Run each input file as its own part, recording the completed files in a checkpoint after each one.
+    A rerun skips the recorded files, the parts are merged once every file of a sample is done.
+    '''
+    logger = logging.getLogger(__name__)
+    config = {'metShift': metShift, 'options': options}
+    checkpoints = {}
+    jobs = []
+    for sample in sorted(filelists):
+        check_dir = '%s/checkpoints/%s' % (ntup_dir, sample)
+        python_mkdir(check_dir)
+        stateName = '%s/checkpoint.json' % check_dir
+        done = readCheckpoint(stateName, filelists[sample], config)
+        if done: logger.info('%s: resuming, %i of %i files done' % (sample, len(done), len(filelists[sample])))
+        checkpoints[sample] = (check_dir, stateName, done)
+        for index, f in enumerate(filelists[sample]):
+            if index in done: continue
+            jobs += [(sample, index, (analysis, channel, sample, [f], '%s/%i.root' % (check_dir, index), period, metShift, loglevel, options))]
+    logger.info('Running %i files of %i samples on %i cores' % (len(jobs), len(filelists), max(min(numCores,len(jobs)),1)))
+
+    p = Pool(max(min(numCores,len(jobs)),1))
+    try:
+        results = p.imap_unordered(run_part, jobs)
+        for i in range(len(jobs)):
+            sample, index = results.next(999999)
+            check_dir, stateName, done = checkpoints[sample]
+            done[index] = '%s/%i.root' % (check_dir, index)
+            writeCheckpoint(stateName, filelists[sample], done, config)
+        p.map_async(merge_sample, [(channel, "%s/%s.root" % (ntup_dir, sample), ['%s/%i.root' % (checkpoints[sample][0], i) for i in range(len(filelists[sample]))], options.get('metShifts',[]), False) for sample in sorted(filelists)], chunksize=1).get(999999)
+    except KeyboardInterrupt:
+        p.terminate()
+        logger.info('Analyzer cancelled, rerun with --checkpoint to resume')
+        sys.exit(1)
+
+    for sample in sorted(filelists):
+        check_dir, stateName, done = checkpoints[sample]
+        shutil.rmtree(check_dir, ignore_errors=True)
+
+    return 0
+
+def run_incremental(analysis, channel, period, filelists, ntup_dir, metShift, loglevel, options, numCores, hashInputs):
+    '''
+    Run only the input files without an up to date cached output, then merge the cached outputs of all the files.
+    The outputs of each configuration (the analyzer, the period, the met shifts, the analyzer options and the hash
+    of the analyzer sources and tables) are kept in their own directory, keyed on the input file (its path with its
+    size and mtime, or its hash).
+    '''
+    logger = logging.getLogger(__name__)
+    analyzerName = analyzerMap[analysis][channel].__name__
+    metShifts = options.get('metShifts',[])
+    if metShifts=='all': metShifts = allowedMetShifts
+    codeHash = sourceHash(baseDir)
+    config = cacheConfig(analyzerName, period, metShift, metShifts, codeHash, options)
+    configName = configKey(config)
+    cacheNames = {}
+    jobs = []
+    for sample in sorted(filelists):
+        cache_dir = '%s/cache/%s/%s' % (ntup_dir, sample, configName)
+        python_mkdir(cache_dir)
+        with open('%s/config.json' % cache_dir, 'w') as f:
+            json.dump(config, f, indent=1, sort_keys=True)
+        cacheNames[sample] = []
+        pending = set()
+        for index, f in enumerate(filelists[sample]):
+            key = cacheKey(inputFingerprint(f,hashInputs))
+            cacheName = '%s/%s.root' % (cache_dir, key)
+            if cacheName in cacheNames[sample]:
+                logger.warning('%s: %s is listed more than once, merging it once' % (sample, f))
+                continue
+            cacheNames[sample] += [cacheName]
+            if os.path.isfile(cacheName): continue
+            pending.add(cacheName)
+            jobs += [(sample, index, cacheName, (analysis, channel, sample, [f], '%s/tmp_%s.root' % (cache_dir, key), period, metShift, loglevel, options))]
+        logger.info('%s: %i of %i files up to date' % (sample, len(cacheNames[sample])-len(pending), len(cacheNames[sample])))
+
+    p = Pool(max(min(numCores,len(jobs)),1))
+    try:
+        p.map_async(run_cached, jobs, chunksize=1).get(999999)
+        p.map_async(merge_sample, [(channel, "%s/%s.root" % (ntup_dir, sample), cacheNames[sample], metShifts, True) for sample in sorted(filelists)], chunksize=1).get(999999)
+    except KeyboardInterrupt:
+        p.terminate()
+        logger.info('Analyzer cancelled')
+        sys.exit(1)
+
+    for sample in sorted(filelists):
+        sample_dir = '%s/cache/%s' % (ntup_dir, sample)
+        cache_dir = '%s/%s' % (sample_dir, configName)
+        # drop the outputs of removed or changed files of this configuration
+        current = set([shiftFileName(x,shift) for x in cacheNames[sample] for shift in [''] + list(allowedMetShifts)] + [profileName(x) for x in cacheNames[sample]] + ['%s/config.json' % cache_dir])
+        for fileName in os.listdir(cache_dir):
+            if '%s/%s' % (cache_dir, fileName) not in current: os.remove('%s/%s' % (cache_dir, fileName))
+        # and the configurations of older analyzer sources, which cannot be reused
+        for otherName in os.listdir(sample_dir):
+            otherConfig = '%s/%s/config.json' % (sample_dir, otherName)
+            if otherName==configName or not os.path.isfile(otherConfig): continue
+            with open(otherConfig, 'r') as f:
+                if json.load(f).get('codeHash')!=codeHash: shutil.rmtree('%s/%s' % (sample_dir, otherName), ignore_errors=True)
+
+    return 0
+
+def merge_sample(args):
+    '''
+    Merge the unit outputs of a sample (and of each met shift), the outputs are removed unless kept.
+    The profile reports of the units (with --profile) are summed into the report of the sample, and removed with the outputs.
+    '''
+    channel, outname, partnames, metShifts, keepParts = args
+    if metShifts=='all': metShifts = allowedMetShifts
+    for shift in [''] + list(metShifts):
+        shiftParts = [shiftFileName(x,shift) for x in partnames]
+        if not any([os.path.isfile(x) for x in shiftParts]): continue # no shifts for data
+        mergeParts(shiftParts, shiftFileName(outname,shift), channel)
+        if keepParts: continue
+        for x in shiftParts:
+            if os.path.isfile(x): os.remove(x)
+    reports = [profileName(x) for x in partnames if os.path.isfile(profileName(x))]
+    if reports:
+        mergeReportFiles(reports, profileName(outname))
+        if not keepParts:
+            for x in reports: os.remove(x)
+
 def submitFwkliteJob(sampledir,args):
     '''
     Submit a job using farmoutAnalysisJobs --fwklite
@@ -252,6 +430,27 @@ def parse_command_line(argv):
     parser.add_argument('-jn','--jobName',nargs='?',type=str,const='',help='Job Name for condor submission')
     parser.add_argument('-d','--customDir',nargs='?',type=str,const='',help='Custom input directory')
     parser.add_argument('-ms','--metShift',nargs='?',type=str,const='',help='Shift the met')
+    parser.add_argument('-mss','--metShifts',nargs='*',type=str,default=[],help='Additional met shifts evaluated in the same pass (\'all\' for every shift), each written to <sample>_<shift>.root')
+    parser.add_argument('-nc','--numCores',type=int,default=8,help='Number of cores to use (0 = all)')
+    parser.add_argument('-us','--unitSize',type=int,default=0,help='Size (MB) of the file units a sample is split into (0 = automatic)')
+    parser.add_argument('-isd','--indexSpillDir',type=str,default='',help='Spill the index of written events to this directory')
+    parser.add_argument('-pd','--prefetchDir',type=str,default='',help='Stage the next input files in this (local scratch) directory while analyzing')
+    parser.add_argument('-pn','--prefetchFiles',type=int,default=2,help='Number of input files staged ahead (with --prefetchDir)')
+    parser.add_argument('-ps','--prefetchSize',type=int,default=2000,help='Size cap (MB) of the staged files of each job (with --prefetchDir)')
+    parser.add_argument('-pf','--profile',action='store_true',help='Time the cuts and analyzer stages, the report is written to <output>_profile.json')
+    parser.add_argument('-pct','--packCutTree',action='store_true',help='Store the cut tree results as a single bitmask (each cut is an alias of the tree), evaluating each cut only if the cuts it requires pass')
+    parser.add_argument('-op','--outputProfile',type=str,default='full',choices=sorted(outputProfiles.keys()),help='Groups of optional fields written to the output ntuple (the others are not computed)')
+    parser.add_argument('-wp','--writerPreset',type=str,default='default',choices=sorted(writerPresets.keys()),help='Compression, basket size and auto flush of the output ntuples (read: optimized for plotting)')
+    parser.add_argument('-wc','--compression',type=str,default=None,choices=sorted(compressionAlgorithms.keys()),help='Compression algorithm of the output (overrides the preset)')
+    parser.add_argument('-wl','--compressionLevel',type=int,default=None,help='Compression level of the output, 0 for none (overrides the preset)')
+    parser.add_argument('-wb','--basketSize',type=int,default=None,help='Basket size (bytes) of the output branches (overrides the preset)')
+    parser.add_argument('-wf','--autoFlush',type=int,default=None,help='Auto flush of the output trees, entries if > 0 and bytes if < 0 (overrides the preset)')
+    parser.add_argument('-cs','--chunkSize',type=int,default=0,help='Read FSA ntuples in chunks of this many entries (0 = row by row)')
+    parser.add_argument('-bm','--branchMode',type=str,default='',choices=['','record','activate'],help='Record the FSA branches read or only read the recorded branches')
+    parser.add_argument('-cp','--checkpoint',action='store_true',help='Run each file separately and record the completed files, a rerun resumes from the last completed file')
+    parser.add_argument('-inc','--incremental',action='store_true',help='Cache the output of each file and only run the new or changed files (and all after changes to the analyzers)')
+    parser.add_argument('-hi','--hashInputs',action='store_true',help='Identify the input files by their hash instead of size and modification time (with --incremental)')
+    parser.add_argument('-bf','--branchFile',type=str,default='',help='File of recorded branches (default: branches.json in the ntuple directory)')
     args = parser.parse_args(argv)
 
     return args
@@ -271,12 +470,33 @@ def main(argv=None):
     else:
         logger.info("Running %s:%s %i TeV analyzer" %(args.analysis, args.channel, args.period))
         if args.submit:
+            if args.metShifts: logger.warning('--metShifts is only supported when running locally, submit each --metShift separately')
+            if args.outputProfile!='full': logger.warning('--outputProfile is only supported when running locally, submitted jobs write the full output')
+            if args.writerPreset!='default': logger.warning('--writerPreset is only supported when running locally, submitted jobs use the default writer settings')
             root_dir, sample_names = get_sample_names(args.analysis, args.period, args.sample_names, customDir=args.customDir)
             for sample in sample_names:
                 sampledir = '%s/%s' % (root_dir, sample)
                 submitFwkliteJob(sampledir,args)
         else:
-            run_ntuples(args.analysis, args.channel, args.period, args.sample_names, args.log, customDir=args.customDir, test=args.test, metShift=args.metShift)
+            analyzerOptions = {
+                'chunkSize': args.chunkSize,
+                'branchMode': args.branchMode,
+                'indexSpillDir': args.indexSpillDir,
+                'prefetchDir': args.prefetchDir,
+                'prefetchFiles': args.prefetchFiles,
+                'prefetchSize': args.prefetchSize,
+                'profile': args.profile,
+                'packCutTree': args.packCutTree,
+                'outputProfile': args.outputProfile,
+                'writerPreset': args.writerPreset,
+                'compression': args.compression,
+                'compressionLevel': args.compressionLevel,
+                'basketSize': args.basketSize,
+                'autoFlush': args.autoFlush,
+                'metShifts': 'all' if 'all' in args.metShifts else args.metShifts,
+            }
+            if args.branchFile: analyzerOptions['branchFile'] = args.branchFile
+            run_ntuples(args.analysis, args.channel, args.period, args.sample_names, args.log, customDir=args.customDir, test=args.test, metShift=args.metShift, numCores=args.numCores, unitSize=args.unitSize, checkpoint=args.checkpoint, incremental=args.incremental, hashInputs=args.hashInputs, analyzerOptions=analyzerOptions)
 
     return 0
 
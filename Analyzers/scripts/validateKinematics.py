@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+'''
+A script to validate the kinematics kernel against TLorentzVector.
+
+Random combinations of leptons, jets and met (including the edge cases of
+null and collinear vectors) are built with TLorentzVector as AnalyzerBase did
+and with the kinematics module (scalar and array), and the variables used in
+getObject are compared. Returns a non zero exit code if any differ by more than
+the tolerance.
+
+Author: Devin N. Taylor, UW-Madison
+'''
+
+import sys
+import math
+import random
+import argparse
+import logging
+
+import numpy as np
+
+import ROOT as rt
+rt.PyConfig.IgnoreCommandLineOptions = True
+rt.gROOT.ProcessLine("gErrorIgnoreLevel = 3001;") # silence the eta warnings
+
+import InitialStateAnalysis.Analyzers.kinematics as kin
+
+masses = {'e':0.511e-3, 'm':0.1056, 't':1.776, 'j':0, 'met':0}
+
+def random_objects(numObjects):
+    '''Random (pt, eta, phi, m) for numObjects objects plus met'''
+    objs = []
+    for i in range(numObjects):
+        flv = random.choice(['e','m','t','j'])
+        objs += [(random.expovariate(1./40.), random.uniform(-2.5,2.5), random.uniform(-math.pi,math.pi), masses[flv])]
+    objs += [(random.expovariate(1./30.), 0., random.uniform(-math.pi,math.pi), 0.)]
+    return objs
+
+def edge_objects():
+    '''Null, back-to-back and collinear configurations'''
+    return [
+        [(0.,0.,0.,0.),(0.,0.,0.,0.)],
+        [(20.,0.,0.,0.),(20.,0.,math.pi,0.)],
+        [(20.,1.,0.5,0.1056),(20.,1.,0.5,0.1056),(0.,0.,0.,0.)],
+        [(30.,-1.2,1.,0.511e-3),(30.,1.2,1.+math.pi,0.511e-3),(10.,0.,2.,0.)],
+    ]
+
+def root_values(objs):
+    vecs = []
+    for pt, eta, phi, m in objs:
+        vec = rt.TLorentzVector()
+        vec.SetPtEtaPhiM(pt,eta,phi,m)
+        vecs += [vec]
+    vec = rt.TLorentzVector()
+    for v in vecs: vec += v
+    candVec = rt.TLorentzVector()
+    for v in vecs[:-1]: candVec += v
+    metVec = vecs[-1]
+    return {
+        'pt'  : vec.Pt(),
+        'mass': vec.M(),
+        'eta' : vec.Eta(),
+        'phi' : vec.Phi(),
+        'mt'  : math.sqrt(abs((candVec.Et()+metVec.Et())**2 - (vec.Pt())**2)),
+    }
+
+def kernel_values(objs):
+    vecs = [kin.p4(*o) for o in objs]
+    vec = kin.add(*vecs)
+    return {
+        'pt'  : kin.pt(vec),
+        'mass': kin.mass(vec),
+        'eta' : kin.eta(vec),
+        'phi' : kin.phi(vec),
+        'mt'  : kin.mt(kin.add(*vecs[:-1]),vecs[-1]),
+    }
+
+def array_values(objsList):
+    '''Evaluate a list of configurations with the same number of objects as arrays'''
+    numObjs = len(objsList[0])
+    vecs = []
+    for i in range(numObjs):
+        cols = zip(*[objs[i] for objs in objsList])
+        vecs += [kin.p4(*[np.array(c) for c in cols])]
+    vec = kin.add(*vecs)
+    return {
+        'pt'  : kin.pt(vec),
+        'mass': kin.mass(vec),
+        'eta' : kin.eta(vec),
+        'phi' : kin.phi(vec),
+        'mt'  : kin.mt(kin.add(*vecs[:-1]),vecs[-1]),
+    }
+
+def differs(a, b, tolerance):
+    return abs(a-b) > tolerance*max(1.,abs(a),abs(b))
+
+def parse_command_line(argv):
+    parser = argparse.ArgumentParser(description="Validate the kinematics kernel against TLorentzVector")
+
+    parser.add_argument('-n','--numTrials',type=int,default=10000,help='Number of random configurations per multiplicity')
+    parser.add_argument('-t','--tolerance',type=float,default=1e-9,help='Relative tolerance')
+    parser.add_argument('-s','--seed',type=int,default=12345,help='Random seed')
+    parser.add_argument('-l','--log',nargs='?',type=str,const='INFO',default='INFO',choices=['INFO','DEBUG','WARNING','ERROR','CRITICAL'],help='Log level for logger')
+    args = parser.parse_args(argv)
+
+    return args
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+
+    args = parse_command_line(argv)
+
+    loglevel = getattr(logging,args.log)
+    logging.basicConfig(format='%(asctime)s.%(msecs)03d %(levelname)s %(name)s: %(message)s', level=loglevel, datefmt='%Y-%m-%d %H:%M:%S')
+    logger = logging.getLogger(__name__)
+
+    random.seed(args.seed)
+    failures = 0
+    configurations = edge_objects()
+    for numObjects in [1,2,3,4]:
+        configurations += [random_objects(numObjects) for i in range(args.numTrials)]
+
+    # scalar
+    for objs in configurations:
+        rootVals = root_values(objs)
+        kinVals = kernel_values(objs)
+        for var in rootVals:
+            if differs(rootVals[var],kinVals[var],args.tolerance):
+                failures += 1
+                logger.error('%s differs (root %r, kinematics %r) for %r' % (var, rootVals[var], kinVals[var], objs))
+
+    # arrays
+    byMultiplicity = {}
+    for objs in configurations:
+        byMultiplicity.setdefault(len(objs),[]).append(objs)
+    for numObjs, objsList in byMultiplicity.iteritems():
+        arrVals = array_values(objsList)
+        for i, objs in enumerate(objsList):
+            rootVals = root_values(objs)
+            for var in rootVals:
+                if differs(rootVals[var],float(arrVals[var][i]),args.tolerance):
+                    failures += 1
+                    logger.error('%s differs (root %r, kinematics array %r) for %r' % (var, rootVals[var], arrVals[var][i], objs))
+
+    logger.info('Compared %i configurations, %i differences' % (len(configurations), failures))
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    status = main()
+    sys.exit(status)
@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+'''
+A script to validate the input file prefetcher with a local directory standing
+in for the remote store.
+
+Files of random sizes (and one missing file) are written to a temporary "remote"
+directory, and copied with an added latency per file. They are read in order
+with a processing time per file, and the local copies are checked to match the
+originals, the missing file to fall back to its original name, the staged size to
+stay within the cap and the scratch directory to be cleaned up. The time taken
+is compared to reading without the prefetcher. Returns a non zero exit code if
+any check fails.
+
+Author: Devin N. Taylor, UW-Madison
+'''
+
+import os
+import sys
+import time
+import random
+import shutil
+import tempfile
+import argparse
+import logging
+
+from InitialStateAnalysis.Analyzers.prefetch import FilePrefetcher, copyFile
+
+def make_store(storeDir, numFiles, maxSize):
+    '''Write the files of the stand in store, returns their names (the last one is missing)'''
+    fileNames = []
+    for i in range(numFiles):
+        fileName = os.path.join(storeDir, 'ntuple_%i.root' % i)
+        with open(fileName, 'wb') as f:
+            f.write(os.urandom(random.randint(1, maxSize)))
+        fileNames += [fileName]
+    return fileNames + [os.path.join(storeDir, 'missing.root')]
+
+def read_files(fileNames, latency, processTime, prefetcher=None):
+    '''Read the files in order as the analyzer does, returns the names read and the bytes of each'''
+    logger = logging.getLogger(__name__)
+    results = []
+    for i, fileName in enumerate(fileNames):
+        if prefetcher:
+            readName = prefetcher.get(i)
+        else:
+            time.sleep(latency)
+            readName = fileName
+        data = open(readName, 'rb').read() if os.path.isfile(readName) else None
+        time.sleep(processTime)
+        if prefetcher:
+            logger.debug('%s: read %s, %i bytes staged' % (fileName, readName, prefetcher.stagedSize))
+            prefetcher.release(i)
+        results += [(readName, data)]
+    return results
+
+def parse_command_line(argv):
+    parser = argparse.ArgumentParser(description="Validate the input file prefetcher with a local stand in for the remote store")
+
+    parser.add_argument('-n','--numFiles',type=int,default=20,help='Number of files')
+    parser.add_argument('-m','--maxFileSize',type=int,default=200000,help='Maximum file size (bytes)')
+    parser.add_argument('-a','--numAhead',type=int,default=3,help='Number of files staged ahead')
+    parser.add_argument('-c','--cacheSize',type=int,default=400000,help='Size cap of the staged files (bytes)')
+    parser.add_argument('-lt','--latency',type=float,default=0.05,help='Latency added to each copy (s)')
+    parser.add_argument('-pt','--processTime',type=float,default=0.05,help='Processing time of each file (s)')
+    parser.add_argument('-s','--seed',type=int,default=12345,help='Random seed')
+    parser.add_argument('-l','--log',nargs='?',type=str,const='INFO',default='INFO',choices=['INFO','DEBUG','WARNING','ERROR','CRITICAL'],help='Log level for logger')
+    args = parser.parse_args(argv)
+
+    return args
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+
+    args = parse_command_line(argv)
+
+    loglevel = getattr(logging,args.log)
+    logging.basicConfig(format='%(asctime)s.%(msecs)03d %(levelname)s %(name)s: %(message)s', level=loglevel, datefmt='%Y-%m-%d %H:%M:%S')
+    logger = logging.getLogger(__name__)
+
+    random.seed(args.seed)
+    workDir = tempfile.mkdtemp(prefix='validatePrefetch_')
+    storeDir = os.path.join(workDir, 'store')
+    cacheDir = os.path.join(workDir, 'scratch')
+    os.makedirs(storeDir)
+    fileNames = make_store(storeDir, args.numFiles, args.maxFileSize)
+    largest = max([os.path.getsize(f) for f in fileNames if os.path.isfile(f)])
+
+    def slowCopy(source, destination):
+        time.sleep(args.latency)
+        copyFile(source, destination)
+
+    failures = 0
+    try:
+        start = time.time()
+        expected = read_files(fileNames, args.latency, args.processTime)
+        directTime = time.time()-start
+
+        start = time.time()
+        with FilePrefetcher(fileNames, cacheDir, numAhead=args.numAhead, maxSize=args.cacheSize, copy=slowCopy) as prefetcher:
+            results = read_files(fileNames, args.latency, args.processTime, prefetcher=prefetcher)
+            peakSize = prefetcher.peakSize
+        prefetchTime = time.time()-start
+
+        for fileName, (directName, directData), (readName, data) in zip(fileNames, expected, results):
+            if data!=directData:
+                failures += 1
+                logger.error('%s: contents of %s differ' % (fileName, readName))
+            if os.path.isfile(fileName) and not readName.startswith(cacheDir):
+                failures += 1
+                logger.error('%s: not staged (read %s)' % (fileName, readName))
+            if not os.path.isfile(fileName) and readName!=fileName:
+                failures += 1
+                logger.error('%s: missing file read as %s' % (fileName, readName))
+        if peakSize>max(args.cacheSize, largest):
+            failures += 1
+            logger.error('Staged %i bytes, above the cap of %i' % (peakSize, args.cacheSize))
+        if os.listdir(cacheDir):
+            failures += 1
+            logger.error('Staged files left in %s: %s' % (cacheDir, ', '.join(os.listdir(cacheDir))))
+
+        logger.info('Read %i files in %.2f s directly and %.2f s with the prefetcher (peak %i bytes staged), %i failures' % (len(fileNames), directTime, prefetchTime, peakSize, failures))
+    finally:
+        shutil.rmtree(workDir, ignore_errors=True)
+
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    status = main()
+    sys.exit(status)
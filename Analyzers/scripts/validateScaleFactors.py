@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+'''
+A script to validate the binned scale factor lookups against a linear scan
+and the extracted histograms against ROOT.
+
+Every table compiled by TriggerScaleFactors and LeptonScaleFactors is queried
+(scalar and vectorized) at the bin edges, just around them, at random points and
+outside of the table, and the bin found is compared to the first bin of the list
+containing the point, as the original scans did. The histograms extracted into
+BinnedMaps are compared to TH2::FindBin and GetBinContent/GetBinError at the same
+kind of points. Returns a non zero exit code if any differ.
+
+Author: Devin N. Taylor, UW-Madison
+'''
+
+import os
+import sys
+import random
+import argparse
+import logging
+
+import numpy as np
+
+import ROOT as rt
+rt.PyConfig.IgnoreCommandLineOptions = True
+
+import InitialStateAnalysis.Analyzers.scale_factors as scale_factors
+from InitialStateAnalysis.Analyzers.scale_factors import TriggerScaleFactors, LeptonScaleFactors, LeptonEfficiency, LeptonFakeRate
+
+# extracted histograms: (object, attribute, file, histogram)
+def extracted_hists(efficiency, fakerate, leptonscaler):
+    return [
+        (efficiency,   'eEffHist_loose',     'SingleElectron_efficiencies_electronTnP.root', 'eff_Loose_ele'),
+        (efficiency,   'eEffHist_medium',    'SingleElectron_efficiencies_electronTnP.root', 'eff_Medium_ele'),
+        (efficiency,   'eEffHist_tight',     'SingleElectron_efficiencies_electronTnP.root', 'eff_Tight_ele'),
+        (efficiency,   'mEffHist_loose',     'SingleMuon_efficiencies_muonTnP.root',         'eff_Loose_mu'),
+        (efficiency,   'mEffHist_medium',    'SingleMuon_efficiencies_muonTnP.root',         'eff_Medium_mu'),
+        (fakerate,     'eFakeHist',          'EGFR_RunII_25ns_jet35_08Jan.root',             'FR_pT_eta_EWKcorr'),
+        (fakerate,     'mFakeHist',          'MuFR_RunII_25ns_jet20_08Jan.root',             'FR_pT_eta_EWKcorr'),
+        (fakerate,     'eTightFakeHist',     'fakes_dijet_13TeV.root',                       'FakeRateProbeElecTight'),
+        (fakerate,     'eMediumFakeHist',    'fakes_dijet_13TeV.root',                       'FakeRateProbeElecMedium'),
+        (fakerate,     'mMediumFakeHist',    'fakes_dijet_13TeV.root',                       'FakeRateProbeMuonMedium'),
+        (fakerate,     'eTightFakeHist_mc',  'fakes_dijet_13TeV_fromMC.root',                'FakeRateProbeElecTight'),
+        (fakerate,     'eMediumFakeHist_mc', 'fakes_dijet_13TeV_fromMC.root',                'FakeRateProbeElecMedium'),
+        (fakerate,     'mMediumFakeHist_mc', 'fakes_dijet_13TeV_fromMC.root',                'FakeRateProbeMuonMedium'),
+        (leptonscaler, 'm_hist',             'MuonScaleFactors_2011_2012.root',              'TH2D_ALL_2012'),
+        (leptonscaler, 'e_hist',             'CombinedMethod_ScaleFactors_RecoIdIsoSip.root','h_electronScaleFactor_RecoIdIsoSip'),
+        (leptonscaler, 'eScaleHist_loose',   'scalefactors_ele.root',                        'unfactorized_scalefactors_Loose_ele'),
+        (leptonscaler, 'eScaleHist_medium',  'scalefactors_ele.root',                        'unfactorized_scalefactors_Medium_ele'),
+        (leptonscaler, 'eScaleHist_tight',   'scalefactors_ele.root',                        'unfactorized_scalefactors_Tight_ele'),
+        (leptonscaler, 'mScaleHist_loose',   'scalefactors_mu.root',                         'unfactorized_scalefactors_Loose_mu'),
+        (leptonscaler, 'mScaleHist_medium',  'scalefactors_mu.root',                         'unfactorized_scalefactors_Medium_mu'),
+    ]
+
+def linear_scan(bins, xlo, xhi, ylo, yhi, x, y):
+    for i, b in enumerate(bins):
+        if x>=b[xlo] and x<b[xhi] and y>=b[ylo] and y<b[yhi]:
+            return i
+    return -1
+
+def test_points(lookup, numTrials):
+    xs = list(lookup.xedges) + [x*(1+1e-9) for x in lookup.xedges] + [x*(1-1e-9) for x in lookup.xedges]
+    ys = list(lookup.yedges) + [y*(1+1e-9) for y in lookup.yedges] + [y*(1-1e-9) for y in lookup.yedges]
+    xlow, xhigh = lookup.xedges[0], lookup.xedges[-1]
+    ylow, yhigh = lookup.yedges[0], lookup.yedges[-1]
+    xs += [random.uniform(xlow-1,min(xhigh,1e4)+1) for i in range(numTrials)] + [-1e10, 1e10, float('nan')]
+    ys += [random.uniform(ylow-1,min(yhigh,1e4)+1) for i in range(numTrials)] + [-1e10, 1e10, float('nan')]
+    return [(x,y) for x in xs for y in ys]
+
+def validate(name, lookup, keys, numTrials):
+    logger = logging.getLogger(__name__)
+    failures = 0
+    points = test_points(lookup, numTrials)
+    expected = [linear_scan(lookup.bins, keys[0], keys[1], keys[2], keys[3], x, y) for x, y in points]
+    scalar = [lookup.index(x, y) for x, y in points]
+    vectorized = lookup.indices(np.array([p[0] for p in points]), np.array([p[1] for p in points]))
+    for p, e, s, v in zip(points, expected, scalar, vectorized):
+        if e!=s or e!=v:
+            failures += 1
+            logger.error('%s: (%r, %r) scan %i, lookup %i, vectorized %i' % (name, p[0], p[1], e, s, v))
+    logger.debug('%s: %i points' % (name, len(points)))
+    return failures
+
+def validate_hist(name, binnedMap, hist, numTrials):
+    logger = logging.getLogger(__name__)
+    failures = 0
+    points = test_points(binnedMap, numTrials)
+    xs = np.array([p[0] for p in points])
+    ys = np.array([p[1] for p in points])
+    vals, errs = binnedMap.values(xs, ys)
+    for i, (x, y) in enumerate(points):
+        b = hist.FindBin(x, y)
+        expected = (b, hist.GetBinContent(b), hist.GetBinError(b))
+        found = (binnedMap.findBin(x, y),) + binnedMap.value(x, y)
+        vectorized = (found[0], vals[i], errs[i])
+        if expected!=found or expected!=vectorized:
+            failures += 1
+            logger.error('%s: (%r, %r) root %r, map %r, vectorized %r' % (name, x, y, expected, found, vectorized))
+    logger.debug('%s: %i points' % (name, len(points)))
+    return failures
+
+def parse_command_line(argv):
+    parser = argparse.ArgumentParser(description="Validate the binned scale factor lookups against a linear scan and ROOT")
+
+    parser.add_argument('-n','--numTrials',type=int,default=200,help='Number of random values per variable and table')
+    parser.add_argument('-s','--seed',type=int,default=12345,help='Random seed')
+    parser.add_argument('-l','--log',nargs='?',type=str,const='INFO',default='INFO',choices=['INFO','DEBUG','WARNING','ERROR','CRITICAL'],help='Log level for logger')
+    args = parser.parse_args(argv)
+
+    return args
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+
+    args = parse_command_line(argv)
+
+    loglevel = getattr(logging,args.log)
+    logging.basicConfig(format='%(asctime)s.%(msecs)03d %(levelname)s %(name)s: %(message)s', level=loglevel, datefmt='%Y-%m-%d %H:%M:%S')
+    logger = logging.getLogger(__name__)
+
+    random.seed(args.seed)
+    trigscaler = TriggerScaleFactors()
+    leptonscaler = LeptonScaleFactors()
+
+    absetaKeys = ('pt_lo','pt_hi','abseta_lo','abseta_hi')
+    tables = []
+    for name in ['muons_13TeV','electrons_13TeV','electronTrigger_13TeV','trackerMuonDZ_13TeV','globalMuonDZ_13TeV']:
+        for key, lookup in getattr(trigscaler,name).iteritems():
+            if key=='version': continue
+            tables += [('%s:%s' % (name,key), lookup, absetaKeys)]
+    for name in ['hww_singleEle23','hww_singleMu20']:
+        tables += [(name, getattr(trigscaler,name), ('pt_lo','pt_hi','eta_lo','eta_hi'))]
+    for leg, lookup in trigscaler.ww_scales.iteritems():
+        tables += [('ww_scales:%s' % leg, lookup, (0,1,2,3))]
+    for name in ['m_id_dict_13tev','e_id_dict_13tev']:
+        for key, lookup in getattr(leptonscaler,name).iteritems():
+            if key=='version': continue
+            tables += [('%s:%s' % (name,key), lookup, absetaKeys)]
+
+    failures = 0
+    for name, lookup, keys in tables:
+        failures += validate(name, lookup, keys, args.numTrials)
+
+    efficiency = LeptonEfficiency()
+    fakerate = LeptonFakeRate()
+    hists = extracted_hists(efficiency, fakerate, leptonscaler)
+    for obj, attr, fileName, histName in hists:
+        rootfile = rt.TFile.Open(os.path.join(os.path.dirname(scale_factors.__file__),fileName),'READ')
+        failures += validate_hist('%s:%s' % (fileName,histName), getattr(obj,attr), rootfile.Get(histName), args.numTrials)
+        rootfile.Close()
+
+    logger.info('Compared %i tables and %i histograms, %i differences' % (len(tables), len(hists), failures))
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    status = main()
+    sys.exit(status)
@@ -0,0 +1,389 @@
+'''
+Utilities to split ISA runs into file level work units and merge the outputs.
+
+A sample is split into units of consecutive input files. Each unit is run as an
+independent analyzer job writing a part ntuple. Merging the parts in file order,
+keeping the first occurrence of each event, reproduces a serial run over all the
+files: the analyzer only writes an event in the first file in which it is stored
+(later files can not replace it), and the best candidate is chosen within that file.
+The cutflow histograms (processed events from metaInfo) are summed.
+
+Duplicate events are found from the event keys alone: the run, lumi and evt
+branches are read in bulk into arrays, the first occurrence of each key is found
+by a stable sort, and the kept entries are copied in one pass with an entry list.
+
+Many outputs are merged at once on a pool of workers (mergeJobs), either
+concatenated as hadd does (fast merged when the trees of the files have the same
+branches) or merged as parts, dropping the duplicate events.
+
+In checkpoint mode every input file is its own part, and the completed files are
+recorded in a checkpoint after each one, so an interrupted run resumes from the
+first file not done and merges to the same output.
+
+In incremental mode the output of every input file is cached under a key of the
+input file (size and modification time, or its hash), the analyzer, the period,
+the met shifts, the output profile and the analyzer sources. Only the files without a cached output
+are run, the cached outputs are merged as the parts are.
+
+Author: Devin N. Taylor, UW-Madison
+'''
+
+import os
+import time
+import json
+import logging
+from multiprocessing import Pool
+
+import numpy as np
+
+import ROOT as rt
+rt.PyConfig.IgnoreCommandLineOptions = True
+
+from InitialStateAnalysis.Analyzers.ntuples import getEventStruct, getCutTreeEventStruct
+from InitialStateAnalysis.Utilities.utilities import hashfile, hashstring
+
+def getFileSize(fileName):
+    '''Size of an input file, 0 if it can not be determined (i.e. remote)'''
+    try:
+        return os.path.getsize(fileName.strip())
+    except OSError:
+        return 0
+
+def buildWorkUnits(filelists, unitSize):
+    '''
+    Split the file lists of the samples into units of consecutive files with at most unitSize bytes
+    (a single file larger than unitSize is its own unit).
+    Returns a list of (sample, unit index, files, size) sorted largest first.
+    '''
+    units = []
+    for sample, files in filelists.iteritems():
+        unitFiles = []
+        size = 0
+        index = 0
+        for f in files:
+            fsize = getFileSize(f)
+            if unitFiles and size+fsize>unitSize:
+                units += [(sample, index, unitFiles, size)]
+                index += 1
+                unitFiles = []
+                size = 0
+            unitFiles += [f]
+            size += fsize
+        if unitFiles: units += [(sample, index, unitFiles, size)]
+    return sorted(units, key=lambda x: x[3], reverse=True)
+
+def getUnitSize(filelists, numCores, unitsPerCore=4):
+    '''Choose a unit size giving about unitsPerCore units per core'''
+    sizes = [getFileSize(f) for files in filelists.itervalues() for f in files]
+    if not sizes: return 0
+    return max(sum(sizes)/(numCores*unitsPerCore), max(sizes))
+
+def readEventKeys(tchain, chunkSize=1000000):
+    '''
+    The run, lumi and evt of every entry of a chain as numpy arrays, reading only the event branch.
+    The values are read with TTree::Draw in chunks of entries (exact for event numbers below 2^53).
+    '''
+    numEntries = tchain.GetEntries()
+    keys = [np.empty(numEntries, dtype=np.uint64) for i in range(3)]
+    tchain.SetEstimate(min(chunkSize, numEntries)+1)
+    for start in xrange(0, numEntries, chunkSize):
+        num = tchain.Draw('event.run:event.lumi:event.evt', '', 'goff', chunkSize, start)
+        for key, values in zip(keys, [tchain.GetV1(), tchain.GetV2(), tchain.GetV3()]):
+            values.SetSize(num)
+            key[start:start+num] = np.frombuffer(values, dtype=np.float64, count=num)
+    return keys
+
+def firstOccurrences(run, lumi, evt):
+    '''The sorted indices of the first occurrence of each (run, lumi, evt)'''
+    if not len(evt): return np.empty(0, dtype=np.int64)
+    order = np.lexsort((evt, lumi, run)) # stable, the first entry of an event sorts first
+    run, lumi, evt = run[order], lumi[order], evt[order]
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = (run[1:]!=run[:-1]) | (lumi[1:]!=lumi[:-1]) | (evt[1:]!=evt[:-1])
+    return np.sort(order[first])
+
+def copyEntries(tchain, entries, outFile):
+    '''Copy the entries of a chain (sorted global entry numbers) to a new tree in outFile in one pass'''
+    outFile.cd()
+    if len(entries)==tchain.GetEntries():
+        return tchain.CloneTree(-1, 'fast')
+    entryList = rt.TEntryList('keep', 'keep', tchain)
+    for entry in entries:
+        entryList.Enter(long(entry), tchain)
+    tchain.SetEntryList(entryList)
+    outFile.cd()
+    tree = tchain.CopyTree('')
+    tchain.SetEntryList(0)
+    return tree
+
+def dedupChain(tchain, outFile):
+    '''
+    Copy a chain to outFile keeping the first occurrence of each event (in chain order).
+    Returns the tree and the number of duplicate entries dropped.
+    '''
+    numEntries = tchain.GetEntries()
+    if not numEntries:
+        outFile.cd()
+        return tchain.CloneTree(0), 0
+    keep = firstOccurrences(*readEventKeys(tchain))
+    return copyEntries(tchain, keep, outFile), numEntries-len(keep)
+
+def dedupChainLoop(tchain, outFile, eventStruct, address):
+    '''
+    Copy a chain to outFile keeping the first occurrence of each event, entry by entry.
+    Returns the tree and the number of duplicate entries dropped.
+    '''
+    numEntries = tchain.GetEntries()
+    tchain.SetBranchAddress('event',address)
+    outFile.cd()
+    tree = tchain.CloneTree(0)
+    events = set()
+    numDuplicates = 0
+    for i in xrange(numEntries):
+        tchain.GetEntry(i)
+        eventkey = (eventStruct.run, eventStruct.lumi, eventStruct.evt)
+        if eventkey in events:
+            numDuplicates += 1
+            continue
+        events.add(eventkey)
+        tree.Fill()
+    return tree, numDuplicates
+
+def mergeTree(partNames, treeName, outFile, dedupMode='sorted'):
+    '''
+    Merge a tree from part files in order, keeping the first occurrence of each event
+    (found from the sorted keys, or entry by entry with dedupMode loop).
+    Returns the number of duplicate entries dropped.
+    '''
+    logger = logging.getLogger(__name__)
+    tchain = rt.TChain(treeName)
+    for partName in partNames:
+        tchain.Add(partName)
+    numEntries = tchain.GetEntries()
+    if dedupMode=='loop':
+        if treeName=='cutTree':
+            event, eventStr = getCutTreeEventStruct()
+            address = rt.AddressOf(event,'evt')
+        else:
+            event, eventStr = getEventStruct()
+            address = rt.AddressOf(event,'gen_weight')
+        tree, numDuplicates = dedupChainLoop(tchain, outFile, event, address)
+    else:
+        tree, numDuplicates = dedupChain(tchain, outFile)
+    if numEntries:
+        # keep the aliases of the parts (i.e. the cuts of a packed cut tree)
+        tchain.LoadTree(0)
+        aliases = tchain.GetTree().GetListOfAliases()
+        for alias in (aliases or []):
+            tree.SetAlias(alias.GetName(), alias.GetTitle())
+    logger.debug('Merged %s: %i entries, %i duplicates' % (treeName, numEntries, numDuplicates))
+    outFile.cd()
+    tree.Write()
+    return numDuplicates
+
+def mergeParts(partNames, outName, channel, dedupMode='sorted'):
+    '''
+    Merge the part outputs of a sample (in file order) into outName, dropping duplicate events.
+    '''
+    logger = logging.getLogger(__name__)
+    partNames = [x for x in partNames if os.path.isfile(x)]
+    outFile = rt.TFile(outName,'recreate')
+    compression = fileCompression(partNames)
+    if compression is not None: outFile.SetCompressionSettings(compression)
+
+    # the ntuple and the cut tree
+    numDuplicates = mergeTree(partNames, channel, outFile, dedupMode=dedupMode)
+    if numDuplicates: logger.info('%s: dropped %i events stored in more than one part' % (outName, numDuplicates))
+    hasCutTree = False
+    for partName in partNames:
+        partFile = rt.TFile(partName)
+        if partFile.Get('cutTree'): hasCutTree = True
+        partFile.Close()
+        if hasCutTree: break
+    if hasCutTree:
+        mergeTree(partNames, 'cutTree', outFile, dedupMode=dedupMode)
+
+    # sum the cutflows
+    cutflowHist = None
+    for partName in partNames:
+        partFile = rt.TFile(partName)
+        partHist = partFile.Get('cutflow')
+        if partHist:
+            if cutflowHist:
+                cutflowHist.Add(partHist)
+            else:
+                outFile.cd()
+                cutflowHist = partHist.Clone('cutflow')
+        partFile.Close()
+    outFile.cd()
+    if cutflowHist: cutflowHist.Write()
+    outFile.Close()
+
+def fileCompression(fileNames):
+    '''The compression settings of the first file that can be opened (the merged output keeps them), None if none'''
+    for fileName in fileNames:
+        tfile = rt.TFile.Open(fileName)
+        if not tfile or tfile.IsZombie(): continue
+        compression = tfile.GetCompressionSettings()
+        tfile.Close()
+        return compression
+    return None
+
+def treeSchema(fileName):
+    '''The trees of a file and their branches (name and leaf list)'''
+    schema = {}
+    tfile = rt.TFile.Open(fileName)
+    if not tfile or tfile.IsZombie(): return schema
+    for key in tfile.GetListOfKeys():
+        if key.GetClassName()!='TTree': continue
+        tree = key.ReadObj()
+        schema[key.GetName()] = [(b.GetName(), b.GetTitle()) for b in tree.GetListOfBranches()]
+    tfile.Close()
+    return schema
+
+def haddFiles(outName, fileNames, fast=True):
+    '''
+    Merge files in process as hadd does: the trees (including metaInfo) are concatenated and the histograms
+    (the cutflow) are summed. In fast mode the compressed baskets are copied without unpacking the entries,
+    which requires the trees of all files to have the same branches (and the output keeps the compression of
+    the first file, see fileCompression). Returns True if the merge succeeded.
+    '''
+    merger = rt.TFileMerger(False, False)
+    merger.SetPrintLevel(0)
+    merger.SetFastMethod(fast)
+    compression = fileCompression(fileNames)
+    opened = merger.OutputFile(outName, 'RECREATE') if compression is None else merger.OutputFile(outName, 'RECREATE', compression)
+    if not opened: return False
+    for fileName in fileNames:
+        if not merger.AddFile(fileName): return False
+    return bool(merger.Merge())
+
+def runMergeJob(job):
+    '''
+    Run a merge job (the worker of mergeJobs): (mode, outName, fileNames, channel, dedupMode).
+    In mode hadd the files are concatenated (fast merged if they have the same schema), in mode dedup
+    they are merged as parts, dropping the duplicate events.
+    Returns a dictionary of the merge statistics, failed is set if the merge failed.
+    '''
+    mode, outName, fileNames, channel, dedupMode = job
+    start = time.time()
+    fast = False
+    try:
+        if mode=='dedup':
+            mergeParts(fileNames, outName, channel, dedupMode=dedupMode)
+            failed = not os.path.isfile(outName)
+        else:
+            schemas = [treeSchema(f) for f in fileNames]
+            fast = all([x==schemas[0] for x in schemas])
+            failed = not haddFiles(outName, fileNames, fast=fast)
+    except Exception as e:
+        logging.getLogger(__name__).error('%s: %s' % (outName, e))
+        failed = True
+    return {
+        'outName'  : outName,
+        'mode'     : mode,
+        'files'    : len(fileNames),
+        'MB'       : sum([getFileSize(f) for f in fileNames])/1e6,
+        'outMB'    : getFileSize(outName)/1e6,
+        'fast'     : fast,
+        'seconds'  : time.time()-start,
+        'failed'   : failed,
+    }
+
+def mergeJobs(jobs, numCores):
+    '''
+    Run merge jobs on a pool of numCores workers, largest first so the longest merges do not start last.
+    Logs the throughput of each job and of the pool, returns the statistics of the jobs.
+    '''
+    logger = logging.getLogger(__name__)
+    if not jobs: return []
+    jobs = sorted(jobs, key=lambda job: sum([getFileSize(f) for f in job[2]]), reverse=True)
+    numWorkers = max(min(numCores,len(jobs)),1)
+    logger.info('Merging %i outputs on %i cores' % (len(jobs), numWorkers))
+    start = time.time()
+    results = []
+    p = Pool(numWorkers)
+    try:
+        for result in p.imap_unordered(runMergeJob, jobs, chunksize=1):
+            if result['failed']:
+                logger.error('%s: merge failed' % result['outName'])
+            else:
+                logger.info('%s: %i files, %.1f MB in %.1f s (%.1f MB/s%s)' % (result['outName'], result['files'], result['MB'], result['seconds'], result['MB']/result['seconds'] if result['seconds'] else 0., ', fast' if result['fast'] else ''))
+            results += [result]
+        p.close()
+    except KeyboardInterrupt:
+        p.terminate()
+        raise
+    finally:
+        p.join()
+    seconds = time.time()-start
+    totalMB = sum([x['MB'] for x in results])
+    logger.info('Merged %i outputs, %.1f MB in %.1f s (%.1f MB/s)' % (len(results), totalMB, seconds, totalMB/seconds if seconds else 0.))
+    return results
+
+def readCheckpoint(stateName, files, config={}):
+    '''
+    The completed files (index: part name) recorded in a checkpoint.
+    Empty if there is no checkpoint or it was made for another file list or configuration (met shift and
+    analyzer options), entries with a missing part are dropped.
+    '''
+    logger = logging.getLogger(__name__)
+    if not os.path.isfile(stateName): return {}
+    with open(stateName,'r') as f:
+        state = json.load(f)
+    if state['files']!=files:
+        logger.warning('%s: the file list changed, starting over' % stateName)
+        return {}
+    if state.get('config',{})!=json.loads(json.dumps(config)):
+        logger.warning('%s: the met shift or analyzer options changed, starting over' % stateName)
+        return {}
+    return dict([(int(index), partName) for index, partName in state['done'].iteritems() if os.path.isfile(partName)])
+
+def writeCheckpoint(stateName, files, done, config={}):
+    '''Record the completed files (the state is replaced atomically, an interrupted write leaves the previous one)'''
+    tmpName = stateName + '.tmp'
+    with open(tmpName,'w') as f:
+        json.dump({'files': files, 'config': config, 'done': dict([(str(index), partName) for index, partName in done.iteritems()])}, f, indent=1)
+    os.rename(tmpName, stateName)
+
+def inputFingerprint(fileName, useHash=False):
+    '''Fingerprint of an input file: its path with its size and modification time, or with the hash of its contents'''
+    fileName = fileName.strip()
+    path = os.path.abspath(fileName)
+    if useHash: return '%s:%s' % (path, hashfile(fileName))
+    stat = os.stat(fileName)
+    return '%s:%i:%r' % (path, stat.st_size, stat.st_mtime)
+
+def sourceHash(sourceDir):
+    '''Hash of the files (sources, scale factor and pileup tables) in a directory'''
+    hashes = []
+    for dirName, subDirs, fileNames in os.walk(sourceDir, followlinks=True):
+        subDirs.sort()
+        for fileName in sorted(fileNames):
+            if os.path.splitext(fileName)[1] in ['.pyc','.pyo','.bundle','.tmp']: continue
+            path = os.path.join(dirName, fileName)
+            hashes += ['%s:%s' % (os.path.relpath(path, sourceDir), hashfile(path))]
+    return hashstring('\n'.join(hashes))
+
+# analyzer options that do not change the output, left out of the cache configuration
+runtimeOptions = ['indexSpillDir','prefetchDir','prefetchFiles','prefetchSize','profile','metShifts']
+
+def cacheConfig(analyzerName, period, metShift, metShifts, codeHash, options={}):
+    '''
+    The configuration of the cached outputs: everything but the input file that can change an output, i.e. the
+    analyzer, the period, the met shifts, the hash of the sources and the analyzer options (with the contents of
+    the branch file in activate mode).
+    '''
+    keyOptions = dict([(key, val) for key, val in options.iteritems() if key not in runtimeOptions])
+    branchFile = keyOptions.pop('branchFile','')
+    if keyOptions.get('branchMode')=='activate':
+        keyOptions['branchFile'] = hashfile(branchFile) if os.path.isfile(branchFile) else ''
+    return {'analyzer': analyzerName, 'period': period, 'metShift': metShift, 'metShifts': sorted(metShifts), 'codeHash': codeHash, 'options': keyOptions}
+
+def configKey(config):
+    '''The key of a cache configuration, the outputs of each configuration are kept in their own directory'''
+    return hashstring(json.dumps(config, sort_keys=True))
+
+def cacheKey(fingerprint):
+    '''The key of the cached output of an input file (within the directory of its configuration)'''
+    return hashstring(fingerprint)